@@ -0,0 +1,151 @@
+"""
+Асинхронный сервер панели управления на aiohttp (ADMIN_SERVER=aiohttp).
+
+Вместо отладочного сервера Flask в отдельном потоке запросы принимает один
+цикл событий asyncio в потоке admin-loop:
+    - лёгкие маршруты (/ping, /healthz) отвечают прямо в цикле, без потоков;
+    - экспорты отдаются потоком по частям, не собирая весь файл в памяти;
+    - долгие операции (публикация поста) выполняются фоновыми задачами,
+      а маршрут сразу возвращает номер задачи;
+    - остальные маршруты обслуживает прежнее Flask-приложение: его WSGI
+      вызывается в небольшом пуле потоков, поэтому панель работает как раньше.
+
+В цикле живёт общая aiohttp.ClientSession: через неё скачивают файлы и панель,
+и обработчики бота (см. fetch), поэтому соединения переиспользуются, а не
+открываются новой сессией на каждый запрос.
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Any, Awaitable, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних фоновых задач хранится для просмотра статуса
+MAX_TASKS = 100
+
+
+class AsyncAdminServer:
+    """Сервер aiohttp в собственном цикле событий с передачей остальных запросов в WSGI-приложение."""
+
+    def __init__(self, wsgi_app: Callable, host: str = '0.0.0.0', port: int = 8080, workers: int = 4):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='admin')
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.app = web.Application()
+        # Фоновые задачи: {id: {'name', 'status', 'result', 'error', 'started_at', 'finished_at'}}
+        self.tasks: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._started = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._started.is_set()
+
+    def add_route(self, method: str, path: str, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> None:
+        """Добавляет маршрут, обслуживаемый прямо в цикле событий (до запуска сервера)."""
+        self.app.router.add_route(method, path, handler)
+
+    # Запуск
+
+    async def _start(self) -> None:
+        self.session = aiohttp.ClientSession()
+        # Всё, что не обслуживается асинхронными маршрутами, уходит во Flask
+        self.app.router.add_route('*', '/{tail:.*}', self._handle_wsgi)
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._start())
+        self._started.set()
+        logger.info(f'Асинхронный сервер панели управления запущен на порту {self.port}')
+        self.loop.run_forever()
+
+    def start(self, timeout: float = 10) -> None:
+        """Запускает цикл событий в потоке admin-loop и ждёт, пока сервер начнёт принимать запросы."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='admin-loop', daemon=True)
+            self._thread.start()
+        if not self._started.wait(timeout):
+            raise RuntimeError('Асинхронный сервер панели управления не запустился')
+
+    def submit(self, coroutine: Awaitable) -> Future:
+        """Запускает корутину в цикле сервера из любого потока."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Общие ресурсы
+
+    async def fetch(self, url: str, timeout: float = 30) -> Tuple[int, str, bytes]:
+        """Скачивает URL через общую сессию; возвращает статус, Content-Type и содержимое."""
+        async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status, response.headers.get('Content-Type', ''), await response.read()
+
+    async def run_blocking(self, func: Callable, *args: Any) -> Any:
+        """Выполняет блокирующую функцию в пуле потоков сервера, не занимая цикл событий."""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    # Фоновые задачи
+
+    async def _run_task(self, task_id: str, func: Callable, args: tuple) -> None:
+        task = self.tasks[task_id]
+        try:
+            task['result'] = await self.run_blocking(func, *args)
+            task['status'] = 'done'
+        except Exception as e:
+            logger.error(f"Ошибка фоновой задачи {task['name']}: {e}")
+            task['status'] = 'failed'
+            task['error'] = str(e)
+        task['finished_at'] = time.time()
+
+    def start_task(self, name: str, func: Callable, *args: Any) -> str:
+        """
+        Запускает блокирующую функцию фоновой задачей (вызывать из цикла событий).
+
+        Returns:
+            str: Номер задачи для просмотра её статуса
+        """
+        task_id = uuid.uuid4().hex[:12]
+        self.tasks[task_id] = {'name': name, 'status': 'running', 'result': None, 'error': None,
+                               'started_at': time.time(), 'finished_at': None}
+        while len(self.tasks) > MAX_TASKS:
+            self.tasks.popitem(last=False)
+        self.loop.create_task(self._run_task(task_id, func, args))
+        return task_id
+
+    # Передача запросов во Flask
+
+    def _call_wsgi(self, method: str, path: str, query_string: str, headers: list,
+                   body: bytes, base_url: str, remote_addr: str) -> Tuple[str, list, bytes]:
+        builder = EnvironBuilder(path=path, base_url=base_url, query_string=query_string,
+                                 method=method, headers=headers, data=body,
+                                 environ_overrides={'REMOTE_ADDR': remote_addr})
+        try:
+            app_iter, status, response_headers = run_wsgi_app(self.wsgi_app, builder.get_environ(), buffered=True)
+            return status, list(response_headers.items()), b''.join(app_iter)
+        finally:
+            builder.close()
+
+    async def _handle_wsgi(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        status, headers, content = await self.run_blocking(
+            self._call_wsgi, request.method, request.path, request.query_string,
+            list(request.headers.items()), body, f'{request.scheme}://{request.host}', request.remote or '')
+
+        # Длину и кодирование тела выставляет aiohttp
+        response_headers = CIMultiDict((name, value) for name, value in headers
+                                       if name.lower() not in ('content-length', 'transfer-encoding'))
+        return web.Response(status=int(status.split(' ', 1)[0]), headers=response_headers, body=content)
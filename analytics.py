@@ -0,0 +1,524 @@
+"""
+Журнал событий бота для воронок и когорт.
+
+Обработчики пишут события (start, check, subscribed, pdf_sent, delivery_fallback)
+вызовом EventStore.record: событие кладётся в очередь в памяти, а на диск его
+пишет фоновый поток пачками, поэтому обработчик не ждёт диска.
+
+Хранение (каталог events/ бота):
+    log-YYYYMMDD.bin    сырой журнал дня: записи фиксированного размера
+                        (время, user_id, событие, источник), только дописываются
+    day-YYYYMMDD.col    свёрнутый день: для каждой пары (событие, источник)
+                        отсортированные user_id без повторов и время первого
+                        события, колонками array; пишется после окончания дня
+    sources.json        словарь источников (payload ссылки /start) → код
+
+Текущий день хранится в памяти множествами пользователей по парам
+(событие, источник) и восстанавливается из сырого журнала при запуске.
+Запросы работают с битовыми картами пользователей (UserBitmap): объединение,
+пересечение и подсчёт выполняются над целыми числами на C, а карты
+завершённых дней строятся из колонок один раз и держатся в кэше (карты
+последних WARM_DAYS дней фоновый поток строит заранее), поэтому воронка и
+когорты по миллионам событий считаются за доли секунды.
+Сырые журналы удаляются через raw_retention_days дней, свёрнутые дни хранятся.
+"""
+import bisect
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Collection, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Типы событий; код события — индекс в кортеже
+EVENTS = ('start', 'check', 'subscribed', 'pdf_sent', 'delivery_fallback')
+_EVENT_CODES = {name: code for code, name in enumerate(EVENTS)}
+
+# Шаги воронки по умолчанию
+FUNNEL_STEPS = ('start', 'subscribed', 'pdf_sent')
+
+# Срез «любое событие» в свёрнутом дне (активные пользователи)
+ANY_EVENT = 255
+
+# Запись сырого журнала: время (секунды эпохи), user_id, код события, код источника
+_RECORD = struct.Struct('<IqBH')
+
+# Сколько событий может ждать записи; лишние отбрасываются, чтобы не копить память
+MAX_PENDING = 100000
+
+# Сколько свёрнутых дней держится в памяти для запросов
+PARTITION_CACHE_SIZE = 90
+
+# Сколько битовых карт (день, событие, источник) завершённых дней держится в памяти
+BITMAP_CACHE_SIZE = 512
+
+# Карта пользователей (UserBitmap) делится на блоки по 2 ** CHUNK_BITS соседних user_id;
+# блок, где пользователей не больше SPARSE_LIMIT, хранится множеством, а не битами:
+# на границе оба варианта занимают около 64 байт на пользователя
+CHUNK_BITS = 20
+SPARSE_LIMIT = (1 << CHUNK_BITS) // 512
+_CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Сколько последних завершённых дней фоновый поток заранее переводит в карты
+WARM_DAYS = 14
+
+SliceKey = Tuple[int, int]
+
+# Блок карты пользователей: биты целого числа или множество смещений внутри блока
+Chunk = Union[int, FrozenSet[int]]
+
+
+def _day_stamp(day: date) -> str:
+    return day.strftime('%Y%m%d')
+
+
+def _day_of(timestamp: float) -> date:
+    return datetime.fromtimestamp(timestamp).date()
+
+
+class UserBitmap:
+    """
+    Множество user_id блоками по 2 ** CHUNK_BITS соседних значений.
+
+    Блок, где больше SPARSE_LIMIT пользователей, хранится битами целого числа:
+    объединение, пересечение и подсчёт выполняются над числом на C. Редкий
+    блок хранится множеством смещений — битовая карта на нескольких
+    пользователей заняла бы больше места. Пустые блоки не хранятся.
+    Карты неизменяемы: операции возвращают новые карты.
+    """
+
+    __slots__ = ('_chunks',)
+
+    def __init__(self, chunks: Optional[Dict[int, Chunk]] = None):
+        self._chunks = chunks or {}
+
+    @classmethod
+    def of(cls, user_ids: Iterable[int]) -> 'UserBitmap':
+        """Карта из user_id в любом порядке."""
+        offsets: Dict[int, List[int]] = {}
+        for user_id in user_ids:
+            offsets.setdefault(user_id >> CHUNK_BITS, []).append(user_id & _CHUNK_MASK)
+        return cls({key: _chunk(chunk_offsets) for key, chunk_offsets in offsets.items()})
+
+    @classmethod
+    def of_sorted(cls, user_ids: Sequence[int]) -> 'UserBitmap':
+        """Карта из отсортированных user_id (колонки свёрнутого дня): границы блоков ищутся бинарным поиском."""
+        chunks = {}
+        start = 0
+        while start < len(user_ids):
+            key = user_ids[start] >> CHUNK_BITS
+            end = bisect.bisect_left(user_ids, (key + 1) << CHUNK_BITS, start)
+            chunks[key] = _chunk([user_id & _CHUNK_MASK for user_id in user_ids[start:end]])
+            start = end
+        return cls(chunks)
+
+    def __or__(self, other: 'UserBitmap') -> 'UserBitmap':
+        chunks = dict(self._chunks)
+        for key, chunk in other._chunks.items():
+            chunks[key] = _union(chunks[key], chunk) if key in chunks else chunk
+        return UserBitmap(chunks)
+
+    def __and__(self, other: 'UserBitmap') -> 'UserBitmap':
+        small, large = sorted((self._chunks, other._chunks), key=len)
+        chunks = {}
+        for key, chunk in small.items():
+            if key in large:
+                common = _intersection(chunk, large[key])
+                if common:
+                    chunks[key] = common
+        return UserBitmap(chunks)
+
+    def __len__(self) -> int:
+        return sum(_popcount(chunk) if isinstance(chunk, int) else len(chunk) for chunk in self._chunks.values())
+
+
+def _popcount(bits: int) -> int:
+    return bits.bit_count() if hasattr(bits, 'bit_count') else bin(bits).count('1')
+
+
+def _bits(offsets: Iterable[int]) -> int:
+    chunk = bytearray(1 << (CHUNK_BITS - 3))
+    for offset in offsets:
+        chunk[offset >> 3] |= 1 << (offset & 7)
+    return int.from_bytes(chunk, 'little')
+
+
+def _chunk(offsets: Collection[int]) -> Chunk:
+    return frozenset(offsets) if len(offsets) <= SPARSE_LIMIT else _bits(offsets)
+
+
+def _union(left: Chunk, right: Chunk) -> Chunk:
+    if isinstance(left, int) and isinstance(right, int):
+        return left | right
+    if isinstance(left, int):
+        return left | _bits(right)
+    if isinstance(right, int):
+        return right | _bits(left)
+    return _chunk(left | right)
+
+
+def _intersection(left: Chunk, right: Chunk) -> Chunk:
+    if isinstance(left, int) and isinstance(right, int):
+        return left & right
+    if isinstance(left, int):
+        return left & _bits(right)
+    if isinstance(right, int):
+        return _bits(left) & right
+    return left & right
+
+
+class DayPartition:
+    """Свёрнутый день: колонки user_id и времени первого события, нарезанные по (событие, источник)."""
+
+    def __init__(self, users: array, first_seen: array, slices: Dict[SliceKey, Tuple[int, int]]):
+        self._users = users
+        self._first_seen = first_seen
+        self._slices = slices
+
+    @classmethod
+    def build(cls, records: Iterable[Tuple[int, int, int, int]]) -> 'DayPartition':
+        """Сворачивает записи дня (время, user_id, событие, источник)."""
+        first_seen: Dict[SliceKey, Dict[int, int]] = {}
+        for timestamp, user_id, event, source in records:
+            for key in ((event, source), (ANY_EVENT, 0)):
+                seen = first_seen.setdefault(key, {})
+                if user_id not in seen or timestamp < seen[user_id]:
+                    seen[user_id] = timestamp
+
+        users = array('q')
+        times = array('I')
+        slices = {}
+        for key in sorted(first_seen):
+            seen = first_seen[key]
+            ordered = sorted(seen)
+            slices[key] = (len(users), len(ordered))
+            users.extend(ordered)
+            times.extend(seen[user_id] for user_id in ordered)
+        return cls(users, times, slices)
+
+    def users(self, event: int, source: Optional[int] = None) -> UserBitmap:
+        """Пользователи с событием за день; source=None — из всех источников."""
+        if source is not None:
+            offset, count = self._slices.get((event, source), (0, 0))
+            return UserBitmap.of_sorted(self._users[offset:offset + count])
+        result = UserBitmap()
+        for (slice_event, _), (offset, count) in self._slices.items():
+            if slice_event == event:
+                result |= UserBitmap.of_sorted(self._users[offset:offset + count])
+        return result
+
+    def save(self, path: str) -> None:
+        header = json.dumps({'slices': [[event, source, offset, count]
+                                        for (event, source), (offset, count) in self._slices.items()],
+                             'count': len(self._users)}).encode()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(struct.pack('<I', len(header)))
+            file.write(header)
+            self._users.tofile(file)
+            self._first_seen.tofile(file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'DayPartition':
+        with open(path, 'rb') as file:
+            header_size = struct.unpack('<I', file.read(4))[0]
+            header = json.loads(file.read(header_size))
+            users = array('q')
+            users.fromfile(file, header['count'])
+            first_seen = array('I')
+            first_seen.fromfile(file, header['count'])
+        slices = {(event, source): (offset, count) for event, source, offset, count in header['slices']}
+        return cls(users, first_seen, slices)
+
+
+class LiveDay:
+    """Текущий день в памяти: множества пользователей по (событие, источник)."""
+
+    def __init__(self, day: date):
+        self.day = day
+        self._sets: Dict[SliceKey, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id: int, event: int, source: int) -> None:
+        with self._lock:
+            self._sets.setdefault((event, source), set()).add(user_id)
+            self._sets.setdefault((ANY_EVENT, 0), set()).add(user_id)
+
+    def users(self, event: int, source: Optional[int] = None) -> UserBitmap:
+        with self._lock:
+            if source is not None:
+                users = set(self._sets.get((event, source), ()))
+            else:
+                users = set()
+                for (slice_event, _), slice_users in self._sets.items():
+                    if slice_event == event:
+                        users.update(slice_users)
+        return UserBitmap.of(users)
+
+
+class EventStore:
+    """Журнал событий одного бота с фоновой записью, свёрткой по дням и запросами."""
+
+    def __init__(self, directory: str, raw_retention_days: int = 30, flush_interval: float = 1.0):
+        self.directory = directory
+        self.raw_retention_days = raw_retention_days
+        self.flush_interval = flush_interval
+
+        self._pending: deque = deque()
+        self.dropped = 0
+        self._sources: Dict[str, int] = {'': 0}
+        self._sources_lock = threading.Lock()
+        self._sources_dirty = False
+        self._partitions: 'OrderedDict[date, DayPartition]' = OrderedDict()
+        self._partitions_lock = threading.Lock()
+        self._bitmaps: 'OrderedDict[Tuple[date, int, Optional[int]], UserBitmap]' = OrderedDict()
+        self._bitmaps_lock = threading.Lock()
+        self._live = LiveDay(date.today())
+        self._thread: Optional[threading.Thread] = None
+
+        sources_file = os.path.join(directory, 'sources.json')
+        if os.path.exists(sources_file):
+            with open(sources_file, 'r', encoding='utf-8') as file:
+                self._sources.update(json.load(file))
+
+    # Запись
+
+    def record(self, event: str, user_id: int, source: str = '') -> None:
+        """Добавляет событие в очередь записи; не блокируется на диске."""
+        if len(self._pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append((int(time.time()), user_id, _EVENT_CODES[event], self._source_code(source)))
+
+    def _source_code(self, source: str) -> int:
+        code = self._sources.get(source)
+        if code is not None:
+            return code
+        with self._sources_lock:
+            code = self._sources.get(source)
+            if code is None:
+                # Коды источников ограничены двумя байтами; остальные считаются без источника
+                if len(self._sources) > 0xFFFF:
+                    return 0
+                code = self._sources[source] = len(self._sources)
+                self._sources_dirty = True
+            return code
+
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def _log_path(self, day: date) -> str:
+        return os.path.join(self.directory, f'log-{_day_stamp(day)}.bin')
+
+    def _partition_path(self, day: date) -> str:
+        return os.path.join(self.directory, f'day-{_day_stamp(day)}.col')
+
+    def _flush(self) -> None:
+        """Дописывает накопившиеся события в сырые журналы их дней."""
+        batches: Dict[date, bytearray] = {}
+        while self._pending:
+            timestamp, user_id, event, source = record = self._pending.popleft()
+            day = _day_of(timestamp)
+            batches.setdefault(day, bytearray()).extend(_RECORD.pack(*record))
+            if day > self._live.day:
+                self._live = LiveDay(day)
+            if day == self._live.day:
+                self._live.add(user_id, event, source)
+
+        if batches:
+            os.makedirs(self.directory, exist_ok=True)
+        for day, data in batches.items():
+            with open(self._log_path(day), 'ab') as file:
+                file.write(data)
+
+        if self._sources_dirty:
+            self._sources_dirty = False
+            with self._sources_lock:
+                sources = dict(self._sources)
+            tmp_path = os.path.join(self.directory, 'sources.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(sources, file, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(self.directory, 'sources.json'))
+
+    def _read_log(self, day: date) -> Iterable[Tuple[int, int, int, int]]:
+        with open(self._log_path(day), 'rb') as file:
+            data = file.read()
+        # Хвост недописанной записи после сбоя пропускаем
+        return _RECORD.iter_unpack(data[:len(data) - len(data) % _RECORD.size])
+
+    # Свёртка и хранение
+
+    def _rollup(self) -> None:
+        """Сворачивает завершённые дни и удаляет сырые журналы старше срока хранения."""
+        today = date.today()
+        oldest_raw = today - timedelta(days=self.raw_retention_days)
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith('log-') and name.endswith('.bin')):
+                continue
+            day = datetime.strptime(name[4:12], '%Y%m%d').date()
+            if day >= today:
+                continue
+            if not os.path.exists(self._partition_path(day)):
+                self._partition(day)
+                logger.info(f'Свёрнуты события за {day.isoformat()}')
+            if day < oldest_raw:
+                os.remove(self._log_path(day))
+                logger.info(f'Удалён сырой журнал событий за {day.isoformat()}')
+
+    def _partition(self, day: date) -> Optional[DayPartition]:
+        """Свёрнутый день (из кэша, файла или сырого журнала) или None, если событий не было."""
+        with self._partitions_lock:
+            partition = self._partitions.get(day)
+            if partition is not None:
+                self._partitions.move_to_end(day)
+                return partition
+
+            path = self._partition_path(day)
+            if os.path.exists(path):
+                partition = DayPartition.load(path)
+            elif os.path.exists(self._log_path(day)):
+                partition = DayPartition.build(self._read_log(day))
+                partition.save(path)
+            else:
+                return None
+
+            self._partitions[day] = partition
+            while len(self._partitions) > PARTITION_CACHE_SIZE:
+                self._partitions.popitem(last=False)
+            return partition
+
+    def _users(self, day: date, event: int, source: Optional[int] = None) -> UserBitmap:
+        """Пользователи с событием за день; карты завершённых дней берутся из кэша."""
+        if day == self._live.day:
+            return self._live.users(event, source)
+        if day > self._live.day:
+            return UserBitmap()
+
+        key = (day, event, source)
+        with self._bitmaps_lock:
+            users = self._bitmaps.get(key)
+            if users is not None:
+                self._bitmaps.move_to_end(key)
+                return users
+
+        partition = self._partition(day)
+        users = partition.users(event, source) if partition is not None else UserBitmap()
+        with self._bitmaps_lock:
+            self._bitmaps[key] = users
+            while len(self._bitmaps) > BITMAP_CACHE_SIZE:
+                self._bitmaps.popitem(last=False)
+        return users
+
+    def _warm(self) -> None:
+        """Строит карты последних WARM_DAYS завершённых дней, чтобы запросы брали их из кэша."""
+        for offset in range(1, WARM_DAYS + 1):
+            day = self._live.day - timedelta(days=offset)
+            for event in (*range(len(EVENTS)), ANY_EVENT):
+                self._users(day, event)
+
+    def _run(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Текущий день восстанавливается из сырого журнала
+        if os.path.exists(self._log_path(self._live.day)):
+            for _, user_id, event, source in self._read_log(self._live.day):
+                self._live.add(user_id, event, source)
+
+        last_rollup = 0.0
+        while True:
+            try:
+                self._flush()
+                if time.monotonic() - last_rollup > 60:
+                    self._rollup()
+                    self._warm()
+                    last_rollup = time.monotonic()
+            except Exception as e:
+                logger.error(f'Ошибка записи журнала событий: {e}')
+            time.sleep(self.flush_interval)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='analytics-writer', daemon=True)
+            self._thread.start()
+
+    # Запросы
+
+    def sources(self) -> List[str]:
+        with self._sources_lock:
+            return sorted(source for source in self._sources if source)
+
+    def _source_filter(self, source: Optional[str]) -> Optional[int]:
+        if source is None:
+            return None
+        # Неизвестный источник — код, которого нет ни в одном срезе
+        return self._sources.get(source, -1)
+
+    def funnel(self, date_from: date, date_to: date, source: Optional[str] = None,
+               steps: Tuple[str, ...] = FUNNEL_STEPS, window_days: int = 7) -> List[Dict[str, Any]]:
+        """
+        Воронка: пользователи первого шага за период и сколько из них дошли до следующих.
+
+        Следующий шаг засчитывается, если событие было с начала периода и не позже
+        window_days дней после его конца. Источник фильтрует первый шаг.
+
+        Returns:
+            Список шагов: событие, количество пользователей и доля от первого шага
+        """
+        days = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+        cohort = UserBitmap()
+        for day in days:
+            cohort |= self._users(day, _EVENT_CODES[steps[0]], self._source_filter(source))
+
+        size = len(cohort)
+        result = [{'event': steps[0], 'users': size, 'conversion': 1.0 if size else 0.0}]
+        reached = cohort
+        window = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + window_days + 1)]
+        for step in steps[1:]:
+            step_users = UserBitmap()
+            for day in window:
+                step_users |= self._users(day, _EVENT_CODES[step])
+            reached = reached & step_users
+            count = len(reached)
+            result.append({'event': step, 'users': count,
+                           'conversion': round(count / size, 4) if size else 0.0})
+        return result
+
+    def cohorts(self, date_from: date, date_to: date, days: int = 7, source: Optional[str] = None,
+                event: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Когорты по дню /start: сколько пользователей когорты вернулись в каждый следующий день.
+
+        Args:
+            days: Сколько дней после дня когорты считать
+            source: Источник /start для отбора когорты
+            event: Событие, которое считается возвратом; None — любое событие
+
+        Returns:
+            Список когорт: день, размер и количество вернувшихся по дням 1..days
+        """
+        event_code = _EVENT_CODES[event] if event else ANY_EVENT
+        # Дни возврата соседних когорт пересекаются: карту каждого дня строим один раз за запрос
+        returning: Dict[date, UserBitmap] = {}
+        rows = []
+        for offset in range((date_to - date_from).days + 1):
+            day = date_from + timedelta(days=offset)
+            cohort = self._users(day, _EVENT_CODES['start'], self._source_filter(source))
+            size = len(cohort)
+            returned = []
+            for k in range(1, days + 1):
+                if not size:
+                    returned.append(0)
+                    continue
+                later = day + timedelta(days=k)
+                if later not in returning:
+                    returning[later] = self._users(later, event_code)
+                returned.append(len(cohort & returning[later]))
+            rows.append({'day': day.isoformat(), 'size': size, 'returned': returned})
+        return rows
@@ -0,0 +1,261 @@
+"""
+Каталог материалов (чек-листов и других бонусов) с выбором по ссылке /start.
+
+Каталог задаётся JSON-файлом (ASSETS_FILE), например:
+
+    [
+        {"key": "checklist", "title": "Чек-лист подготовки к ремонту",
+         "url": "https://.../checklist.pdf", "payloads": ["checklist"]},
+        {"key": "kitchen", "title": "Гид по кухне", "url": "https://.../kitchen.pdf",
+         "caption": "Гид по планировке кухни", "channel_id": "@kitchen",
+         "payloads": ["kitchen", "kitchen_promo"]}
+    ]
+
+Ссылка https://t.me/<бот>?start=<payload> выбирает материал по таблице
+payload → материал, построенной при загрузке каталога; неизвестный payload
+ведёт к первому материалу. Для каждого материала можно задать свой канал,
+подписка на который нужна для получения.
+
+При запуске (шаг прогрева) каждый материал скачивается, проверяется и
+загружается в служебный чат, чтобы дальше отправляться по file_id. Запросы
+пользователей файлы не скачивают: материал без file_id отправляется из
+памяти или, если скачать его не удалось, по URL силами Telegram. file_id
+и счётчики выдачи сохраняются в assets_state.json и после перезапуска
+переиспользуются, пока файл по URL не изменился.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+# Результаты выдачи, которые считаются по каждому материалу
+COUNTER_NAMES = ('requested', 'delivered', 'failed')
+
+
+@dataclass(frozen=True)
+class Asset:
+    """Материал каталога с заранее подготовленными текстами и клавиатурой."""
+    key: str
+    title: str
+    url: str
+    file_name: str
+    caption: str
+    channel_id: str
+    payloads: Tuple[str, ...]
+    subscription_message: str
+    # Клавиатура перехода в канал, уже сериализованная в JSON
+    subscription_keyboard: str
+
+
+def load_assets(path: str, default_channel_id: str) -> List[Asset]:
+    """
+    Читает каталог материалов из JSON-файла.
+
+    Args:
+        path: Путь к файлу каталога
+        default_channel_id: Канал, подписка на который нужна, если у материала он не задан
+
+    Returns:
+        Список материалов в порядке файла; первый используется по умолчанию
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        items = json.load(file)
+    if not items:
+        raise ValueError('Каталог материалов пуст')
+
+    assets = []
+    keys = set()
+    payloads = set()
+    for item in items:
+        key = item.get('key')
+        if not key or key in keys:
+            raise ValueError(f'Ключ материала не задан или повторяется: {key!r}')
+        if not item.get('url'):
+            raise ValueError(f'Для материала {key} нужно задать url')
+        keys.add(key)
+
+        asset_payloads = tuple(dict.fromkeys(payload.lower() for payload in item.get('payloads') or [key]))
+        for payload in asset_payloads:
+            if payload in payloads:
+                raise ValueError(f'Payload {payload} указан у нескольких материалов')
+            payloads.add(payload)
+
+        title = item.get('title', key)
+        channel_id = item.get('channel_id') or default_channel_id
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.add(types.InlineKeyboardButton(text='Перейти в канал', url=f"https://t.me/{channel_id.lstrip('@')}"))
+
+        assets.append(Asset(
+            key=key,
+            title=title,
+            url=item['url'],
+            file_name=item.get('file_name', f'{title}.pdf'),
+            caption=item.get('caption', title),
+            channel_id=channel_id,
+            payloads=asset_payloads,
+            subscription_message=item.get(
+                'subscription_message',
+                f'Чтобы получить «{title}», подпишитесь на канал {channel_id} и нажмите /check для проверки подписки.'),
+            subscription_keyboard=keyboard.to_json(),
+        ))
+    return assets
+
+
+class AssetCatalog:
+    """Материалы бота, таблица выбора по payload, загруженные файлы и счётчики выдачи."""
+
+    def __init__(self, assets: List[Asset], state_file: str):
+        self.assets: Dict[str, Asset] = {asset.key: asset for asset in assets}
+        self.default = assets[0]
+        # Таблица выбора материала по payload ссылки /start
+        self.routes: Dict[str, Asset] = {payload: asset for asset in assets for payload in asset.payloads}
+        self.state_file = state_file
+
+        # Подготовленные файлы: {key: {'content', 'sha256', 'file_id', 'prepared_at', 'error'}}
+        self._media: Dict[str, Dict[str, Any]] = {
+            key: {'content': None, 'sha256': None, 'file_id': None, 'prepared_at': None, 'error': None}
+            for key in self.assets}
+        self._counters: Dict[str, Counter] = {key: Counter() for key in self.assets}
+        self._lock = threading.Lock()
+        self._load_state()
+
+    def route(self, payload: Optional[str]) -> Optional[Asset]:
+        """Материал по payload ссылки /start; None, если payload не указан или неизвестен."""
+        return self.routes.get((payload or '').strip().lower())
+
+    def get(self, key: Optional[str]) -> Optional[Asset]:
+        return self.assets.get(key) if key else None
+
+    # Подготовка файлов
+
+    def prepare(self, download: Callable[[str], bytes],
+                upload: Callable[[Asset, bytes], Optional[str]]) -> str:
+        """
+        Скачивает и проверяет все материалы; загружает в Telegram те, у которых нет file_id.
+
+        Args:
+            download: Скачивает файл по URL
+            upload: Загружает файл в служебный чат и возвращает file_id (None — загрузка не настроена)
+
+        Returns:
+            str: Сводка подготовки
+
+        Raises:
+            Exception: Если какой-то материал подготовить не удалось (остальные подготовлены)
+        """
+        failed = []
+        for asset in self.assets.values():
+            media = self._media[asset.key]
+            try:
+                content = download(asset.url)
+                if not content:
+                    raise ValueError('получен пустой файл')
+                if asset.file_name.lower().endswith('.pdf') and not content.startswith(b'%PDF'):
+                    raise ValueError('файл не является PDF')
+
+                sha256 = hashlib.sha256(content).hexdigest()
+                # file_id из прошлого запуска подходит, только если файл не изменился
+                file_id = media['file_id'] if media['sha256'] == sha256 else None
+                if file_id is None:
+                    file_id = upload(asset, content)
+                with self._lock:
+                    media.update(content=content, sha256=sha256, file_id=file_id,
+                                 prepared_at=time.time(), error=None)
+            except Exception as e:
+                logger.error(f'Ошибка подготовки материала {asset.key}: {e}')
+                media['error'] = str(e)
+                failed.append(asset.key)
+
+        self.save()
+        if failed:
+            raise Exception(f"не подготовлены: {', '.join(failed)}")
+        return f'материалов: {len(self.assets)}'
+
+    def media(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """Содержимое и file_id материала."""
+        media = self._media[key]
+        return media['content'], media['file_id']
+
+    def bind(self, key: str, file_id: str) -> None:
+        """Запоминает file_id, полученный при отправке материала пользователю."""
+        with self._lock:
+            self._media[key]['file_id'] = file_id
+
+    def forget_file_id(self, key: str) -> None:
+        """Сбрасывает file_id, который Telegram не принял."""
+        with self._lock:
+            self._media[key]['file_id'] = None
+
+    # Счётчики
+
+    def record(self, key: str, outcome: str) -> None:
+        with self._lock:
+            self._counters[key][outcome] += 1
+
+    def counters(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {key: {name: counter[name] for name in COUNTER_NAMES} for key, counter in self._counters.items()}
+
+    def report(self) -> List[Dict[str, Any]]:
+        """Состояние материалов для панели управления."""
+        counters = self.counters()
+        rows = []
+        for asset in self.assets.values():
+            media = self._media[asset.key]
+            rows.append({
+                'key': asset.key,
+                'title': asset.title,
+                'url': asset.url,
+                'channel_id': asset.channel_id,
+                'payloads': list(asset.payloads),
+                'size': len(media['content']) if media['content'] is not None else None,
+                'file_id': bool(media['file_id']),
+                'error': media['error'],
+                'counters': counters[asset.key],
+            })
+        return rows
+
+    # Хранение file_id и счётчиков
+
+    def _load_state(self) -> None:
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+        except Exception as e:
+            logger.error(f'Ошибка загрузки состояния каталога материалов: {e}')
+            return
+
+        for key, item in state.items():
+            if key not in self.assets:
+                continue
+            if item.get('url') == self.assets[key].url:
+                self._media[key].update(sha256=item.get('sha256'), file_id=item.get('file_id'))
+            self._counters[key].update(item.get('counters') or {})
+
+    def save(self) -> None:
+        with self._lock:
+            state = {key: {'url': self.assets[key].url, 'sha256': media['sha256'], 'file_id': media['file_id'],
+                           'counters': dict(self._counters[key])}
+                     for key, media in self._media.items()}
+        try:
+            directory = os.path.dirname(self.state_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            tmp_path = f'{self.state_file}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(state, file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.state_file)
+        except Exception as e:
+            logger.error(f'Ошибка сохранения состояния каталога материалов: {e}')
@@ -0,0 +1,90 @@
+"""
+Нагрузочная проверка хранилища пользователей (user_store.py).
+
+    python bench_user_store.py
+
+Печатает JSON с количеством ошибок и скоростью записей и снимков; при
+ошибках завершается с кодом 1.
+"""
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any
+
+from user_store import UserStore, write_snapshot
+
+
+def stress_test(writers: int = 8, readers: int = 4, seconds: float = 3.0) -> Dict[str, Any]:
+    """
+    Нагрузочная проверка хранилища: параллельные записи, снимки и сохранения.
+
+    Каждый писатель обновляет своих пользователей, записывая одинаковое значение
+    в два поля; читатели делают снимки, обходят их целиком и сохраняют на диск.
+    Проверяется, что ни одна запись не потеряна и ни один снимок не увидел
+    запись в промежуточном состоянии.
+    """
+    directory = tempfile.mkdtemp()
+    store = UserStore(os.path.join(directory, 'users.bin'), os.path.join(directory, 'users.json'))
+    stop = threading.Event()
+    errors = []
+    write_counts = [0] * writers
+    read_counts = [0] * readers
+    users_per_writer = 1000
+
+    def writer(number: int) -> None:
+        rng = random.Random(number)
+        expected: Dict[int, int] = {}
+        try:
+            while not stop.is_set():
+                user_id = number * users_per_writer + rng.randrange(users_per_writer)
+                store.setdefault(user_id, {'user_id': user_id, 'a': 0, 'b': 0})
+                value = expected.get(user_id, 0) + 1
+                store.update_user(user_id, a=value, b=value, last_activity=datetime.now())
+                expected[user_id] = value
+                write_counts[number] += 1
+            for user_id, value in expected.items():
+                if store[user_id]['a'] != value:
+                    errors.append(f'Потеряна запись пользователя {user_id}')
+        except Exception as e:
+            errors.append(repr(e))
+
+    def reader(number: int) -> None:
+        path = os.path.join(directory, f'reader-{number}.bin')
+        try:
+            while not stop.is_set():
+                snapshot = store.snapshot()
+                for user_data in snapshot.values():
+                    if user_data['a'] != user_data['b']:
+                        errors.append(f'Несогласованная запись {user_data}')
+                write_snapshot(path, snapshot)
+                read_counts[number] += 1
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = ([threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+               + [threading.Thread(target=reader, args=(i,)) for i in range(readers)])
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    return {
+        'errors': errors,
+        'users': len(store),
+        'writes_per_second': round(sum(write_counts) / elapsed),
+        'snapshots_per_second': round(sum(read_counts) / elapsed, 1),
+    }
+
+
+if __name__ == '__main__':
+    result = stress_test()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    raise SystemExit(1 if result['errors'] else 0)
@@ -0,0 +1,150 @@
+"""
+Запись входящих обновлений для последующего воспроизведения (см. replay.py).
+
+Обновления пишутся в сжатый gzip NDJSON: по одной строке на обновление вида
+{"ts": время получения в секундах эпохи, "update": исходный JSON обновления}.
+Идентификаторы пользователей и приватных чатов заменяются псевдонимами
+(HMAC от исходного ID), а имена и username удаляются (обязательное для
+Bot API поле first_name заменяется заглушкой). Один и тот же
+пользователь в пределах записи получает один и тот же псевдоним, поэтому
+поведение отдельных пользователей при воспроизведении сохраняется.
+
+Строки копятся в памяти и раз в FLUSH_INTERVAL дописываются в файл
+отдельным завершённым gzip member, поэтому файл всегда читается целиком,
+кроме, может быть, последнего member, недописанного при сбое: read_capture
+его пропускает. При остановке процесса запись закрывается (atexit).
+"""
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import zlib
+from typing import Dict, Any, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+# Поля с персональными данными, которые не попадают в запись
+_PERSONAL_FIELDS = ('last_name', 'username', 'phone_number', 'bio')
+
+# Как часто дописывать накопившиеся обновления в файл, в секундах
+FLUSH_INTERVAL = 5
+
+# Размер блока при чтении записи, байты
+_READ_CHUNK = 1 << 16
+
+
+class UpdateRecorder:
+    """Пишет анонимизированные обновления в сжатый NDJSON-файл."""
+
+    def __init__(self, path: str, salt: str = None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._salt = (salt or secrets.token_hex(16)).encode()
+        self._lock = threading.Lock()
+        self._lines: List[str] = []
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='capture-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        logger.info(f'Запись обновлений включена: {path}')
+
+    def anonymize_id(self, value: int) -> int:
+        """Заменяет ID пользователя стабильным псевдонимом."""
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], 'big') + 1
+
+    def _anonymize(self, data: Any) -> Any:
+        if isinstance(data, list):
+            return [self._anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            if key in _PERSONAL_FIELDS:
+                continue
+            if key == 'first_name':
+                value = 'user'
+            if key in ('from', 'user', 'chat') and isinstance(value, dict):
+                value = dict(value)
+                # Групповые чаты и каналы (отрицательные ID) не являются персональными данными
+                if isinstance(value.get('id'), int) and value['id'] > 0:
+                    value['id'] = self.anonymize_id(value['id'])
+            result[key] = self._anonymize(value)
+        return result
+
+    def record(self, raw_update: Dict[str, Any]) -> None:
+        try:
+            line = json.dumps({'ts': time.time(), 'update': self._anonymize(raw_update)}, ensure_ascii=False)
+        except Exception as e:
+            logger.error(f'Ошибка записи обновления {raw_update.get("update_id")}: {e}')
+            return
+        with self._lock:
+            self._lines.append(line + '\n')
+
+    def flush(self) -> None:
+        """Дописывает накопившиеся обновления в файл одним завершённым gzip member."""
+        with self._lock:
+            lines, self._lines = self._lines, []
+            if not lines:
+                return
+            try:
+                with open(self.path, 'ab') as file:
+                    file.write(gzip.compress(''.join(lines).encode('utf-8')))
+            except Exception as e:
+                logger.error(f'Ошибка записи обновлений в {self.path}: {e}')
+
+    def _run(self) -> None:
+        while not self._closed.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self) -> None:
+        """Дописывает оставшиеся обновления и останавливает запись (повторный вызов ничего не делает)."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+
+
+def read_capture(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Читает записанные обновления по порядку.
+
+    Обновления отдаются только из завершённых gzip member: недописанный
+    последний member (запись прервалась сбоем) пропускается с предупреждением.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    member = bytearray()
+    started = False
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(_READ_CHUNK)
+            if not chunk:
+                break
+            while chunk:
+                started = True
+                try:
+                    member += decompressor.decompress(chunk)
+                except zlib.error as e:
+                    logger.warning(f'Запись {path} повреждена, чтение остановлено: {e}')
+                    return
+                if not decompressor.eof:
+                    break
+                for line in member.decode('utf-8').splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+                member.clear()
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                started = False
+    if started:
+        logger.warning(f'Последний блок записи {path} не дописан и пропущен')
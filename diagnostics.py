@@ -0,0 +1,278 @@
+"""
+Диагностика работающего процесса: память, CPU и потоки.
+
+Все инструменты включаются только по запросу из панели управления и ничего не
+стоят, пока не используются: tracemalloc запускается явно и останавливается
+после снятия отчёта, профилировщик работает только на время замера, а размеры
+структур считаются в момент запроса.
+
+    MemoryTracer      запуск/остановка tracemalloc и разница снимков по строкам кода
+    profile           сэмплирующий профилировщик всех потоков на N секунд
+    thread_dump       стеки всех потоков
+    size_report       оценка размеров структур в памяти
+
+Результаты возвращаются текстом, который панель отдаёт как файл.
+"""
+import gc
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+import types
+from collections import Counter, deque
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+# Максимальная длительность профилирования, в секундах
+MAX_PROFILE_SECONDS = 60
+
+# Объекты этих типов не учитываются при оценке размеров: они разделяются
+# со всем процессом и не принадлежат измеряемой структуре
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType,
+                 types.BuiltinFunctionType, threading.Thread)
+
+
+def _header(title: str) -> List[str]:
+    return [title, f'Время: {datetime.now().isoformat(timespec="seconds")}', '']
+
+
+def _format_bytes(size: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+
+# Память
+
+class MemoryTracer:
+    """Управляет tracemalloc: запуск с базовым снимком, разница с ним и остановка."""
+
+    def __init__(self):
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        # Аллокации самого tracemalloc и импорта модулей только мешают
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+
+    @property
+    def is_tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1) -> None:
+        """Запускает трассировку аллокаций и запоминает базовый снимок."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._baseline = self._snapshot()
+
+    def stop(self) -> None:
+        """Останавливает трассировку и освобождает её память."""
+        with self._lock:
+            self._baseline = None
+            tracemalloc.stop()
+
+    def diff(self, limit: int = 30) -> str:
+        """
+        Сравнивает текущий снимок с базовым.
+
+        Returns:
+            str: Отчёт с приростом памяти и крупнейшими аллокаторами по строкам кода
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing() or self._baseline is None:
+                raise RuntimeError('Трассировка памяти не запущена')
+            snapshot = self._snapshot()
+            baseline = self._baseline
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = _header('Трассировка памяти (tracemalloc)')
+        lines.append(f'Отслеживается сейчас: {_format_bytes(current)}, пик: {_format_bytes(peak)}')
+        lines.append('')
+
+        lines.append(f'Прирост с момента запуска, топ {limit} строк:')
+        for stat in snapshot.compare_to(baseline, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f'{_format_bytes(stat.size_diff):>12} {stat.count_diff:+9d} блоков  '
+                         f'{frame.filename}:{frame.lineno}')
+        lines.append('')
+
+        lines.append(f'Крупнейшие аллокаторы, топ {limit} строк:')
+        for stat in snapshot.statistics('lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f'{_format_bytes(stat.size):>12} {stat.count:9d} блоков  '
+                         f'{frame.filename}:{frame.lineno}')
+        return '\n'.join(lines) + '\n'
+
+
+# CPU
+
+def _thread_names() -> Dict[int, str]:
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def _stack(frame: types.FrameType) -> Tuple[Tuple[str, int, str], ...]:
+    """Стек кадра от корня к листу в виде (файл, строка, функция)."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def profile(seconds: float, interval: float = 0.005, limit: int = 30) -> str:
+    """
+    Сэмплирующий профилировщик: каждые interval секунд снимает стеки всех
+    потоков, кроме вызывающего.
+
+    Отчёт содержит число выборок по потокам, самые частые функции (собственное
+    и общее время) и свёрнутые стеки в формате flamegraph.pl.
+    """
+    seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+    own_ident = threading.get_ident()
+    stacks: Counter = Counter()
+    samples = 0
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = _thread_names()
+        for ident, frame in sys._current_frames().items():
+            if ident != own_ident:
+                stacks[(names.get(ident, str(ident)), _stack(frame))] += 1
+        samples += 1
+        time.sleep(interval)
+
+    by_thread: Counter = Counter()
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for (thread_name, stack), count in stacks.items():
+        by_thread[thread_name] += count
+        if stack:
+            own[stack[-1]] += count
+        for entry in set(stack):
+            total[entry] += count
+
+    def describe(entry: Tuple[str, int, str]) -> str:
+        return f'{entry[2]} ({entry[0]}:{entry[1]})'
+
+    lines = _header(f'Профиль CPU за {seconds:g} с, выборок: {samples}, интервал: {interval * 1000:g} мс')
+    lines.append('Выборки по потокам:')
+    for thread_name, count in by_thread.most_common():
+        lines.append(f'{count:8d}  {thread_name}')
+    lines.append('')
+
+    lines.append(f'Собственное время, топ {limit}:')
+    for entry, count in own.most_common(limit):
+        lines.append(f'{count:8d}  {describe(entry)}')
+    lines.append('')
+
+    lines.append(f'Общее время, топ {limit}:')
+    for entry, count in total.most_common(limit):
+        lines.append(f'{count:8d}  {describe(entry)}')
+    lines.append('')
+
+    lines.append('Свёрнутые стеки (flamegraph.pl):')
+    for (thread_name, stack), count in stacks.most_common():
+        frames = ';'.join(f'{name} ({filename.rsplit("/", 1)[-1]}:{lineno})' for filename, lineno, name in stack)
+        lines.append(f'{thread_name};{frames} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def thread_dump() -> str:
+    """Возвращает текущие стеки всех потоков процесса."""
+    names = _thread_names()
+    daemons = {thread.ident: thread.daemon for thread in threading.enumerate()}
+
+    lines = _header(f'Стеки потоков, всего: {len(names)}')
+    for ident, frame in sys._current_frames().items():
+        kind = 'daemon' if daemons.get(ident) else 'thread'
+        lines.append(f'--- {names.get(ident, "?")} ({kind}, ident={ident}) ---')
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+
+# Размеры структур
+
+def deep_sizeof(obj: Any, exclude: Tuple[type, ...] = ()) -> int:
+    """
+    Оценивает размер объекта вместе со всем, на что он ссылается.
+
+    Каждый объект учитывается один раз; функции, классы, модули, потоки и
+    объекты типов из exclude не учитываются.
+    """
+    skip = _SHARED_TYPES + exclude
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or isinstance(item, skip):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item, 0)
+
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            pending.extend(item)
+        elif isinstance(item, (str, bytes, bytearray, int, float, bool)) or item is None:
+            continue
+        else:
+            pending.extend(gc.get_referents(item))
+    return size
+
+
+def estimate_mapping_size(mapping: Any, sample: int = 1000) -> Tuple[int, int]:
+    """
+    Оценивает размер записей большого словаря по выборке первых sample записей.
+
+    Returns:
+        Количество записей и оценка их суммарного размера в байтах
+    """
+    count = len(mapping)
+    measured = 0
+    sampled = 0
+    for key in mapping:
+        measured += deep_sizeof(key) + deep_sizeof(mapping[key])
+        sampled += 1
+        if sampled >= sample:
+            break
+    return count, int(measured / sampled * count) if sampled else 0
+
+
+def size_report(structures: Dict[str, Any], mappings: Dict[str, Any], exclude: Tuple[type, ...] = ()) -> str:
+    """
+    Отчёт о размерах структур.
+
+    Args:
+        structures: Структуры, размер которых считается полностью
+        mappings: Большие словари, размер которых оценивается по выборке
+        exclude: Типы объектов, которые не учитываются
+    """
+    lines = _header('Размеры структур в памяти (оценка)')
+
+    for name, mapping in mappings.items():
+        count, size = estimate_mapping_size(mapping)
+        lines.append(f'{_format_bytes(size):>12}  {name} (записей: {count}, оценка по выборке)')
+
+    for name, obj in structures.items():
+        size = deep_sizeof(obj, exclude)
+        length = f' (элементов: {len(obj)})' if hasattr(obj, '__len__') else ''
+        lines.append(f'{_format_bytes(size):>12}  {name}{length}')
+
+    lines.append('')
+    lines.append(f'Объектов под наблюдением сборщика мусора: {len(gc.get_objects())}')
+    lines.append(f'Счётчики поколений gc: {gc.get_count()}')
+    return '\n'.join(lines) + '\n'
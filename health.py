@@ -0,0 +1,90 @@
+"""
+Проверка готовности экземпляра бота для оркестратора (/healthz).
+
+Проверка должна быть дешёвой, чтобы её можно было вызывать каждую секунду:
+все показатели собираются заранее (время последнего ответа getUpdates,
+длительность последнего сохранения и т.п.), а здесь только сравниваются
+с порогами. Сетевых запросов и обхода пользователей проверка не делает.
+
+Задержка планирования измеряется фоновым потоком LagMonitor: он засыпает на
+фиксированный интервал и замеряет, насколько позже заданного времени проснулся.
+Большая задержка означает, что процесс перегружен (GIL занят обработчиками,
+не хватает CPU или идёт долгая сборка мусора).
+"""
+import os
+import threading
+import time
+from typing import Dict, Any, List, Optional
+
+
+class LagMonitor:
+    """Фоновый замер задержки планирования потоков процесса."""
+
+    def __init__(self, interval: float = 0.5, window: int = 20):
+        self.interval = interval
+        self.window = window
+        # Задержки последних замеров, секунды
+        self._samples: List[float] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            time.sleep(self.interval)
+            lag = max(time.monotonic() - expected, 0.0)
+            with self._lock:
+                self._samples.append(lag)
+                if len(self._samples) > self.window:
+                    del self._samples[0]
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='lag-monitor', daemon=True)
+            self._thread.start()
+
+    def current(self) -> Optional[float]:
+        """Задержка последнего замера или None, если замеров ещё не было."""
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def maximum(self) -> Optional[float]:
+        """Максимальная задержка за последние window замеров."""
+        with self._lock:
+            return max(self._samples) if self._samples else None
+
+
+def load_thresholds(long_polling_timeout: int) -> Dict[str, float]:
+    """Пороги проверки из переменных окружения."""
+    return {
+        # Ответ getUpdates приходит не реже, чем раз в long_polling_timeout
+        'poll_age': float(os.getenv('HEALTH_MAX_POLL_AGE', long_polling_timeout + 30)),
+        'queue_depth': float(os.getenv('HEALTH_MAX_QUEUE_DEPTH', 1000)),
+        'loop_lag': float(os.getenv('HEALTH_MAX_LOOP_LAG', 1.0)),
+        # Сохранение выполняется раз в минуту; допускаем несколько пропусков
+        'save_age': float(os.getenv('HEALTH_MAX_SAVE_AGE', 300)),
+        # Время с последнего ответа процесса-обработчика (при работе в нескольких процессах)
+        'shard_heartbeat_age': float(os.getenv('HEALTH_MAX_SHARD_HEARTBEAT_AGE', 15)),
+    }
+
+
+def evaluate(metrics: Dict[str, Any], thresholds: Dict[str, float]) -> List[str]:
+    """
+    Сравнивает показатели с порогами; показатели без порога не проверяются.
+
+    Показатель без значения (None) считается нарушением: например, замеров
+    задержки ещё не было.
+
+    Returns:
+        Список описаний нарушенных порогов; пустой, если экземпляр здоров
+    """
+    failures = []
+    for name, value in metrics.items():
+        limit = thresholds.get(name)
+        if limit is None:
+            continue
+        if value is None:
+            failures.append(f'{name}: нет данных')
+        elif value > limit:
+            failures.append(f'{name}: {value} > {limit}')
+    return failures
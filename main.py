@@ -1,25 +1,58 @@
+import asyncio
+import functools
+import hashlib
+import hmac
+import itertools
 import json
 import logging
 import os
+import threading
 import time
-from datetime import datetime
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from dataclasses import replace
+from typing import Dict, Any, Callable, Iterator, Optional, Tuple
 
 import aiohttp
+import requests
 import telebot
 from dotenv import load_dotenv
-from flask import Flask, request, render_template_string, redirect, Response
-from telebot import types
+from aiohttp import web
+from flask import Flask, request, render_template, redirect, Response, abort, g
+from markupsafe import Markup
+from telebot import apihelper
+from werkzeug.local import LocalProxy
+
+import diagnostics
+from analytics import EventStore, FUNNEL_STEPS
+from assets import Asset, AssetCatalog, load_assets
+from admin_server import AsyncAdminServer
+from capture import UpdateRecorder
+from health import LagMonitor, evaluate, load_thresholds
+from outbox import Outbox
+from polling import PollingEngine, WorkerPool
+from scheduler import OutboundLimiter, PostScheduler, SEND_METHOD_PREFIXES
+from settings import SettingsManager, format_description
+from sharding import LeaderLock, ShardRouter, ShardServer, derive_authkey, import_shard, socket_path
+from structured_logging import setup_logging, parse_sample_rates
+from tracing import Tracer, TracingAdapter, span
+from tenants import Tenant, TenantConfig, TenantRegistry, load_tenant_configs, tenant_context
+from user_store import UserStore
+from warmup import WarmUp, SkipStep
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+# Загрузка переменных окружения
+load_dotenv()
+
+# Настройка логирования: вывод идёт из фонового потока, частые события можно прореживать
+logging_state = setup_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    json_format=os.getenv('LOG_FORMAT', 'text').lower() == 'json',
+    sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE_RATES')),
 )
 logger = logging.getLogger(__name__)
 
-# Загрузка переменных окружения
-load_dotenv()
+# Уровни логирования, доступные в панели управления
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
 
 # Настройки и константы из переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -37,92 +70,225 @@ CHANNEL_LINK = os.getenv('CHANNEL_LINK', 'https://t.me/uyutnie_metry')
 CHANNEL_BUTTON_TEXT = os.getenv('CHANNEL_BUTTON_TEXT', 'ЗАБРАТЬ ПОДАРОК')
 
 # Преобразование описания с звездочками в HTML теги
-CHANNEL_POST_DESCRIPTION = (CHANNEL_POST_DESCRIPTION
-                            .replace('<br>', '\n')
-                            .replace('<br/>', '\n')
-                            .replace('<br />', '\n'))
-CHANNEL_POST_DESCRIPTION = ''.join(f'<b>{part}</b>' if i % 2 else part
-                                   for i, part in enumerate(CHANNEL_POST_DESCRIPTION.split('*')))
+CHANNEL_POST_DESCRIPTION = format_description(CHANNEL_POST_DESCRIPTION)
 
-# Создаем экземпляр бота
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
+# Количество потоков обработки обновлений (общих для всех ботов процесса)
+POLLING_WORKERS = int(os.getenv('POLLING_WORKERS', 8))
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 50))
 
-# Хранилище для отслеживания пользователей
-users: Dict[int, Dict[str, Any]] = {}
 
 # Настройки сообщений
-CONFIG = {
-    'channel_name': CHANNEL_ID.replace('@', ''),
-    'channel_username': CHANNEL_ID,
+def build_config(channel_id: str) -> Dict[str, str]:
+    return {
+        'channel_name': channel_id.replace('@', ''),
+        'channel_username': channel_id,
+
+        # Сообщения
+        # 'welcome_message': f'Привет! Подпишитесь на канал {channel_id} и нажмите кнопку, чтобы получить чек-лист.',
+        'subscription_request': f'Чтобы получить чек-лист подготовки к ремонту, подпишитесь на канал {channel_id} и нажмите /check для проверки подписки.',
+        'pdf_message': 'Спасибо за подписку на канал! 🎁\n\nВот Ваш чек-лист для подготовки к ремонту:',
+        'pdf_message_repeat': 'Вот Ваш чек-лист для подготовки к ремонту:',
 
-    # Сообщения
-    # 'welcome_message': f'Привет! Подпишитесь на канал {CHANNEL_ID} и нажмите кнопку, чтобы получить чек-лист.',
-    'subscription_request': f'Чтобы получить чек-лист подготовки к ремонту, подпишитесь на канал {CHANNEL_ID} и нажмите /check для проверки подписки.',
-    'pdf_message': 'Спасибо за подписку на канал! 🎁\n\nВот Ваш чек-лист для подготовки к ремонту:',
-    'pdf_message_repeat': 'Вот Ваш чек-лист для подготовки к ремонту:',
+        # Кнопки
+        'checklist_button_text': 'Получить чек-лист',
+    }
 
-    # Кнопки
-    'checklist_button_text': 'Получить чек-лист',
-}
 
 # Настройка путей к данным
 DATA_DIR = os.path.join(os.getcwd(), '.data')
-USERS_FILE = os.path.join(DATA_DIR, 'users.json')
+
+# Бот из переменных окружения. Значения из переменных окружения используются,
+# пока настройки не изменены в панели управления.
+DEFAULT_TENANT = TenantConfig(
+    name=os.getenv('TENANT_NAME', 'default'),
+    bot_token=BOT_TOKEN,
+    channel_id=CHANNEL_ID,
+    bot_username=BOT_USERNAME,
+    data_dir=DATA_DIR,
+    pdf_file_id=PDF_FILE_ID,
+    assets_file=os.getenv('ASSETS_FILE'),
+    settings={
+        'bonus_pdf_url': BONUS_PDF_URL,
+        'image_url': IMAGE_URL,
+        'channel_post_title': CHANNEL_POST_TITLE,
+        'channel_post_description': CHANNEL_POST_DESCRIPTION,
+        'channel_post_call': CHANNEL_POST_CALL,
+        'channel_link': CHANNEL_LINK,
+        'channel_button_text': CHANNEL_BUTTON_TEXT,
+    },
+)
+
+# Несколько ботов в одном процессе (см. tenants.py); без TENANTS_FILE — один бот
+TENANTS_FILE = os.getenv('TENANTS_FILE')
+
+# Работа в нескольких процессах (см. sharding.py): приёмник обновлений и
+# SHARD_COUNT обработчиков; без SHARD_COUNT — один процесс, как раньше
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+SHARD_ROLE = os.getenv('SHARD_ROLE', 'ingress') if SHARD_COUNT else None
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))
+SHARDS_DIR = os.path.join(DATA_DIR, 'shards')
+SHARD_AUTHKEY = derive_authkey(os.getenv('SHARD_SECRET') or BOT_TOKEN or '')
+
+if SHARD_COUNT and TENANTS_FILE:
+    raise ValueError('Работа в нескольких процессах поддерживается только для одного бота (без TENANTS_FILE)')
+if SHARD_ROLE == 'worker':
+    # Обработчик хранит свою долю пользователей, а настройки у всех процессов общие
+    DEFAULT_TENANT = replace(DEFAULT_TENANT, data_dir=os.path.join(SHARDS_DIR, str(SHARD_INDEX)),
+                             settings_file=os.path.join(DATA_DIR, 'settings.json'))
+
+# Журнал событий для воронок и когорт (см. analytics.py): сколько дней хранить
+# сырые журналы; свёрнутые по дням данные хранятся без ограничения
+ANALYTICS_RAW_RETENTION_DAYS = int(os.getenv('ANALYTICS_RAW_RETENTION_DAYS', 30))
+
+tenant_configs = load_tenant_configs(TENANTS_FILE, DEFAULT_TENANT) if TENANTS_FILE else [DEFAULT_TENANT]
+
+# Предел отправки сообщений каждым ботом, сообщений в секунду; общий для всех ботов
+# процесса и всех источников отправки (обработчики, фоновые проверки, рассылки)
+BOT_SEND_RATE = float(os.getenv('BOT_SEND_RATE', 30))
+outbound_limiter = OutboundLimiter(BOT_SEND_RATE)
+
+
+class BotApiAdapter(TracingAdapter):
+    """Адаптер общего пула соединений: трассировка запросов и общий предел отправки сообщений."""
+
+    def send(self, request, *args, **kwargs):
+        # Путь запроса к Bot API: /bot<токен>/<метод>
+        path = request.path_url.split('?', 1)[0]
+        bot_key = method = None
+        if path.startswith('/bot'):
+            bot_key, _, method = path[4:].partition('/')
+        if method and method.startswith(SEND_METHOD_PREFIXES):
+            with span('outbound_limit'):
+                outbound_limiter.acquire(bot_key)
+        response = super().send(request, *args, **kwargs)
+        if bot_key and response.status_code == 429:
+            try:
+                seconds = response.json().get('parameters', {}).get('retry_after')
+            except ValueError:
+                seconds = None
+            if seconds:
+                outbound_limiter.pause(bot_key, seconds)
+        return response
+
+
+# Общий пул соединений с Bot API для всех потоков и ботов: соединения открываются
+# при прогреве и переиспользуются обработчиками (по одному держит long polling
+# каждого бота, запас — для панели управления)
+api_session = requests.Session()
+api_adapter = BotApiAdapter(pool_connections=2, pool_maxsize=POLLING_WORKERS + len(tenant_configs) + 4)
+api_session.mount('https://', api_adapter)
+api_session.mount('http://', api_adapter)
+apihelper.session = api_session
+
+# Общий пул потоков обработки обновлений всех ботов
+worker_pool = WorkerPool(POLLING_WORKERS)
+
+# Трассировка обработки обновлений (см. tracing.py): доля трассируемых обновлений,
+# порог медленной обработки в секундах, размер буфера медленных и файл для их записи
+tracer = Tracer(
+    sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', 0.05)),
+    slow_threshold=float(os.getenv('TRACE_SLOW_THRESHOLD', 5)),
+    buffer_size=int(os.getenv('TRACE_BUFFER_SIZE', 100)),
+    export_file=os.getenv('TRACE_EXPORT_FILE') or None,
+)
+
+
+def create_tenant(config: TenantConfig) -> Tenant:
+    """Создаёт бота: экземпляр TeleBot, настройки, хранилище пользователей и опрос обновлений."""
+    # Обновления раздаёт PollingEngine по своим потокам,
+    # поэтому собственный пул потоков telebot не нужен.
+    tenant_bot = telebot.TeleBot(config.bot_token, parse_mode='HTML', threaded=False)
+
+    # Текущий снимок настроек с готовыми текстами и клавиатурами
+    tenant_settings = SettingsManager(
+        config.settings_file or os.path.join(config.data_dir, 'settings.json'),
+        defaults=config.settings,
+        config=build_config(config.channel_id),
+        channel_id=config.channel_id,
+        bot_username=config.bot_username,
+    )
+
+    # Хранилище для отслеживания пользователей
+    tenant_users = UserStore(os.path.join(config.data_dir, 'users.bin'),
+                             os.path.join(config.data_dir, 'users.json'))
+
+    tenant = Tenant(config, tenant_bot, tenant_settings, tenant_users)
+
+    # Каталог материалов: таблица выбора по payload строится при загрузке, файлы готовятся при прогреве
+    if config.assets_file:
+        tenant.catalog = AssetCatalog(load_assets(config.assets_file, config.channel_id),
+                                      os.path.join(config.data_dir, 'assets_state.json'))
+
+    # Журнал событий: обработчики только ставят событие в очередь, на диск его пишет фоновый поток
+    tenant.analytics = EventStore(os.path.join(config.data_dir, 'events'), raw_retention_days=ANALYTICS_RAW_RETENTION_DAYS)
+
+    # Журнал доставок: отправка файла подписчику повторяется после падения процесса
+    tenant.outbox = Outbox(os.path.join(config.data_dir, 'outbox.log'))
+
+    # Получение обновлений: long polling пачками с параллельной обработкой по чатам
+    tenant.polling_engine = PollingEngine(
+        tenant_bot,
+        os.path.join(config.data_dir, 'polling_offset.json'),
+        long_polling_timeout=POLLING_TIMEOUT,
+        pool=worker_pool,
+        name=config.name if len(tenant_configs) > 1 else None,
+        context={tenant_context: tenant},
+    )
+    tenant.polling_engine.tracer = tracer
+    return tenant
+
+
+tenants = TenantRegistry()
+for tenant_config in tenant_configs:
+    tenants.add(create_tenant(tenant_config))
+
+# Объекты текущего бота: в обработчиках — бота, получившего обновление,
+# в панели управления — выбранного бота, в остальных местах — бота по умолчанию
+bot: telebot.TeleBot = LocalProxy(lambda: tenants.current().bot)
+bot_settings: SettingsManager = LocalProxy(lambda: tenants.current().settings)
+users: UserStore = LocalProxy(lambda: tenants.current().users)
+polling_engine: PollingEngine = LocalProxy(lambda: tenants.current().polling_engine)
+analytics: EventStore = LocalProxy(lambda: tenants.current().analytics)
+outbox: Outbox = LocalProxy(lambda: tenants.current().outbox)
+
+# Приёмник раздаёт обновления обработчикам и собирает с них данные для панели
+shard_router = ShardRouter(SHARDS_DIR, SHARD_COUNT, SHARD_AUTHKEY) if SHARD_ROLE == 'ingress' else None
 
 
 # Функции для работы с хранилищем пользователей
+# Время запуска процесса и результат последнего сохранения текущего бота (time.monotonic) для /healthz
+STARTED_AT = time.monotonic()
+_save_state: Dict[str, Any] = LocalProxy(lambda: tenants.current().save_state)
+
+
 def save_users() -> None:
-    """Сохраняет данные пользователей в файл."""
+    """Сохраняет данные пользователей в бинарный снимок (на приёмнике — на всех обработчиках)."""
+    started = time.monotonic()
     try:
-        # Создаем директорию, если её нет
-        if not os.path.exists(DATA_DIR):
-            os.makedirs(DATA_DIR)
-
-        # Преобразуем datetime объекты в строки для сериализации
-        serializable_users = {}
-        for user_id, user_data in users.items():
-            serializable_user = user_data.copy()
-            if 'last_activity' in serializable_user and isinstance(serializable_user['last_activity'], datetime):
-                serializable_user['last_activity'] = serializable_user['last_activity'].isoformat()
-            if 'last_checked' in serializable_user and isinstance(serializable_user['last_checked'], datetime):
-                serializable_user['last_checked'] = serializable_user['last_checked'].isoformat()
-            serializable_users[str(user_id)] = serializable_user
-
-        # Сохраняем данные пользователей в файл
-        with open(USERS_FILE, 'w', encoding='utf-8') as file:
-            json.dump(serializable_users, file, ensure_ascii=False, indent=2)
-
-        logger.info(f'Данные пользователей сохранены, всего: {len(users)}')
+        if shard_router is not None:
+            user_count = sum(shard_router.call_all('save'))
+        else:
+            users.save()
+            user_count = len(users)
+        _save_state['succeeded_at'] = time.monotonic()
+        _save_state['duration'] = _save_state['succeeded_at'] - started
+        _save_state['error'] = None
+        logger.info(f'Данные пользователей сохранены, всего: {user_count}')
     except Exception as e:
+        _save_state['error'] = str(e)
         logger.error(f'Ошибка сохранения данных пользователей: {e}')
 
 
 def load_users() -> None:
-    """Загружает данные пользователей из файла."""
-    global users
+    """
+    Запускает фоновую загрузку данных пользователей.
+
+    Бот может обрабатывать сообщения сразу: пользователи, которые ещё не
+    загружены, ищутся по индексу снимка. Старый users.json автоматически
+    конвертируется в снимок.
+    """
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r', encoding='utf-8') as file:
-                loaded_users = json.load(file)
-
-            # Преобразуем строковые ключи обратно в целые числа и обрабатываем даты
-            for user_id_str, user_data in loaded_users.items():
-                user_id = int(user_id_str)
-                if 'last_activity' in user_data and isinstance(user_data['last_activity'], str):
-                    try:
-                        user_data['last_activity'] = datetime.fromisoformat(user_data['last_activity'])
-                    except ValueError:
-                        user_data['last_activity'] = datetime.now()
-                if 'last_checked' in user_data and isinstance(user_data['last_checked'], str):
-                    try:
-                        user_data['last_checked'] = datetime.fromisoformat(user_data['last_checked'])
-                    except ValueError:
-                        user_data['last_checked'] = datetime.now()
-                users[user_id] = user_data
-
-            logger.info(f'Загружены данные {len(users)} пользователей')
-        else:
-            logger.info('Файл с данными пользователей не найден, создаем новый')
+        users.start_loading()
     except Exception as e:
         logger.error(f'Ошибка загрузки данных пользователей: {e}')
 
@@ -130,26 +296,40 @@ def load_users() -> None:
 # Функция для отправки приветствия с кнопкой
 def send_welcome_with_button(chat_id: int) -> None:
     """Отправляет приветственное сообщение с кнопкой для получения чек-листа."""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton(CONFIG.get('checklist_button_text', 'Получить чек-лист')))
+    settings = bot_settings.current
+    bot.send_message(chat_id, settings.welcome_message, reply_markup=settings.checklist_keyboard)
+
+
+def user_asset(user_id: int) -> Optional[Asset]:
+    """Материал, который пользователь запросил по ссылке /start; None, если каталог не задан."""
+    catalog = tenants.current().catalog
+    if catalog is None:
+        return None
+    return catalog.get((users.get(user_id) or {}).get('asset')) or catalog.default
 
-    # Используем значение по умолчанию, если ключа нет в CONFIG
-    welcome_message = CONFIG.get('welcome_message',
-                                 f'Привет! Подпишитесь на канал {CHANNEL_ID} и нажмите кнопку, чтобы получить чек-лист.')
 
-    bot.send_message(chat_id, welcome_message, reply_markup=keyboard)
+def subscription_channel(user_id: int) -> str:
+    """Канал, подписка на который нужна пользователю для получения материала."""
+    asset = user_asset(user_id)
+    return asset.channel_id if asset is not None else tenants.current().channel_id
 
 
 # Функция отправки запроса на подписку
-def send_subscription_request(chat_id: int) -> None:
+def send_subscription_request(chat_id: int, user_id: Optional[int] = None) -> None:
     """Отправляет запрос на подписку на канал."""
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(types.InlineKeyboardButton(
-        text="Перейти в канал",
-        url=f"https://t.me/{CONFIG['channel_username'].replace('@', '')}"
-    ))
+    asset = user_asset(user_id) if user_id is not None else None
+    if asset is not None:
+        bot.send_message(chat_id, asset.subscription_message, reply_markup=asset.subscription_keyboard)
+        return
 
-    bot.send_message(chat_id, CONFIG['subscription_request'], reply_markup=keyboard)
+    settings = bot_settings.current
+    bot.send_message(chat_id, settings.subscription_request, reply_markup=settings.subscription_keyboard)
+
+
+async def traced_sleep(seconds: float) -> None:
+    """Пауза, видимая в трассировке обновления."""
+    with span('sleep', seconds=seconds):
+        await asyncio.sleep(seconds)
 
 
 # Улучшенная функция проверки подписки на канал
@@ -169,39 +349,38 @@ async def check_subscription(user_id: int) -> bool:
     for attempt in range(max_attempts):
         try:
             # Небольшая задержка перед запросом для надежности
-            await asyncio.sleep(0.5)
+            await traced_sleep(0.5)
 
             # Проверка подписки через API бота
-            chat_member = bot.get_chat_member(CHANNEL_ID, user_id)
+            with span('subscription_attempt', attempt=attempt + 1):
+                chat_member = bot.get_chat_member(subscription_channel(user_id), user_id)
             status = chat_member.status
 
             # Проверяем статус подписки
             # Только member, administrator и creator считаются подписанными
             is_subscribed = status in ['member', 'administrator', 'creator']
 
-            logger.info(f'Попытка {attempt + 1}: Статус подписки пользователя {user_id}: {status} ({is_subscribed})')
+            logger.info('Попытка %s: Статус подписки пользователя %s: %s (%s)', attempt + 1, user_id, status, is_subscribed,
+                        extra={'event': 'subscription_check', 'user_id': user_id})
 
             # Если пользователь подписан, обновляем статус и возвращаем результат
             if is_subscribed:
                 # Обновляем статус в хранилище
-                if user_id in users:
-                    users[user_id]['is_subscribed'] = True
-                    users[user_id]['last_checked'] = datetime.now()
+                users.update_user(user_id, is_subscribed=True, last_checked=datetime.now())
+                analytics.record('subscribed', user_id)
                 return True
 
             # Если не подписан и это не последняя попытка, ждем немного
             if attempt < max_attempts - 1:
-                await asyncio.sleep(1)
+                await traced_sleep(1)
 
         except Exception as e:
             logger.error(f'Ошибка при проверке подписки (попытка {attempt + 1}): {e}')
             if attempt < max_attempts - 1:
-                await asyncio.sleep(1)
+                await traced_sleep(1)
 
     # Если после всех попыток пользователь не подписан
-    if user_id in users:
-        users[user_id]['is_subscribed'] = False
-        users[user_id]['last_checked'] = datetime.now()
+    users.update_user(user_id, is_subscribed=False, last_checked=datetime.now())
 
     return False
 
@@ -217,7 +396,8 @@ def check_subscription_sync(user_id: int) -> bool:
         asyncio.set_event_loop(loop)
 
         # Выполняем асинхронную функцию в цикле событий
-        result = loop.run_until_complete(check_subscription(user_id))
+        with span('check_subscription'):
+            result = loop.run_until_complete(check_subscription(user_id))
 
         # Закрываем цикл событий
         loop.close()
@@ -228,6 +408,78 @@ def check_subscription_sync(user_id: int) -> bool:
         return False
 
 
+# Время жизни кэша скачанного PDF, в секундах. Вместе с содержимым хранится
+# file_id уже загруженного в Telegram файла: по нему PDF отправляется без повторной загрузки
+PDF_CACHE_TTL = int(os.getenv('PDF_CACHE_TTL', 3600))
+_pdf_cache: Dict[str, Any] = LocalProxy(lambda: tenants.current().pdf_cache)
+
+
+async def fetch_url(url: str) -> tuple:
+    """
+    Скачивает файл по URL.
+
+    Returns:
+        tuple: HTTP-статус, Content-Type и содержимое
+    """
+    # С асинхронным сервером панели файл скачивается через его общую сессию
+    if admin_server is not None and admin_server.running:
+        with span('download', shared_session=True):
+            return await asyncio.wrap_future(admin_server.submit(admin_server.fetch(url)))
+
+    with span('download'):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url, timeout=30) as response:
+                return response.status, response.headers.get('Content-Type', ''), await response.read()
+
+
+async def get_pdf_content(url: str) -> bytes:
+    """
+    Возвращает содержимое PDF по URL, закэшированное на PDF_CACHE_TTL секунд.
+
+    Кэш сбрасывается при смене URL в настройках; file_id сбрасывается,
+    если файл по URL изменился.
+    """
+    now = time.monotonic()
+    if (_pdf_cache['url'] == url and _pdf_cache['content'] is not None
+            and now - _pdf_cache['fetched_at'] <= PDF_CACHE_TTL):
+        return _pdf_cache['content']
+
+    # Скачиваем файл с увеличенным таймаутом
+    status, _, file_content = await fetch_url(url)
+    if status != 200:
+        raise Exception(f"Ошибка при скачивании PDF: статус {status}")
+
+    # Проверяем, что файл не пустой
+    if len(file_content) <= 0:
+        raise Exception("Получен пустой файл")
+
+    # Проверяем заголовок файла PDF (байты %PDF)
+    if not file_content.startswith(b'%PDF'):
+        logger.warning('Полученный файл может быть не PDF форматом')
+
+    file_id = _pdf_cache['file_id']
+    if _pdf_cache['url'] != url or (_pdf_cache['content'] is not None and _pdf_cache['content'] != file_content):
+        file_id = None
+    _pdf_cache.update(url=url, content=file_content, fetched_at=time.monotonic(), file_id=file_id)
+    return file_content
+
+
+def get_pdf_file_id(url: str):
+    """Возвращает file_id загруженного PDF, если он соответствует URL и кэш свежий."""
+    if _pdf_cache['url'] != url or not _pdf_cache['file_id']:
+        return None
+    # file_id из PDF_FILE_ID используется до первой проверки файла по URL
+    if _pdf_cache['content'] is not None and time.monotonic() - _pdf_cache['fetched_at'] > PDF_CACHE_TTL:
+        return None
+    return _pdf_cache['file_id']
+
+
+def remember_pdf_file_id(url: str, message: telebot.types.Message) -> None:
+    """Запоминает file_id PDF из отправленного сообщения."""
+    if _pdf_cache['url'] == url and message is not None and message.document is not None:
+        _pdf_cache['file_id'] = message.document.file_id
+
+
 # Функция для отправки PDF документа
 async def send_pdf_document(chat_id: int, user_id: int) -> bool:
     """
@@ -240,83 +492,80 @@ async def send_pdf_document(chat_id: int, user_id: int) -> bool:
     Returns:
         bool: True если документ был успешно отправлен, иначе False
     """
+    # Берём снимок настроек один раз, чтобы вся отправка шла по одной версии
+    settings = bot_settings.current
+
     try:
         # Проверяем, отправляли ли уже PDF этому пользователю
         already_sent = users.get(user_id, {}).get('pdf_sent', False)
 
         # Отмечаем, что PDF был отправлен
-        if user_id in users:
-            users[user_id]['pdf_sent'] = True
+        users.update_user(user_id, pdf_sent=True)
 
         # Отправляем разные сообщения для первой и повторной отправки
-        message_text = CONFIG['pdf_message_repeat'] if already_sent else CONFIG['pdf_message']
+        message_text = settings.pdf_message_repeat if already_sent else settings.pdf_message
 
         # Отправляем сообщение перед PDF
         bot.send_message(chat_id, message_text)
 
+        file_id = None
         try:
-            # Скачиваем PDF с указанного URL
-            logger.info(f'Отправка PDF пользователю {user_id}')
+            # Скачиваем PDF с указанного URL (или берём из кэша)
+            logger.info('Отправка PDF пользователю %s', user_id, extra={'event': 'pdf_sending', 'user_id': user_id})
 
             # Имя файла для отправки
             file_name = 'Чек-лист.pdf'
 
-            # Скачиваем файл с увеличенным таймаутом
-            async with aiohttp.ClientSession() as session:
-                async with session.get(BONUS_PDF_URL, timeout=30) as response:
-                    if response.status != 200:
-                        raise Exception(f"Ошибка при скачивании PDF: статус {response.status}")
-
-                    # Читаем файл в байтовый объект
-                    file_content = await response.read()
-
-                    # Проверяем, что файл не пустой
-                    if len(file_content) <= 0:
-                        raise Exception("Получен пустой файл")
-
-                    # Проверяем заголовок файла PDF (байты %PDF)
-                    if len(file_content) >= 4 and not (
-                            file_content[0] == 0x25 and  # %
-                            file_content[1] == 0x50 and  # P
-                            file_content[2] == 0x44 and  # D
-                            file_content[3] == 0x46):  # F
-                        logger.warning('Полученный файл может быть не PDF форматом')
+            file_id = get_pdf_file_id(settings.bonus_pdf_url)
+            if file_id:
+                # Файл уже загружен в Telegram: отправляем по file_id
+                bot.send_document(chat_id, file_id, caption=settings.pdf_caption)
+            else:
+                file_content = await get_pdf_content(settings.bonus_pdf_url)
 
-                    # Отправляем файл напрямую как документ
-                    bot.send_document(
-                        chat_id,
-                        (file_name, file_content),
-                        caption='Чек-лист подготовки к ремонту'
-                    )
+                # Отправляем файл напрямую как документ
+                message = bot.send_document(
+                    chat_id,
+                    (file_name, file_content),
+                    caption=settings.pdf_caption
+                )
+                remember_pdf_file_id(settings.bonus_pdf_url, message)
 
-            logger.info(f'PDF успешно отправлен пользователю {user_id}')
+            logger.info('PDF успешно отправлен пользователю %s', user_id, extra={'event': 'pdf_sent', 'user_id': user_id})
+            analytics.record('pdf_sent', user_id)
             return True
 
         except Exception as error:
             logger.error(f'Ошибка при отправке PDF как документа: {error}')
 
+            if file_id:
+                # file_id мог стать недействительным: следующая отправка загрузит файл заново
+                _pdf_cache['file_id'] = None
+
             try:
                 # Вторая попытка - отправка файла по URL
                 logger.info('Повторная попытка отправки PDF по URL...')
 
                 # Отправляем файл по url
-                bot.send_document(
-                    chat_id,
-                    BONUS_PDF_URL,
-                    caption='Чек-лист подготовки к ремонту'
-                )
+                with span('pdf_fallback_url'):
+                    bot.send_document(
+                        chat_id,
+                        settings.bonus_pdf_url,
+                        caption=settings.pdf_caption
+                    )
 
-                logger.info(f'PDF успешно отправлен по URL пользователю {user_id}')
+                logger.info('PDF успешно отправлен по URL пользователю %s', user_id,
+                            extra={'event': 'pdf_sent_by_url', 'user_id': user_id})
+                analytics.record('pdf_sent', user_id)
+                analytics.record('delivery_fallback', user_id)
                 return True
 
             except Exception as second_error:
                 logger.error(f'Ошибка второй попытки отправки PDF: {second_error}')
 
                 # Если все попытки отправки файла не удались, отправляем ссылку
-                bot.send_message(
-                    chat_id,
-                    f'К сожалению, не удалось отправить документ. Скачайте PDF по ссылке: {BONUS_PDF_URL}'
-                )
+                bot.send_message(chat_id, settings.pdf_link_message)
+                analytics.record('delivery_fallback', user_id)
 
                 return False
 
@@ -324,26 +573,68 @@ async def send_pdf_document(chat_id: int, user_id: int) -> bool:
         logger.error(f'Критическая ошибка при отправке PDF: {error}')
 
         # Отправляем ссылку в случае ошибки
-        bot.send_message(
-            chat_id,
-            f'Произошла ошибка при отправке PDF. Скачайте его по ссылке: {BONUS_PDF_URL}'
-        )
+        bot.send_message(chat_id, settings.pdf_error_message)
+        analytics.record('delivery_fallback', user_id)
+
+        return False
+
+
+def send_asset(chat_id: int, user_id: int, asset: Asset) -> bool:
+    """
+    Отправляет пользователю материал из каталога.
 
+    Файл уже подготовлен при прогреве: отправляется по file_id или из памяти;
+    если подготовить его не удалось, Telegram скачивает его сам по URL.
+    """
+    catalog = tenants.current().catalog
+    content, file_id = catalog.media(asset.key)
+    try:
+        if file_id:
+            try:
+                bot.send_document(chat_id, file_id, caption=asset.caption)
+            except Exception as error:
+                # file_id мог стать недействительным: отправляем файл заново
+                logger.error(f'Ошибка отправки материала {asset.key} по file_id: {error}')
+                catalog.forget_file_id(asset.key)
+                file_id = None
+        if not file_id:
+            message = bot.send_document(chat_id, (asset.file_name, content) if content is not None else asset.url,
+                                        caption=asset.caption)
+            if content is not None and message.document is not None:
+                catalog.bind(asset.key, message.document.file_id)
+
+        users.update_user(user_id, pdf_sent=True)
+        catalog.record(asset.key, 'delivered')
+        analytics.record('pdf_sent', user_id)
+        logger.info('Материал %s отправлен пользователю %s', asset.key, user_id,
+                    extra={'event': 'asset_sent', 'user_id': user_id})
+        return True
+    except Exception as error:
+        logger.error(f'Ошибка отправки материала {asset.key}: {error}')
+        catalog.record(asset.key, 'failed')
+        bot.send_message(chat_id, f'Не удалось отправить файл. Вы можете скачать «{asset.title}» по ссылке: {asset.url}')
+        analytics.record('delivery_fallback', user_id)
         return False
 
 
 # Синхронная обертка для асинхронной функции отправки PDF
 def send_pdf_document_sync(chat_id: int, user_id: int) -> bool:
-    """Синхронная обертка для отправки PDF документа."""
+    """Синхронная обертка для отправки PDF документа (или материала из каталога)."""
     import asyncio
 
+    asset = user_asset(user_id)
+    if asset is not None:
+        with span('send_asset', asset=asset.key):
+            return send_asset(chat_id, user_id, asset)
+
     try:
         # Создаем новый цикл событий
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
 
         # Выполняем асинхронную функцию в цикле событий
-        result = loop.run_until_complete(send_pdf_document(chat_id, user_id))
+        with span('send_pdf'):
+            result = loop.run_until_complete(send_pdf_document(chat_id, user_id))
 
         # Закрываем цикл событий
         loop.close()
@@ -354,6 +645,51 @@ def send_pdf_document_sync(chat_id: int, user_id: int) -> bool:
         return False
 
 
+def deliver_pdf(chat_id: int, user_id: int) -> bool:
+    """
+    Отправляет файл подписчику через журнал доставок.
+
+    Доставка записывается на диск до отправки и отмечается завершённой после неё,
+    поэтому если процесс упадёт посреди отправки, она будет повторена при запуске.
+    """
+    asset = user_asset(user_id)
+    with span('outbox_commit'):
+        entry_id = outbox.add(chat_id, user_id, asset.key if asset is not None else None)
+    delivered = send_pdf_document_sync(chat_id, user_id)
+    outbox.complete(entry_id, delivered)
+    return delivered
+
+
+def replay_outbox() -> int:
+    """Повторяет доставки, не завершённые до перезапуска; возвращает число повторённых."""
+    entries = outbox.replayable()
+    for entry in entries:
+        # Материал берётся из журнала: пользователи могли не успеть сохраниться,
+        # поэтому отсутствующая запись пользователя создаётся заново
+        if entry.get('asset'):
+            users.setdefault(entry['user_id'], {
+                'user_id': entry['user_id'],
+                'username': '',
+                'welcome_sent': True,
+                'pdf_sent': False,
+                'is_subscribed': False,
+                'last_activity': datetime.now()
+            })
+            users.update_user(entry['user_id'], asset=entry['asset'])
+        entry_id = outbox.retry(entry)
+        logger.info('Повтор доставки пользователю %s после перезапуска', entry['user_id'],
+                    extra={'event': 'delivery_replay', 'user_id': entry['user_id']})
+        try:
+            delivered = send_pdf_document_sync(entry['chat_id'], entry['user_id'])
+        except Exception as e:
+            logger.error(f"Ошибка повтора доставки пользователю {entry['user_id']}: {e}")
+            continue
+        outbox.complete(entry_id, delivered)
+    if entries:
+        logger.info(f'Повторено доставок после перезапуска: {len(entries)}')
+    return len(entries)
+
+
 # Функция для проверки подписки и отправки PDF
 def check_and_send_pdf(chat_id: int, user_id: int) -> bool:
     """
@@ -371,10 +707,10 @@ def check_and_send_pdf(chat_id: int, user_id: int) -> bool:
 
     if is_subscribed:
         # Если подписан, отправляем PDF без дополнительных инструкций
-        return send_pdf_document_sync(chat_id, user_id)
+        return deliver_pdf(chat_id, user_id)
     else:
         # Если не подписан, отправляем только запрос на подписку
-        send_subscription_request(chat_id)
+        send_subscription_request(chat_id, user_id)
         return False
 
 
@@ -387,43 +723,20 @@ async def publish_post_to_channel() -> str:
         str: Сообщение о статусе публикации
     """
     try:
-        # Проверяем наличие тегов <b> и убеждаемся, что они корректно парные
-        clean_description = CHANNEL_POST_DESCRIPTION
-
-        # Подсчитываем количество открывающих и закрывающих тегов
-        open_tags = clean_description.count('<b>')
-        close_tags = clean_description.count('</b>')
-
-        # Если количество не совпадает, используем более безопасный метод
-        if open_tags != close_tags:
-            logger.warning(f'Неравное количество тегов <b> ({open_tags}) и </b> ({close_tags}). Переформатируем.')
-            # Удаляем все существующие теги <b> и заново применяем форматирование
-            clean_description = clean_description.replace('<b>', '').replace('</b>', '')
-            clean_description = ''.join(f'<b>{part}</b>' if i % 2 else part
-                                        for i, part in enumerate(clean_description.split('*')))
-
-        # Формируем финальный текст поста
-        post_text = f"<b>{CHANNEL_POST_TITLE}</b>\n\n{clean_description}\n\n<b>{CHANNEL_POST_CALL}</b>\n\nСоздавайте уютный и функциональный дом \nвместе с <a href=\"{CHANNEL_LINK}\">Уютные метры</a>🏡"
+        settings = bot_settings.current
+        post_text = settings.post_text
 
         # Для отладки - выводим финальный текст в консоль
-        logger.info('Финальный текст поста:')
-        logger.info(post_text)
-
-        # Кнопка для поста
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.add(types.InlineKeyboardButton(
-            text=CHANNEL_BUTTON_TEXT,
-            url=f"https://t.me/{BOT_USERNAME}?start=checklist"
-        ))
+        logger.debug('Финальный текст поста:\n%s', post_text)
 
         # Проверяем, есть ли URL изображения
-        if IMAGE_URL:
+        if settings.image_url:
             # Отправляем фото с подписью и кнопкой
             bot.send_photo(
-                CHANNEL_ID,
-                IMAGE_URL,
+                tenants.current().channel_id,
+                settings.image_url,
                 caption=post_text,
-                reply_markup=keyboard,
+                reply_markup=settings.post_keyboard,
                 parse_mode='HTML'
             )
 
@@ -432,9 +745,9 @@ async def publish_post_to_channel() -> str:
         else:
             # Отправляем только текст с кнопкой
             bot.send_message(
-                CHANNEL_ID,
+                tenants.current().channel_id,
                 post_text,
-                reply_markup=keyboard,
+                reply_markup=settings.post_keyboard,
                 parse_mode='HTML'
             )
 
@@ -469,82 +782,198 @@ def publish_post_to_channel_sync() -> str:
         return f"Ошибка публикации поста: {e}"
 
 
-# Функция для HTML-форматирования
-def html_to_editable(text: str) -> str:
-    """Преобразует HTML-теги в звездочки для редактирования."""
-    if not text:
-        return ''
+# Очередь публикаций (см. scheduler.py): скорость рассылки по каналам, сообщений
+# в секунду, и количество каналов, в которые пост отправляется одновременно
+PUBLISH_RATE = float(os.getenv('PUBLISH_RATE', 20))
+PUBLISH_CONCURRENCY = int(os.getenv('PUBLISH_CONCURRENCY', 4))
 
-    # Заменяем <b> теги на звездочки
-    text = text.replace('<b>', '*').replace('</b>', '*')
 
-    # Заменяем разные виды <br> на переносы строк
-    text = text.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
+def current_post() -> Dict[str, Any]:
+    """Пост для очереди публикаций из текущих настроек."""
+    settings = bot_settings.current
+    return {'text': settings.post_text, 'image_url': settings.image_url, 'reply_markup': settings.post_keyboard}
 
-    return text
+
+def send_channel_post(target: str, post: Dict[str, Any], photo: Any) -> tuple:
+    """Отправляет пост из очереди в канал; возвращает ID сообщения и file_id фото."""
+    if photo:
+        message = bot.send_photo(target, photo, caption=post['text'],
+                                 reply_markup=post['reply_markup'], parse_mode='HTML')
+        return message.message_id, message.photo[-1].file_id if message.photo else None
+
+    message = bot.send_message(target, post['text'], reply_markup=post['reply_markup'], parse_mode='HTML')
+    return message.message_id, None
+
+
+for tenant in tenants:
+    tenant.scheduler = PostScheduler(
+        os.path.join(tenant.data_dir, 'scheduled_posts.json'),
+        functools.partial(tenant.run, send_channel_post),
+        rate=PUBLISH_RATE,
+        concurrency=PUBLISH_CONCURRENCY,
+        name=tenant.name if len(tenants) > 1 else None,
+    )
+
+post_scheduler: PostScheduler = LocalProxy(lambda: tenants.current().scheduler)
+
+
+# Быстрый ответ на /start: пользователь сразу видит START_STATUS_MESSAGE, а проверка
+# подписки и отправка файла идут в пуле START_BACKGROUND_WORKERS потоков, после чего
+# сообщение о проверке правится результатом. Поток обработки обновлений при этом свободен.
+# Пока проверка чата не закончена, следующие сообщения этого чата ставятся в пул за ней,
+# поэтому порядок обработки внутри чата сохраняется (см. ordered_after_start).
+START_FAST_PATH = os.getenv('START_FAST_PATH', '').lower() in ('1', 'true', 'yes')
+START_STATUS_MESSAGE = os.getenv('START_STATUS_MESSAGE', '⏳ Проверяем подписку на канал...')
+START_SUBSCRIBED_MESSAGE = os.getenv('START_SUBSCRIBED_MESSAGE', '✅ Подписка подтверждена, отправляем материал')
+START_BACKGROUND_WORKERS = int(os.getenv('START_BACKGROUND_WORKERS', 8))
+start_pool = WorkerPool(START_BACKGROUND_WORKERS, name='start-verify')
+
+# Количество задач чата (бот, chat_id) в start_pool, которые ещё не выполнены
+_start_in_flight: Dict[Tuple[str, int], int] = {}
+_start_in_flight_lock = threading.Lock()
+
+
+def submit_after_start(chat_id: int, func: Callable, *args: Any) -> None:
+    """Ставит задачу в start_pool за остальными задачами чата; выполняется с контекстом текущего бота."""
+    tenant = tenants.current()
+    key = (tenant.name, chat_id)
+    with _start_in_flight_lock:
+        _start_in_flight[key] = _start_in_flight.get(key, 0) + 1
+    start_pool.start()
+    start_pool.submit(key, _run_after_start, key, tenant, func, args)
+
+
+def _run_after_start(key: Tuple[str, int], tenant: Tenant, func: Callable, args: tuple) -> None:
+    try:
+        tenant.run(func, *args)
+    finally:
+        with _start_in_flight_lock:
+            _start_in_flight[key] -= 1
+            if not _start_in_flight[key]:
+                del _start_in_flight[key]
+
+
+def ordered_after_start(handler: Callable) -> Callable:
+    """Обработчик, который ждёт незаконченную фоновую проверку /start своего чата, а не обгоняет её."""
+    @functools.wraps(handler)
+    def wrapper(message):
+        with _start_in_flight_lock:
+            waiting = (tenants.current().name, message.chat.id) in _start_in_flight
+        if waiting:
+            submit_after_start(message.chat.id, handler, message)
+        else:
+            handler(message)
+    return wrapper
+
+
+def answer_start(chat_id: int, user_id: int, asset: Optional[Asset], status_message_id: Optional[int] = None) -> None:
+    """
+    Проверяет подписку и отвечает на /start: подписчику отправляет файл, остальным — приглашение в канал.
+
+    Args:
+        status_message_id: Сообщение о проверке, которое правится результатом вместо отправки нового
+    """
+    # Проверяем подписку
+    is_subscribed = check_subscription_sync(user_id)
+
+    if is_subscribed:
+        if status_message_id is not None:
+            try:
+                bot.edit_message_text(START_SUBSCRIBED_MESSAGE, chat_id=chat_id, message_id=status_message_id)
+            except Exception:
+                pass
+
+        # Если пользователь подписан, сразу отправляем PDF
+        deliver_pdf(chat_id, user_id)
+        return
+
+    # Если не подписан, отправляем ОДНО сообщение с инструкцией и кнопкой для перехода в канал
+    if asset is not None:
+        text, keyboard = asset.subscription_message, asset.subscription_keyboard
+    else:
+        settings = bot_settings.current
+        text, keyboard = settings.start_message, settings.subscription_keyboard
+
+    if status_message_id is not None:
+        try:
+            bot.edit_message_text(text, chat_id=chat_id, message_id=status_message_id, reply_markup=keyboard)
+            return
+        except Exception as e:
+            logger.error(f'Ошибка изменения сообщения о проверке подписки: {e}')
+    bot.send_message(chat_id, text, reply_markup=keyboard)
+
+
+def verify_start_in_background(chat_id: int, user_id: int, asset: Optional[Asset], status_message_id: int) -> None:
+    """Фоновая часть быстрого ответа на /start (в пуле start_pool)."""
+    with tracer.trace('start_verification', user_id=user_id, tenant=tenants.current().name):
+        try:
+            answer_start(chat_id, user_id, asset, status_message_id)
+        except Exception as e:
+            logger.error(f'Ошибка фоновой проверки подписки пользователя {user_id}: {e}')
 
 
 # Обработчик команды /start
-# Обработчик команды /start
-@bot.message_handler(commands=['start'])
 def handle_start(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
 
     # Сохраняем информацию о пользователе
-    if user_id not in users:
-        users[user_id] = {
-            'user_id': user_id,
-            'username': message.from_user.username or '',
-            'welcome_sent': False,
-            'pdf_sent': False,
-            'is_subscribed': False,
-            'last_activity': datetime.now()
-        }
+    users.setdefault(user_id, {
+        'user_id': user_id,
+        'username': message.from_user.username or '',
+        'welcome_sent': False,
+        'pdf_sent': False,
+        'is_subscribed': False,
+        'last_activity': datetime.now()
+    })
 
     # Обновляем активность пользователя
-    users[user_id]['last_activity'] = datetime.now()
+    users.update_user(user_id, last_activity=datetime.now())
+
+    # Payload ссылки (t.me/<бот>?start=<payload>) — источник перехода для воронки
+    payload = telebot.util.extract_arguments(message.text or '') or ''
+    analytics.record('start', user_id, source=payload.strip().lower()[:64])
+
+    # Материал выбирается по payload и запоминается, чтобы /check после подписки
+    # выдал тот же материал; /start без известного payload не меняет материал,
+    # выбранный раньше по ссылке
+    catalog = tenants.current().catalog
+    asset = None
+    if catalog is not None:
+        asset = catalog.route(payload)
+        if asset is None and (users.get(user_id) or {}).get('asset'):
+            asset = user_asset(user_id)
+        else:
+            asset = asset or catalog.default
+            users.update_user(user_id, asset=asset.key)
+        catalog.record(asset.key, 'requested')
 
-    # Проверяем подписку
-    is_subscribed = check_subscription_sync(user_id)
+    status_message_id = None
+    if START_FAST_PATH:
+        # Быстрый ответ: сообщение о проверке сразу, проверка и отправка файла — в фоне
+        try:
+            status_message_id = bot.send_message(chat_id, START_STATUS_MESSAGE).message_id
+        except Exception as e:
+            logger.error(f'Ошибка отправки сообщения о проверке подписки: {e}')
 
-    if is_subscribed:
-        # Если пользователь подписан, сразу отправляем PDF
-        send_pdf_document_sync(chat_id, user_id)
+    if status_message_id is not None:
+        submit_after_start(chat_id, verify_start_in_background, chat_id, user_id, asset, status_message_id)
     else:
-        # Если не подписан, отправляем ОДНО сообщение с инструкцией и кнопкой
-        keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        keyboard.add(types.KeyboardButton(CONFIG.get('checklist_button_text', 'Получить чек-лист')))
-
-        # Создаем инлайн-кнопку для перехода в канал
-        inline_keyboard = types.InlineKeyboardMarkup()
-        inline_keyboard.add(types.InlineKeyboardButton(
-            text="Перейти в канал",
-            url=f"https://t.me/{CHANNEL_ID.replace('@', '')}"
-        ))
-
-        # Отправляем единое сообщение с обоими клавиатурами
-        welcome_message = f'Привет! Чтобы получить чек-лист подготовки к ремонту, подпишитесь на канал {CHANNEL_ID} и нажмите /check для проверки подписки.'
-
-        bot.send_message(
-            chat_id,
-            welcome_message,
-            reply_markup=inline_keyboard  # Отправляем инлайн-клавиатуру для перехода в канал
-        )
+        answer_start(chat_id, user_id, asset)
 
     # Отмечаем, что приветствие отправлено
-    users[user_id]['welcome_sent'] = True
+    users.update_user(user_id, welcome_sent=True)
 
-    logger.info(f'Пользователь {user_id} запустил бота')
+    logger.info('Пользователь %s запустил бота', user_id, extra={'event': 'start', 'user_id': user_id})
 
 
 # Обработчик команды /check
-@bot.message_handler(commands=['check'])
 def handle_check(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
 
-    logger.info(f'Пользователь {user_id} запросил проверку подписки')
+    logger.info('Пользователь %s запросил проверку подписки', user_id, extra={'event': 'check', 'user_id': user_id})
+    analytics.record('check', user_id)
 
     # Отправляем сообщение о проверке
     status_msg = bot.send_message(chat_id, "Проверяем вашу подписку...")
@@ -561,7 +990,7 @@ def handle_check(message):
                 pass
 
             # Отправляем PDF подписчику
-            send_pdf_document_sync(chat_id, user_id)
+            deliver_pdf(chat_id, user_id)
         else:
             # Обновляем сообщение о проверке
             try:
@@ -574,8 +1003,9 @@ def handle_check(message):
                 pass
 
             # Отправляем запрос на подписку с небольшой задержкой
-            time.sleep(1)
-            send_subscription_request(chat_id)
+            with span('sleep', seconds=1):
+                time.sleep(1)
+            send_subscription_request(chat_id, user_id)
 
     except Exception as error:
         logger.error(f'Ошибка при обработке команды /check: {error}')
@@ -592,7 +1022,6 @@ def handle_check(message):
 
 
 # Обработчик текстовых сообщений
-@bot.message_handler(func=lambda message: True, content_types=['text'])
 def handle_message(message):
     if not message.text:
         return
@@ -601,49 +1030,175 @@ def handle_message(message):
     user_id = message.from_user.id
     text = message.text
 
-    logger.info(f'Получено сообщение от {user_id}: {text}')
+    # Текст сообщения — персональные данные: в INFO пишется только его длина
+    logger.info('Получено сообщение от %s, длина %s', user_id, len(text),
+                extra={'event': 'message_received', 'user_id': user_id})
+    logger.debug('Текст сообщения от %s: %s', user_id, text, extra={'user_id': user_id})
 
     # Обновляем активность пользователя
-    if user_id in users:
-        users[user_id]['last_activity'] = datetime.now()
+    user_data = users.update_user(user_id, last_activity=datetime.now())
+
+    settings = bot_settings.current
 
     # Если текст совпадает с текстом кнопки получения чек-листа
-    if text == CONFIG['checklist_button_text']:
+    if text == settings.checklist_button_text:
+        analytics.record('check', user_id)
         check_and_send_pdf(chat_id, user_id)
     else:
         # Для других сообщений отправляем напоминание
-        if user_id in users and users[user_id].get('welcome_sent'):
-            bot.send_message(
-                chat_id,
-                f"Чтобы получить чек-лист, нажмите кнопку \"{CONFIG['checklist_button_text']}\" или отправьте /check для проверки подписки."
-            )
+        if user_data is not None and user_data.get('welcome_sent'):
+            bot.send_message(chat_id, settings.reminder_message)
         else:
             # Если пользователь новый, отправляем приветствие
             send_welcome_with_button(chat_id)
 
-            if user_id in users:
-                users[user_id]['welcome_sent'] = True
+            if user_data is not None:
+                users.update_user(user_id, welcome_sent=True)
             else:
-                users[user_id] = {
+                users.setdefault(user_id, {
                     'user_id': user_id,
                     'username': message.from_user.username or '',
                     'welcome_sent': True,
                     'pdf_sent': False,
                     'is_subscribed': False,
                     'last_activity': datetime.now()
-                }
+                })
+
+
+def register_handlers(tenant_bot: telebot.TeleBot) -> None:
+    """Регистрирует обработчики сообщений; обработчики общие для всех ботов процесса."""
+    tenant_bot.register_message_handler(ordered_after_start(handle_start), commands=['start'])
+    tenant_bot.register_message_handler(ordered_after_start(handle_check), commands=['check'])
+    tenant_bot.register_message_handler(ordered_after_start(handle_message), func=lambda message: True,
+                                        content_types=['text'])
+
+
+for tenant in tenants:
+    register_handlers(tenant.bot)
 
 
 # Создаем Flask-приложение для веб-интерфейса
 app = Flask(__name__)
 
 
-# Функция генерации CSV со списком пользователей
-def generate_users_csv() -> str:
-    """Генерирует CSV-файл со списком пользователей."""
-    csv_content = 'ID,Username,Subscription Status,PDF Sent,Last Activity\n'
+# Панель управления работает с ботом, выбранным через ?tenant= или cookie
+@app.before_request
+def select_tenant():
+    name = request.args.get('tenant') or request.cookies.get('tenant')
+    g.tenant_token = tenant_context.set(tenants.get(name) or tenants.default)
+
+
+@app.teardown_request
+def reset_tenant(error=None):
+    token = g.pop('tenant_token', None)
+    if token is not None:
+        tenant_context.reset(token)
+
+
+def precompile_templates() -> None:
+    """Компилирует шаблоны панели заранее, чтобы первый запрос не платил за компиляцию."""
+    for template_name in ('admin.html', 'message.html', 'users.html', 'posts.html', 'assets.html', 'analytics.html',
+                          'traces.html'):
+        app.jinja_env.get_template(template_name)
+
+
+# Функция подготовки пользователя к JSON-сериализации
+def serialize_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Преобразует datetime объекты пользователя в строки ISO 8601."""
+    serializable_user = user_data.copy()
+    if 'last_activity' in serializable_user and isinstance(serializable_user['last_activity'], datetime):
+        serializable_user['last_activity'] = serializable_user['last_activity'].isoformat()
+    if 'last_checked' in serializable_user and isinstance(serializable_user['last_checked'], datetime):
+        serializable_user['last_checked'] = serializable_user['last_checked'].isoformat()
+    return serializable_user
+
+
+# Максимальный размер страницы при поиске пользователей
+USERS_PAGE_LIMIT = 500
 
-    for user_id, user_data in users.items():
+
+def query_users(args) -> tuple:
+    """
+    Ищет пользователей по параметрам запроса через индексы хранилища.
+
+    Поддерживаемые параметры: subscribed и pdf_sent (1/0), active_from и active_to
+    (ISO 8601), username (префикс), order (desc/asc), limit, cursor.
+
+    Returns:
+        tuple: Список найденных пользователей и курсор следующей страницы
+
+    Raises:
+        ValueError: Если параметры запроса некорректны
+    """
+    flags = {}
+    for arg_name, flag in (('subscribed', 'is_subscribed'), ('pdf_sent', 'pdf_sent')):
+        value = args.get(arg_name, '')
+        if value:
+            if value not in ('0', '1'):
+                raise ValueError(f'Параметр {arg_name} должен быть 0 или 1')
+            flags[flag] = value == '1'
+
+    active_from = args.get('active_from', '')
+    active_to = args.get('active_to', '')
+    order = args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError('Параметр order должен быть asc или desc')
+    limit = min(max(int(args.get('limit', 50)), 1), USERS_PAGE_LIMIT)
+
+    query = {
+        'flags': flags,
+        'active_from': datetime.fromisoformat(active_from) if active_from else None,
+        'active_to': datetime.fromisoformat(active_to) if active_to else None,
+        'username_prefix': args.get('username', ''),
+        'cursor': args.get('cursor') or None,
+    }
+    if shard_router is not None:
+        return shard_router.find_users(descending=order == 'desc', limit=limit, **query)
+    return find_users(descending=order == 'desc', limit=limit, **query)
+
+
+def find_users(descending: bool = True, limit: int = 50, **query: Any) -> tuple:
+    """Ищет пользователей в хранилище этого процесса по индексам."""
+    user_ids, next_cursor = users.index.query(descending=descending, limit=limit, **query)
+
+    found_users = []
+    for user_id in user_ids:
+        user_data = users.get(user_id)
+        if user_data is not None:
+            found_users.append(user_data)
+    return found_users, next_cursor
+
+
+def user_stats() -> Dict[str, int]:
+    """Счётчики пользователей; берутся из битовых карт индекса, без обхода пользователей."""
+    if shard_router is not None:
+        return shard_router.stats()
+    return {
+        'user_count': len(users),
+        'is_subscribed': users.index.count('is_subscribed'),
+        'pdf_sent': users.index.count('pdf_sent'),
+    }
+
+
+def users_snapshot() -> Dict[int, Dict[str, Any]]:
+    """Все пользователи (на приёмнике — собранные со всех обработчиков)."""
+    if shard_router is not None:
+        return shard_router.snapshot()
+    return users.snapshot()
+
+
+def notify_settings_changed() -> None:
+    """Просит обработчики перечитать общий файл настроек после изменения в панели."""
+    if shard_router is not None:
+        shard_router.call_all('reload_settings')
+
+
+# Функции генерации CSV и JSON со списком пользователей по строкам,
+# чтобы экспорт можно было отдавать потоком
+def iter_users_csv(snapshot: Dict[int, Dict[str, Any]]) -> Iterator[str]:
+    yield 'ID,Username,Subscription Status,PDF Sent,Last Activity\n'
+
+    for user_id, user_data in snapshot.items():
         is_subscribed = 'Subscribed' if user_data.get('is_subscribed', False) else 'Not Subscribed'
         pdf_sent = 'Yes' if user_data.get('pdf_sent', False) else 'No'
         username = user_data.get('username', 'no_username')
@@ -652,9 +1207,25 @@ def generate_users_csv() -> str:
         if isinstance(last_activity, datetime):
             last_activity = last_activity.isoformat()
 
-        csv_content += f"{user_id},{username},{is_subscribed},{pdf_sent},{last_activity}\n"
+        yield f"{user_id},{username},{is_subscribed},{pdf_sent},{last_activity}\n"
+
 
-    return csv_content
+def iter_users_json(snapshot: Dict[int, Dict[str, Any]]) -> Iterator[str]:
+    """Тот же JSON, что json.dumps({id: пользователь}, indent=2), по одному пользователю."""
+    if not snapshot:
+        yield '{}'
+        return
+    separator = '{\n'
+    for user_id, user_data in snapshot.items():
+        value = json.dumps(serialize_user(user_data), ensure_ascii=False, indent=2).replace('\n', '\n  ')
+        yield f'{separator}  {json.dumps(str(user_id))}: {value}'
+        separator = ',\n'
+    yield '\n}'
+
+
+def generate_users_csv() -> str:
+    """Генерирует CSV-файл со списком пользователей."""
+    return ''.join(iter_users_csv(users_snapshot()))
 
 
 def check_bot_channel_access() -> dict:
@@ -671,12 +1242,12 @@ def check_bot_channel_access() -> dict:
         bot_username = bot_info.username
 
         # Получаем информацию о канале
-        channel_info = bot.get_chat(CHANNEL_ID)
+        channel_info = bot.get_chat(tenants.current().channel_id)
         channel_name = channel_info.title
         channel_username = channel_info.username
 
         # Проверяем права бота в канале
-        bot_member = bot.get_chat_member(CHANNEL_ID, bot_info.id)
+        bot_member = bot.get_chat_member(tenants.current().channel_id, bot_info.id)
         is_admin = bot_member.status in ['administrator', 'creator']
         can_post = getattr(bot_member, 'can_post_messages', False)
 
@@ -698,148 +1269,126 @@ def check_bot_channel_access() -> dict:
         }
 
 
-# Административная панель
-@app.route('/admin')
-def admin_panel():
-    user_count = len(users)
-    subscribed_users = sum(1 for user in users.values() if user.get('is_subscribed', False))
-    pdf_sent_count = sum(1 for user in users.values() if user.get('pdf_sent', False))
+# Время жизни кэша проверки доступа бота к каналу, в секундах
+CHANNEL_ACCESS_TTL = int(os.getenv('CHANNEL_ACCESS_TTL', 60))
+_channel_access_cache: Dict[str, Any] = LocalProxy(lambda: tenants.current().channel_access_cache)
 
-    # Подготавливаем текст описания для редактирования
-    editable_description = html_to_editable(CHANNEL_POST_DESCRIPTION)
 
-    # Проверяем доступ бота к каналу
-    channel_access = check_bot_channel_access()
+def get_channel_access() -> dict:
+    """Возвращает результат check_bot_channel_access, закэшированный на CHANNEL_ACCESS_TTL секунд."""
+    now = time.monotonic()
+    if (_channel_access_cache['result'] is None
+            or now - _channel_access_cache['checked_at'] > CHANNEL_ACCESS_TTL):
+        _channel_access_cache['result'] = check_bot_channel_access()
+        _channel_access_cache['checked_at'] = now
+    return _channel_access_cache['result']
 
-    # Формируем сообщение о статусе подключения
+
+def describe_channel_access(channel_access: dict) -> tuple:
+    """Формирует сообщение о статусе подключения бота к каналу и его CSS-класс."""
     if channel_access['success']:
         if channel_access['is_admin'] and channel_access['can_post']:
-            channel_status = f"Бот @{channel_access['bot_username']} подключён к каналу {channel_access['channel_name']} (@{channel_access['channel_username']}) и может публиковать посты ✅"
-            channel_status_class = "success"
+            return (f"Бот @{channel_access['bot_username']} подключён к каналу {channel_access['channel_name']} (@{channel_access['channel_username']}) и может публиковать посты ✅",
+                    "success")
         elif channel_access['is_admin']:
-            channel_status = f"Бот @{channel_access['bot_username']} является администратором канала {channel_access['channel_name']}, но не имеет прав на публикацию сообщений ⚠️"
-            channel_status_class = "warning"
+            return (f"Бот @{channel_access['bot_username']} является администратором канала {channel_access['channel_name']}, но не имеет прав на публикацию сообщений ⚠️",
+                    "warning")
         else:
-            channel_status = f"Бот @{channel_access['bot_username']} не является администратором канала {channel_access['channel_name']} и не может публиковать посты ❌"
-            channel_status_class = "danger"
-    else:
-        channel_status = f"Не удалось проверить доступ бота к каналу: {channel_access.get('error', 'Неизвестная ошибка')} ❌"
-        channel_status_class = "danger"
-
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-      <meta charset="UTF-8">
-      <meta name="viewport" content="width=device-width, initial-scale=1.0">
-      <title>Панель управления ботом</title>
-      <style>
-        body { font-family: Arial, sans-serif; line-height: 1.6; max-width: 800px; margin: 0 auto; padding: 20px; }
-        h1, h2 { color: #2c3e50; }
-        .card { background: #f9f9f9; border-radius: 5px; padding: 15px; margin-bottom: 20px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
-        .stats { display: flex; justify-content: space-between; flex-wrap: wrap; }
-        .stat-card { background: #fff; border-left: 4px solid #3498db; padding: 10px; width: 30%; margin-bottom: 15px; }
-        button, .button { background: #3498db; color: white; border: none; padding: 10px 15px; border-radius: 4px; cursor: pointer; text-decoration: none; display: inline-block; }
-        button:hover, .button:hover { background: #2980b9; }
-        table { width: 100%; border-collapse: collapse; margin: 20px 0; }
-        table, th, td { border: 1px solid #ddd; }
-        th, td { padding: 12px; text-align: left; }
-        th { background-color: #f2f2f2; }
-        form { margin-bottom: 20px; }
-        input, textarea { width: 100%; padding: 8px; margin: 8px 0; box-sizing: border-box; }
-        .help-text { color: #666; font-style: italic; margin: 5px 0; font-size: 0.9em; }
-        .status { padding: 10px; border-radius: 5px; margin: 10px 0; }
-        .success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-        .warning { background-color: #fff3cd; color: #856404; border: 1px solid #ffeeba; }
-        .danger { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-      </style>
-    </head>
-    <body>
-      <h1>Панель управления Telegram-ботом</h1>
-
-      <div class="card">
-        <h2>Статистика</h2>
-        <div class="stats">
-          <div class="stat-card">
-            <h3>Всего пользователей</h3>
-            <p>{{ user_count }}</p>
-          </div>
-          <div class="stat-card">
-            <h3>Подписчиков канала</h3>
-            <p>{{ subscribed_users }}</p>
-          </div>
-          <div class="stat-card">
-            <h3>Отправлено PDF</h3>
-            <p>{{ pdf_sent_count }}</p>
-          </div>
-        </div>
-      </div>
-
-      <div class="card">
-        <h2>Настройки PDF и бонусных файлов</h2>
-        <form action="/update-pdf-settings" method="post">
-          <label for="bonusPdfUrl">URL бонусного PDF-файла (отправляется подписчикам):</label>
-          <input type="text" id="bonusPdfUrl" name="bonusPdfUrl" value="{{ bonus_pdf_url }}">
-
-          <button type="submit">Обновить настройки PDF</button>
-        </form>
-      </div>
-
-      <div class="card">
-        <h2>Публикация в канал</h2>
-        <div class="status {{ channel_status_class }}">
-          {{ channel_status }}
-        </div>
-        <form action="/publish-post" method="post">
-          <label for="title">Заголовок:</label>
-          <input type="text" id="title" name="title" value="{{ channel_post_title }}">
-
-          <label for="description">Описание:</label>
-          <p class="help-text">Используйте *звездочки* для выделения текста жирным шрифтом</p>
-          <textarea id="description" name="description" rows="5">{{ editable_description }}</textarea>
-
-          <label for="call">Призыв к действию:</label>
-          <input type="text" id="call" name="call" value="{{ channel_post_call }}">
-
-          <label for="buttonText">Текст кнопки:</label>
-          <input type="text" id="buttonText" name="buttonText" value="{{ channel_button_text }}">
-
-          <label for="imageUrl">URL изображения (оставьте пустым для текстового поста):</label>
-          <input type="text" id="imageUrl" name="imageUrl" value="{{ image_url }}">
-
-          <button type="submit">Опубликовать пост</button>
-        </form>
-      </div>
-
-      <div class="card">
-        <h2>Действия</h2>
-        <p><a href="/save-users" class="button">Сохранить данные пользователей</a></p>
-        <p><a href="/test-bot" class="button">Проверить работу бота</a></p>
-        <p><a href="/test-pdf" class="button">Проверить отправку PDF</a></p>
-        <p><a href="/clear-users" class="button" onclick="return confirm('Вы уверены, что хотите удалить всех пользователей?')">Очистить данные пользователей</a></p>
-      </div>
-      <div class="card">
-        <h2>Экспорт данных</h2>
-        <p><a href="/export-users" class="button" download>Скачать список пользователей (CSV)</a></p>
-        <p><a href="/export-users-json" class="button" download>Скачать детальный список пользователей (JSON)</a></p>
-      </div>
-    </body>
-    </html>
-    """
+            return (f"Бот @{channel_access['bot_username']} не является администратором канала {channel_access['channel_name']} и не может публиковать посты ❌",
+                    "danger")
+    return (f"Не удалось проверить доступ бота к каналу: {channel_access.get('error', 'Неизвестная ошибка')} ❌",
+            "danger")
+
+
+def render_message(title: str, *lines: Any) -> str:
+    """Отрисовывает страницу с результатом действия и ссылкой на панель управления."""
+    return render_template('message.html', title=title, lines=lines)
 
-    return render_template_string(
-        html_template,
+
+# Административная панель
+@app.route('/admin')
+def admin_panel():
+    stats = user_stats()
+    user_count = stats['user_count']
+    subscribed_users = stats['is_subscribed']
+    pdf_sent_count = stats['pdf_sent']
+
+    settings = bot_settings.current
+
+    # Проверяем доступ бота к каналу (результат кэшируется)
+    channel_access = get_channel_access()
+
+    # Страница зависит только от счётчиков, настроек и статуса канала,
+    # поэтому при неизменных данных отвечаем 304 без отрисовки шаблона
+    # Каналы для публикации по умолчанию — из последнего задания очереди
+    publish_targets = post_scheduler.last_targets() or [tenants.current().channel_id]
+
+    etag = hashlib.md5(repr((tenants.current().name, user_count, subscribed_users, pdf_sent_count,
+                             settings.version, _channel_access_cache['checked_at'],
+                             logging_state.level, publish_targets)).encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    channel_status, channel_status_class = describe_channel_access(channel_access)
+
+    response = Response(render_template(
+        'admin.html',
         user_count=user_count,
         subscribed_users=subscribed_users,
         pdf_sent_count=pdf_sent_count,
-        bonus_pdf_url=BONUS_PDF_URL,
-        channel_post_title=CHANNEL_POST_TITLE,
-        editable_description=editable_description,
-        channel_post_call=CHANNEL_POST_CALL,
-        channel_button_text=CHANNEL_BUTTON_TEXT,
-        image_url=IMAGE_URL or '',
+        bonus_pdf_url=settings.bonus_pdf_url,
+        channel_post_title=settings.channel_post_title,
+        editable_description=settings.editable_description,
+        channel_post_call=settings.channel_post_call,
+        channel_button_text=settings.channel_button_text,
+        image_url=settings.image_url,
+        post_preview=Markup(settings.post_preview),
         channel_status=channel_status,
-        channel_status_class=channel_status_class
+        channel_status_class=channel_status_class,
+        log_level=logging_state.level,
+        log_levels=LOG_LEVELS,
+        tenant_name=tenants.current().name,
+        tenant_names=tenants.names(),
+        publish_targets='\n'.join(publish_targets)
+    ))
+    response.set_etag(etag)
+    return response
+
+
+# Маршрут для поиска пользователей
+@app.route('/api/users')
+def api_users():
+    try:
+        found_users, next_cursor = query_users(request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {
+        'users': [serialize_user(user_data) for user_data in found_users],
+        'next_cursor': next_cursor,
+    }
+
+
+# Страница поиска пользователей в панели управления
+@app.route('/admin/users')
+def admin_users():
+    try:
+        found_users, next_cursor = query_users(request.args)
+    except ValueError as e:
+        return render_message('Ошибка поиска пользователей', str(e)), 400
+
+    next_page_args = None
+    if next_cursor:
+        next_page_args = request.args.to_dict()
+        next_page_args['cursor'] = next_cursor
+
+    return render_template(
+        'users.html',
+        users=[serialize_user(user_data) for user_data in found_users],
+        args=request.args,
+        next_page_args=next_page_args,
     )
 
 
@@ -858,18 +1407,8 @@ def export_users():
 # Маршрут для экспорта пользователей в JSON
 @app.route('/export-users-json')
 def export_users_json():
-    # Преобразуем datetime объекты для JSON-сериализации
-    serializable_users = {}
-    for user_id, user_data in users.items():
-        serializable_user = user_data.copy()
-        if 'last_activity' in serializable_user and isinstance(serializable_user['last_activity'], datetime):
-            serializable_user['last_activity'] = serializable_user['last_activity'].isoformat()
-        if 'last_checked' in serializable_user and isinstance(serializable_user['last_checked'], datetime):
-            serializable_user['last_checked'] = serializable_user['last_checked'].isoformat()
-        serializable_users[str(user_id)] = serializable_user
-
     return Response(
-        json.dumps(serializable_users, ensure_ascii=False, indent=2),
+        ''.join(iter_users_json(users_snapshot())),
         mimetype='application/json',
         headers={'Content-Disposition': 'attachment; filename=users.json'}
     )
@@ -878,36 +1417,45 @@ def export_users_json():
 # Маршрут для обновления настроек PDF
 @app.route('/update-pdf-settings', methods=['POST'])
 def update_pdf_settings():
-    global BONUS_PDF_URL
-
     try:
         bonus_pdf_url = request.form.get('bonusPdfUrl')
 
-        # Обновляем URL бонусного PDF
-        BONUS_PDF_URL = bonus_pdf_url
-
-        html_response = """
-        <h1>Настройки PDF успешно обновлены!</h1>
-        <p>Новый URL бонусного PDF: {}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
+        # Публикуем новую версию настроек с обновлённым URL бонусного PDF
+        bot_settings.update(bonus_pdf_url=bonus_pdf_url)
+        notify_settings_changed()
 
-        return html_response.format(bonus_pdf_url)
+        return render_message('Настройки PDF успешно обновлены!',
+                              f'Новый URL бонусного PDF: {bonus_pdf_url}')
     except Exception as e:
-        html_error = """
-        <h1>Ошибка обновления настроек PDF</h1>
-        <p>{}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
+        return render_message('Ошибка обновления настроек PDF', str(e)), 500
 
-        return html_error.format(str(e)), 500
+
+# Маршрут для переключения панели управления на другого бота
+@app.route('/switch-tenant')
+def switch_tenant():
+    name = request.args.get('tenant', '')
+    if tenants.get(name) is None:
+        return render_message('Бот не найден', name), 404
+
+    response = redirect('/admin')
+    response.set_cookie('tenant', name, samesite='Lax')
+    return response
+
+
+# Маршрут для смены уровня логирования без перезапуска
+@app.route('/update-log-level', methods=['POST'])
+def update_log_level():
+    try:
+        logging_state.set_level(request.form.get('level', ''))
+        logger.warning(f'Уровень логирования изменён на {logging_state.level}')
+        return render_message('Уровень логирования изменён', f'Текущий уровень: {logging_state.level}')
+    except ValueError as e:
+        return render_message('Ошибка смены уровня логирования', str(e)), 400
 
 
 # Маршрут для публикации поста
 @app.route('/publish-post', methods=['POST'])
 def publish_post():
-    global CHANNEL_POST_TITLE, CHANNEL_POST_DESCRIPTION, CHANNEL_POST_CALL, CHANNEL_BUTTON_TEXT, IMAGE_URL
-
     try:
         title = request.form.get('title')
         description = request.form.get('description')
@@ -915,38 +1463,203 @@ def publish_post():
         button_text = request.form.get('buttonText')
         image_url = request.form.get('imageUrl')
 
-        # Обновляем глобальные переменные
-        CHANNEL_POST_TITLE = title
+        # Публикуем новую версию настроек одним атомарным обновлением; описание
+        # форматируется так же, как в предпросмотре панели
+        bot_settings.update(
+            channel_post_title=title,
+            channel_post_description=format_description(description),
+            channel_post_call=call,
+            channel_button_text=button_text,
+            image_url=image_url,
+        )
+        notify_settings_changed()
+
+        # Ставим пост в очередь: рассылка по каналам идёт в фоне, ответ возвращается сразу
+        targets = list(dict.fromkeys(target.strip() for target in request.form.get('targets', '').replace(',', '\n').split('\n')
+                                     if target.strip())) or [tenants.current().channel_id]
+        publish_at = request.form.get('publishAt', '')
+        job_id = post_scheduler.schedule(
+            current_post(), targets,
+            publish_at=datetime.fromisoformat(publish_at).timestamp() if publish_at else None,
+        )
 
-        # Форматируем описание
-        formatted_description = description.replace('\r\n', '\n').replace('\n{3,}', '\n\n').strip()
-        CHANNEL_POST_DESCRIPTION = ''.join(f'<b>{part}</b>' if i % 2 else part
-                                           for i, part in enumerate(formatted_description.split('*')))
+        return render_message('Пост поставлен в очередь публикации',
+                              f'Номер задания: {job_id}',
+                              f'Каналов: {len(targets)}',
+                              f"Время публикации: {publish_at.replace('T', ' ') if publish_at else 'сразу'}",
+                              'Результаты по каналам — на странице /admin/posts')
+    except Exception as e:
+        logger.error(f"Ошибка при публикации поста: {e}")
 
-        CHANNEL_POST_CALL = call
-        CHANNEL_BUTTON_TEXT = button_text
-        IMAGE_URL = image_url
+        return render_message('Ошибка публикации поста', str(e)), 500
 
-        # Публикуем пост
-        result = publish_post_to_channel_sync()
 
-        html_response = """
-        <h1>Пост успешно опубликован!</h1>
-        <p>{}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
+def format_timestamp(timestamp: Any) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else ''
 
-        return html_response.format(result)
-    except Exception as e:
-        logger.error(f"Ошибка при публикации поста: {e}")
 
-        html_error = """
-        <h1>Ошибка публикации поста</h1>
-        <p>{}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
+# Страница каталога материалов со ссылками и счётчиками выдачи
+@app.route('/admin/assets')
+def admin_assets():
+    catalog = tenants.current().catalog
+    if catalog is None:
+        return render_message('Каталог материалов не задан',
+                              'Укажите файл каталога в ASSETS_FILE (или assets_file в TENANTS_FILE)'), 404
+
+    rows = catalog.report()
+    if shard_router is not None:
+        # Материалы выдают обработчики: счётчики складываются со всех
+        for row in rows:
+            row['counters'] = {name: 0 for name in row['counters']}
+        for counters in shard_router.call_all('asset_counters'):
+            for row in rows:
+                for name, value in counters.get(row['key'], {}).items():
+                    row['counters'][name] += value
+    return render_template('assets.html', assets=rows, bot_username=tenants.current().config.bot_username)
+
+
+def analytics_query(args) -> Dict[str, Any]:
+    """Разбирает параметры запроса аналитики: from, to (YYYY-MM-DD), source, days, window."""
+    try:
+        date_to = date.fromisoformat(args['to']) if args.get('to') else date.today()
+        date_from = date.fromisoformat(args['from']) if args.get('from') else date_to - timedelta(days=6)
+        days = int(args.get('days', 7))
+        window = int(args.get('window', 7))
+    except ValueError:
+        raise ValueError('Даты задаются в формате YYYY-MM-DD, days и window — целые числа')
+    if date_from > date_to:
+        raise ValueError('Начало периода позже его конца')
+    if (date_to - date_from).days > 366 or not 1 <= days <= 90 or not 0 <= window <= 90:
+        raise ValueError('Период — не больше года, days — от 1 до 90, window — от 0 до 90')
+    return {'date_from': date_from, 'date_to': date_to, 'source': args.get('source') or None,
+            'days': days, 'window': window}
+
+
+def analytics_funnel(query: Dict[str, Any]) -> list:
+    """Воронка бота; при нескольких процессах пользователи разделены по обработчикам, и счётчики складываются."""
+    kwargs = {'date_from': query['date_from'], 'date_to': query['date_to'], 'source': query['source'],
+              'steps': FUNNEL_STEPS, 'window_days': query['window']}
+    if shard_router is None:
+        return analytics.funnel(**kwargs)
+
+    steps = [{'event': step, 'users': 0} for step in FUNNEL_STEPS]
+    for shard_steps in shard_router.call_all('analytics_funnel', **kwargs):
+        for step, shard_step in zip(steps, shard_steps):
+            step['users'] += shard_step['users']
+    first = steps[0]['users']
+    for step in steps:
+        step['conversion'] = round(step['users'] / first, 4) if first else 0.0
+    return steps
+
+
+def analytics_cohorts(query: Dict[str, Any]) -> list:
+    """Когорты бота; при нескольких процессах складываются по обработчикам."""
+    kwargs = {'date_from': query['date_from'], 'date_to': query['date_to'], 'days': query['days'],
+              'source': query['source']}
+    if shard_router is None:
+        return analytics.cohorts(**kwargs)
+
+    rows = None
+    for shard_rows in shard_router.call_all('analytics_cohorts', **kwargs):
+        if rows is None:
+            rows = shard_rows
+            continue
+        for row, shard_row in zip(rows, shard_rows):
+            row['size'] += shard_row['size']
+            row['returned'] = [a + b for a, b in zip(row['returned'], shard_row['returned'])]
+    return rows or []
+
+
+def analytics_sources() -> list:
+    """Известные источники /start (со всех обработчиков при нескольких процессах)."""
+    if shard_router is None:
+        return analytics.sources()
+    return sorted(set().union(*shard_router.call_all('analytics_sources')))
+
+
+# Воронка по payload ссылки /start: start → subscribed → pdf_sent
+@app.route('/api/analytics/funnel')
+def api_analytics_funnel():
+    try:
+        query = analytics_query(request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'steps': analytics_funnel(query)}
+
+
+# Когорты по дню /start: сколько вернулось в следующие дни
+@app.route('/api/analytics/cohorts')
+def api_analytics_cohorts():
+    try:
+        query = analytics_query(request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'cohorts': analytics_cohorts(query)}
+
 
-        return html_error.format(str(e)), 500
+# Страница воронки и когорт
+@app.route('/admin/analytics')
+def admin_analytics():
+    try:
+        query = analytics_query(request.args)
+    except ValueError as e:
+        return render_message('Неверные параметры аналитики', str(e)), 400
+    return render_template('analytics.html', query=query, funnel=analytics_funnel(query),
+                           cohorts=analytics_cohorts(query), sources=analytics_sources())
+
+
+def collect_traces() -> list:
+    """Медленные трассировки процесса (и всех обработчиков при нескольких процессах), начиная с последней."""
+    traces = tracer.recent()
+    if shard_router is not None:
+        for shard_traces in shard_router.call_all('traces'):
+            traces.extend(shard_traces)
+        traces.sort(key=lambda trace: trace['at'], reverse=True)
+    return traces
+
+
+# Маршрут для получения медленных трассировок
+@app.route('/api/traces')
+def api_traces():
+    return {'traces': collect_traces(), 'slow_threshold': tracer.slow_threshold, 'sample_rate': tracer.sample_rate}
+
+
+# Страница медленных трассировок с деревом отрезков
+@app.route('/admin/traces')
+def admin_traces():
+    traces = collect_traces()
+    for trace in traces:
+        trace['at'] = format_timestamp(trace['at'])
+    return render_template('traces.html', traces=traces, tracer=tracer)
+
+
+# Страница очереди публикаций с результатами по каналам
+@app.route('/admin/posts')
+def admin_posts():
+    jobs = post_scheduler.recent()
+    for job in jobs:
+        job['publish_at'] = format_timestamp(job['publish_at'])
+        job['created_at'] = format_timestamp(job['created_at'])
+        for result in job['results'].values():
+            result['sent_at'] = format_timestamp(result.get('sent_at'))
+    return render_template('posts.html', jobs=jobs)
+
+
+# Маршрут для получения статуса задания публикации
+@app.route('/api/posts/<job_id>')
+def api_post(job_id):
+    job = post_scheduler.get(job_id)
+    if job is None:
+        return {'error': 'Задание не найдено'}, 404
+    return job
+
+
+# Маршрут для отмены запланированной публикации
+@app.route('/admin/posts/<job_id>/cancel', methods=['POST'])
+def cancel_post(job_id):
+    if not post_scheduler.cancel(job_id):
+        return render_message('Задание нельзя отменить', 'Оно не найдено или уже выполняется'), 409
+    return redirect('/admin/posts')
 
 
 # Маршрут для сохранения пользователей
@@ -954,12 +1667,7 @@ def publish_post():
 def save_users_route():
     save_users()
 
-    html_response = """
-    <h1>Данные пользователей сохранены</h1>
-    <p><a href="/admin">Вернуться в панель управления</a></p>
-    """
-
-    return html_response
+    return render_message('Данные пользователей сохранены')
 
 
 # Маршрут для проверки бота
@@ -968,107 +1676,70 @@ def test_bot():
     try:
         me = bot.get_me()
 
-        html_response = """
-        <h1>Бот работает корректно</h1>
-        <p>Имя бота: {}</p>
-        <p>Имя пользователя: @{}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
-
-        return html_response.format(me.first_name, me.username)
+        return render_message('Бот работает корректно',
+                              f'Имя бота: {me.first_name}',
+                              f'Имя пользователя: @{me.username}')
     except Exception as e:
-        html_error = """
-        <h1>Ошибка проверки бота</h1>
-        <p>{}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
-
-        return html_error.format(str(e)), 500
+        return render_message('Ошибка проверки бота', str(e)), 500
 
 
 # Маршрут для проверки PDF
 @app.route('/test-pdf')
 def test_pdf():
-    try:
-        import aiohttp
-        import asyncio
+    bonus_pdf_url = bot_settings.current.bonus_pdf_url
 
+    try:
         async def check_pdf():
-            async with aiohttp.ClientSession() as session:
-                async with session.get(BONUS_PDF_URL, timeout=30) as response:
-                    status = response.status
-                    content_type = response.headers.get('Content-Type', '')
-
-                    file_content = await response.read()
-                    file_size = len(file_content)
-
-                    is_pdf = (
-                            file_size >= 4 and
-                            file_content[0] == 0x25 and  # %
-                            file_content[1] == 0x50 and  # P
-                            file_content[2] == 0x44 and  # D
-                            file_content[3] == 0x46  # F
-                    )
+            status, content_type, file_content = await fetch_url(bonus_pdf_url)
+            file_size = len(file_content)
+
+            is_pdf = (
+                    file_size >= 4 and
+                    file_content[0] == 0x25 and  # %
+                    file_content[1] == 0x50 and  # P
+                    file_content[2] == 0x44 and  # D
+                    file_content[3] == 0x46  # F
+            )
 
-                    first_20_bytes = ''.join(f'{b:02x}' for b in file_content[:20])
+            first_20_bytes = ''.join(f'{b:02x}' for b in file_content[:20])
 
-                    return {
-                        'status': status,
-                        'content_type': content_type,
-                        'file_size': file_size,
-                        'is_pdf': is_pdf,
-                        'first_20_bytes': first_20_bytes
-                    }
+            return {
+                'status': status,
+                'content_type': content_type,
+                'file_size': file_size,
+                'is_pdf': is_pdf,
+                'first_20_bytes': first_20_bytes
+            }
 
         # Запускаем асинхронную функцию
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(check_pdf())
-        loop.close()
-
-        html_response = """
-        <h1>Результат проверки PDF-файла</h1>
-        <p>URL: {url}</p>
-        <p>HTTP статус: {status}</p>
-        <p>Content-Type: {content_type}</p>
-        <p>Размер файла: {size} КБ</p>
-        <p>Формат PDF: {is_pdf}</p>
-        <p>Первые 20 байт: {bytes}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
-
-        return html_response.format(
-            url=BONUS_PDF_URL,
-            status=result['status'],
-            content_type=result['content_type'],
-            size=round(result['file_size'] / 1024, 2),
-            is_pdf='Да' if result['is_pdf'] else 'Нет',
-            bytes=result['first_20_bytes']
+        result = asyncio.run(check_pdf())
+
+        return render_message(
+            'Результат проверки PDF-файла',
+            f'URL: {bonus_pdf_url}',
+            f"HTTP статус: {result['status']}",
+            f"Content-Type: {result['content_type']}",
+            f"Размер файла: {round(result['file_size'] / 1024, 2)} КБ",
+            f"Формат PDF: {'Да' if result['is_pdf'] else 'Нет'}",
+            f"Первые 20 байт: {result['first_20_bytes']}"
         )
     except Exception as e:
-        html_error = """
-        <h1>Ошибка проверки PDF-файла</h1>
-        <p>URL: {url}</p>
-        <p>Ошибка: {error}</p>
-        <p><a href="/admin">Вернуться в панель управления</a></p>
-        """
-
-        return html_error.format(url=BONUS_PDF_URL, error=str(e)), 500
+        return render_message('Ошибка проверки PDF-файла',
+                              f'URL: {bonus_pdf_url}',
+                              f'Ошибка: {e}'), 500
 
 
 # Маршрут для очистки данных пользователей
 @app.route('/clear-users')
 def clear_users():
     # Очищаем данные пользователей
-    users.clear()
+    if shard_router is not None:
+        shard_router.call_all('clear')
+    else:
+        users.clear()
     save_users()
 
-    html_response = """
-    <h1>Данные пользователей очищены</h1>
-    <p><a href="/admin">Вернуться в панель управления</a></p>
-    """
-
-    return html_response
+    return render_message('Данные пользователей очищены')
 
 
 # Маршрут для ручной публикации поста
@@ -1087,52 +1758,537 @@ def root():
     return redirect('/admin')
 
 
+# Пороги проверки готовности и замер задержки планирования
+HEALTH_THRESHOLDS = load_thresholds(POLLING_TIMEOUT)
+lag_monitor = LagMonitor()
+
+
+def _age(timestamp: Any, now: float) -> Any:
+    return round(now - timestamp, 3) if timestamp is not None else None
+
+
+def tenant_health(tenant: Tenant, now: float) -> Dict[str, Any]:
+    """Показатели готовности одного бота."""
+    channel_access = tenant.channel_access_cache['result']
+    save_state = tenant.save_state
+    pdf_cache = tenant.pdf_cache
+    return {
+        'metrics': {
+            'poll_age': _age(tenant.polling_engine.last_poll_at or STARTED_AT, now),
+            # На приёмнике пользователей хранят обработчики: берём самого отстающего
+            'save_age': (shard_router.save_age() if shard_router is not None
+                         else _age(save_state['succeeded_at'] or STARTED_AT, now)),
+        },
+        'save': {
+            'duration': round(save_state['duration'], 3) if save_state['duration'] is not None else None,
+            'error': save_state['error'],
+        },
+        'channel_access': {
+            'success': channel_access.get('success') if channel_access else None,
+            'age': _age(tenant.channel_access_cache['checked_at'] if channel_access else None, now),
+        },
+        'warm_up': tenant.warm_up.report,
+        'analytics': {'queue_depth': tenant.analytics.queue_depth(), 'dropped': tenant.analytics.dropped},
+        'pdf_cache': {
+            'cached': pdf_cache['content'] is not None,
+            'file_id': bool(pdf_cache['file_id']),
+            'age': _age(pdf_cache['fetched_at'] if pdf_cache['content'] is not None else None, now),
+            'ttl': PDF_CACHE_TTL,
+        },
+    }
+
+
+def health_report() -> tuple:
+    """
+    Показатели готовности процесса и всех ботов.
+
+    Только чтение заранее собранных показателей: без сетевых запросов и обхода данных.
+
+    Returns:
+        tuple: Тело ответа и HTTP-статус (200 или 503)
+    """
+    now = time.monotonic()
+    loop_lag = lag_monitor.maximum()
+
+    # Очереди обработки (вместе с фоновыми проверками /start и очередями отправки
+    # обработчикам) и задержка планирования общие для всех ботов процесса
+    queue_depth = worker_pool.queue_depth() + start_pool.queue_depth()
+    if shard_router is not None:
+        queue_depth += shard_router.queue_depth()
+    metrics = {
+        'queue_depth': queue_depth,
+        'loop_lag': round(loop_lag, 3) if loop_lag is not None else None,
+    }
+    failures = evaluate(metrics, HEALTH_THRESHOLDS)
+
+    tenants_health = {}
+    for tenant in tenants:
+        health = tenant_health(tenant, now)
+        failures.extend(f'{tenant.name}: {failure}' for failure in evaluate(health['metrics'], HEALTH_THRESHOLDS))
+        tenants_health[tenant.name] = health
+
+    body = {
+        'status': 'ok' if not failures else 'degraded',
+        'failures': failures,
+        'metrics': metrics,
+        'thresholds': HEALTH_THRESHOLDS,
+        'tenants': tenants_health,
+    }
+
+    # Обработчики опрашиваются фоновым heartbeat приёмника, здесь только его результаты
+    if shard_router is not None:
+        shards = []
+        for index, status in enumerate(shard_router.status):
+            shard_metrics = {'shard_heartbeat_age': _age(status['at'] or STARTED_AT, now)}
+            failures.extend(f'shard {index}: {failure}' for failure in evaluate(shard_metrics, HEALTH_THRESHOLDS))
+            shards.append(dict(shard_metrics, error=status['error']))
+        body['shards'] = shards
+        body['status'] = 'ok' if not failures else 'degraded'
+    return body, 200 if not failures else 503
+
+
+# Маршрут для проверки готовности (для оркестратора)
+@app.route('/healthz')
+def healthz():
+    return health_report()
+
+
+# Диагностика процесса доступна только с токеном DIAGNOSTICS_TOKEN;
+# без него маршруты диагностики отвечают 404
+DIAGNOSTICS_TOKEN = os.getenv('DIAGNOSTICS_TOKEN', '')
+memory_tracer = diagnostics.MemoryTracer()
+
+
+def require_diagnostics_token(view):
+    """Пропускает запрос только с верным токеном (?token= или заголовок X-Admin-Token)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.args.get('token') or request.headers.get('X-Admin-Token') or ''
+        if not DIAGNOSTICS_TOKEN or not hmac.compare_digest(token, DIAGNOSTICS_TOKEN):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def diagnostics_report(content: str, name: str) -> Response:
+    """Отдаёт отчёт диагностики как текстовый файл."""
+    file_name = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+    return Response(
+        content,
+        mimetype='text/plain',
+        headers={'Content-Disposition': f'attachment; filename={file_name}'}
+    )
+
+
+# Страница диагностики
+@app.route('/admin/diagnostics')
+@require_diagnostics_token
+def diagnostics_page():
+    return render_template(
+        'diagnostics.html',
+        token=request.args.get('token', ''),
+        tracing=memory_tracer.is_tracing,
+        max_profile_seconds=diagnostics.MAX_PROFILE_SECONDS,
+    )
+
+
+# Запуск и остановка трассировки памяти
+@app.route('/admin/diagnostics/tracemalloc/start')
+@require_diagnostics_token
+def diagnostics_tracemalloc_start():
+    memory_tracer.start(frames=request.args.get('frames', 1, type=int))
+    logger.warning('Трассировка памяти запущена')
+    return render_message('Трассировка памяти запущена',
+                          'Снимите отчёт после того, как память вырастет, и остановите трассировку.')
+
+
+@app.route('/admin/diagnostics/tracemalloc/stop')
+@require_diagnostics_token
+def diagnostics_tracemalloc_stop():
+    memory_tracer.stop()
+    logger.warning('Трассировка памяти остановлена')
+    return render_message('Трассировка памяти остановлена')
+
+
+@app.route('/admin/diagnostics/tracemalloc/diff')
+@require_diagnostics_token
+def diagnostics_tracemalloc_diff():
+    try:
+        report = memory_tracer.diff(limit=request.args.get('limit', 30, type=int))
+    except RuntimeError as e:
+        return render_message('Ошибка трассировки памяти', str(e)), 400
+    return diagnostics_report(report, 'tracemalloc')
+
+
+# Профилирование CPU всех потоков
+@app.route('/admin/diagnostics/profile')
+@require_diagnostics_token
+def diagnostics_profile():
+    seconds = request.args.get('seconds', 10, type=float)
+    interval = request.args.get('interval', 5, type=float) / 1000
+    return diagnostics_report(diagnostics.profile(seconds, interval=max(interval, 0.001)), 'profile')
+
+
+# Стеки всех потоков
+@app.route('/admin/diagnostics/threads')
+@require_diagnostics_token
+def diagnostics_threads():
+    return diagnostics_report(diagnostics.thread_dump(), 'threads')
+
+
+# Размеры структур в памяти
+@app.route('/admin/diagnostics/sizes')
+@require_diagnostics_token
+def diagnostics_sizes():
+    # Структуры выбранного в панели бота и общие для процесса очереди
+    tenant = tenants.current()
+    report = diagnostics.size_report(
+        structures={
+            'users.index': tenant.users.index,
+            'polling_engine._seen (недавние update_id)': tenant.polling_engine._seen,
+            'polling_engine._pending (необработанные обновления)': tenant.polling_engine._pending,
+            'worker_pool (очереди обработки)': worker_pool.queued_tasks(),
+            'start_pool (фоновые проверки /start)': start_pool.queued_tasks(),
+            'bot_settings': tenant.settings,
+            '_pdf_cache': tenant.pdf_cache,
+            '_channel_access_cache': tenant.channel_access_cache,
+            'logging queue': logging_state.handler.queue,
+        },
+        mappings={'users': tenant.users.snapshot()},
+        # Задачи в очередях ссылаются на бота, движок опроса и через контекст на
+        # всё состояние бота; считаются только сами задачи и их обновления
+        exclude=(telebot.TeleBot, Tenant, UserStore, PollingEngine),
+    )
+    return diagnostics_report(report, 'sizes')
+
+
 # Маршрут для мониторинга
 @app.route('/ping')
 def ping():
     return 'OK', 200
 
 
+# Асинхронный сервер панели управления (см. admin_server.py). Маршруты ниже
+# обслуживаются прямо в его цикле событий, остальные — Flask-приложением.
+ADMIN_SERVER = os.getenv('ADMIN_SERVER', 'flask').lower()
+if ADMIN_SERVER not in ('flask', 'aiohttp'):
+    raise ValueError(f'ADMIN_SERVER должен быть flask или aiohttp, получено: {ADMIN_SERVER}')
+ADMIN_WORKERS = int(os.getenv('ADMIN_WORKERS', 4))
+# Пользователей в одной части потокового экспорта
+EXPORT_CHUNK_SIZE = 1000
+
+admin_server = (AsyncAdminServer(app, port=int(os.environ.get('PORT', 8080)), workers=ADMIN_WORKERS)
+                if ADMIN_SERVER == 'aiohttp' else None)
+
+
+def request_tenant(request: web.Request) -> Tenant:
+    """Бот, выбранный в панели управления через ?tenant= или cookie (как в select_tenant)."""
+    return tenants.get(request.query.get('tenant') or request.cookies.get('tenant')) or tenants.default
+
+
+async def async_ping(request: web.Request) -> web.Response:
+    return web.Response(text='OK')
+
+
+async def async_healthz(request: web.Request) -> web.Response:
+    body, status = health_report()
+    return web.json_response(body, status=status)
+
+
+async def stream_users_export(request: web.Request, rows: Callable[[Dict[int, Dict[str, Any]]], Iterator[str]],
+                              content_type: str, file_name: str) -> web.StreamResponse:
+    """Отдаёт экспорт пользователей по частям; части готовятся в пуле потоков сервера."""
+    tenant = request_tenant(request)
+    snapshot = await admin_server.run_blocking(tenant.run, users_snapshot)
+
+    response = web.StreamResponse(headers={'Content-Type': content_type,
+                                           'Content-Disposition': f'attachment; filename={file_name}'})
+    await response.prepare(request)
+    parts = rows(snapshot)
+    while True:
+        chunk = await admin_server.run_blocking(lambda: ''.join(itertools.islice(parts, EXPORT_CHUNK_SIZE)))
+        if not chunk:
+            break
+        await response.write(chunk.encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def async_export_users(request: web.Request) -> web.StreamResponse:
+    return await stream_users_export(request, iter_users_csv, 'text/csv; charset=utf-8', 'users.csv')
+
+
+async def async_export_users_json(request: web.Request) -> web.StreamResponse:
+    return await stream_users_export(request, iter_users_json, 'application/json', 'users.json')
+
+
+async def async_publish_post_manually(request: web.Request) -> web.Response:
+    # Публикация идёт фоновой задачей: ответ с номером задачи возвращается сразу
+    tenant = request_tenant(request)
+    task_id = admin_server.start_task('publish_post', tenant.run, publish_post_to_channel_sync)
+    return web.json_response({'task_id': task_id, 'status_url': f'/admin/tasks/{task_id}'}, status=202)
+
+
+async def async_task_status(request: web.Request) -> web.Response:
+    task = admin_server.tasks.get(request.match_info['task_id'])
+    if task is None:
+        return web.json_response({'error': 'Задача не найдена'}, status=404)
+    return web.json_response(task)
+
+
+if admin_server is not None:
+    admin_server.add_route('GET', '/ping', async_ping)
+    admin_server.add_route('GET', '/healthz', async_healthz)
+    admin_server.add_route('GET', '/export-users', async_export_users)
+    admin_server.add_route('GET', '/export-users-json', async_export_users_json)
+    admin_server.add_route('GET', '/publish-post-manually', async_publish_post_manually)
+    admin_server.add_route('GET', '/admin/tasks/{task_id}', async_task_status)
+
+
 # Функция периодического сохранения данных пользователей
 def periodic_save():
     while True:
         time.sleep(60)  # Сохранение каждую минуту
-        try:
-            save_users()
-        except Exception as e:
-            logger.error(f'Ошибка при периодическом сохранении данных: {e}')
+        for tenant in tenants:
+            try:
+                tenant.run(save_users)
+                if tenant.catalog is not None:
+                    tenant.catalog.save()
+                tenant.outbox.compact()
+            except Exception as e:
+                logger.error(f'Ошибка при периодическом сохранении данных бота {tenant.name}: {e}')
+
+
+# Прогрев перед началом приёма обновлений
+SERVICE_CHAT_ID = os.getenv('SERVICE_CHAT_ID')
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 30))
+
+
+def warm_up_connections() -> str:
+    # Параллельные запросы открывают в пуле по соединению на каждый поток обработки
+    with ThreadPoolExecutor(max_workers=POLLING_WORKERS) as executor:
+        list(executor.map(lambda _: bot.get_me(), range(POLLING_WORKERS)))
+    return f'соединений: {POLLING_WORKERS}'
+
+
+def warm_up_channel() -> str:
+    channel_access = get_channel_access()
+    if not channel_access['success']:
+        raise Exception(channel_access['error'])
+    return f"канал {channel_access['channel_name']}, статус бота: {channel_access['status']}"
+
+
+def warm_up_pdf() -> str:
+    if tenants.current().catalog is not None:
+        raise SkipStep('материалы выдаются из каталога')
+    file_content = asyncio.run(get_pdf_content(bot_settings.current.bonus_pdf_url))
+    if not file_content.startswith(b'%PDF'):
+        raise Exception('файл по URL бонусного PDF не является PDF')
+    return f'{len(file_content)} байт'
+
+
+def warm_up_pdf_file_id() -> str:
+    if tenants.current().catalog is not None:
+        raise SkipStep('материалы выдаются из каталога')
+    url = bot_settings.current.bonus_pdf_url
+    if get_pdf_file_id(url):
+        return 'file_id уже известен'
+    if not SERVICE_CHAT_ID:
+        raise SkipStep('SERVICE_CHAT_ID не задан, файл загрузится при первой отправке')
+
+    # Загружаем файл один раз в служебный чат, дальше отправляем по file_id
+    file_content = asyncio.run(get_pdf_content(url))
+    message = bot.send_document(SERVICE_CHAT_ID, ('Чек-лист.pdf', file_content),
+                                caption='Прогрев бота', disable_notification=True)
+    remember_pdf_file_id(url, message)
+    return 'файл загружен в служебный чат'
+
+
+def download_asset(url: str) -> bytes:
+    status, _, content = asyncio.run(fetch_url(url))
+    if status != 200:
+        raise Exception(f'статус {status}')
+    return content
+
+
+def upload_asset(asset: Asset, content: bytes) -> Optional[str]:
+    """Загружает материал в служебный чат ради file_id; без SERVICE_CHAT_ID материал отправляется из памяти."""
+    if not SERVICE_CHAT_ID:
+        return None
+    message = bot.send_document(SERVICE_CHAT_ID, (asset.file_name, content),
+                                caption='Прогрев бота', disable_notification=True)
+    return message.document.file_id if message.document is not None else None
+
+
+def warm_up_assets() -> str:
+    catalog = tenants.current().catalog
+    if catalog is None:
+        raise SkipStep('каталог материалов не задан')
+    return catalog.prepare(download_asset, upload_asset)
+
+
+def build_warm_up(tenant: Tenant) -> WarmUp:
+    """Шаги прогрева бота; каждый шаг выполняется с этим ботом в роли текущего."""
+    warm_up = WarmUp(timeout=WARMUP_TIMEOUT)
+    warm_up.step('connections', functools.partial(tenant.run, warm_up_connections))
+    warm_up.step('channel', functools.partial(tenant.run, warm_up_channel))
+    warm_up.step('pdf', functools.partial(tenant.run, warm_up_pdf))
+    warm_up.step('pdf_file_id', functools.partial(tenant.run, warm_up_pdf_file_id))
+    warm_up.step('assets', functools.partial(tenant.run, warm_up_assets))
+    return warm_up
+
+
+for tenant in tenants:
+    tenant.warm_up = build_warm_up(tenant)
+
+
+def save_shard() -> int:
+    """Сохраняет пользователей обработчика по запросу приёмника; ошибка передаётся приёмнику."""
+    save_users()
+    if _save_state['error']:
+        raise RuntimeError(_save_state['error'])
+    return len(users)
+
+
+def shard_operations() -> Dict[str, Callable[..., Any]]:
+    """Операции, которые приёмник вызывает на обработчике (см. ShardServer)."""
+    return {
+        'stats': lambda: dict(user_stats(), save_age=_age(_save_state['succeeded_at'] or STARTED_AT, time.monotonic())),
+        'find_users': find_users,
+        'snapshot': lambda: dict(users.snapshot()),
+        'save': save_shard,
+        'clear': users.clear,
+        'reload_settings': bot_settings.reload,
+        'asset_counters': lambda: tenants.default.catalog.counters() if tenants.default.catalog is not None else {},
+        'analytics_funnel': analytics.funnel,
+        'analytics_cohorts': analytics.cohorts,
+        'analytics_sources': analytics.sources,
+        'traces': tracer.recent,
+    }
+
+
+def run_shard_worker() -> None:
+    """Процесс-обработчик: обрабатывает обновления своей доли пользователей, полученные от приёмника."""
+
+    # При первом запуске переносим свою долю пользователей из снимка однопроцессного бота
+    shared_snapshot = os.path.join(DATA_DIR, 'users.bin')
+    if (not os.path.exists(users.snapshot_file) and not os.path.exists(users.json_file)
+            and os.path.exists(shared_snapshot)):
+        count = import_shard(shared_snapshot, users.snapshot_file, SHARD_INDEX, SHARD_COUNT)
+        logger.info(f'Обработчик {SHARD_INDEX}: перенесено пользователей из общего снимка: {count}')
+
+    load_users()
+    analytics.start()
+    lag_monitor.start()
+    threading.Thread(target=periodic_save, name='periodic-save', daemon=True).start()
+    tenants.default.warm_up.run()
+    threading.Thread(target=replay_outbox, name='outbox-replay', daemon=True).start()
+
+    polling_engine.start_workers()
+    server = ShardServer(
+        socket_path(SHARDS_DIR, SHARD_INDEX),
+        SHARD_AUTHKEY,
+        on_update=lambda raw_update: polling_engine.dispatch(telebot.types.Update.de_json(raw_update)),
+        operations=shard_operations(),
+    )
+    logger.info(f'Обработчик {SHARD_INDEX} из {SHARD_COUNT} запущен')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        worker_pool.stop()
+        start_pool.stop()
 
 
 # Основная функция запуска приложения
 def main():
-    import threading
 
-    # Загружаем данные пользователей при запуске
-    load_users()
+    if SHARD_ROLE == 'worker':
+        run_shard_worker()
+        return
+
+    if SHARD_ROLE == 'ingress':
+        # Опрашивать Telegram может только один приёмник: резервный ждёт здесь,
+        # пока ведущий не завершится
+        leader_lock = LeaderLock(os.path.join(SHARDS_DIR, 'leader.lock'))
+        if not leader_lock.acquire(blocking=False):
+            logger.info('Ведущий приёмник уже работает, ожидаем освобождения блокировки')
+            leader_lock.acquire()
+        logger.info(f'Приёмник стал ведущим, обработчиков: {SHARD_COUNT}')
+        polling_engine.router = shard_router.route
+        shard_router.start_heartbeat()
+    else:
+        # Загружаем данные пользователей всех ботов при запуске и запускаем запись событий
+        # (на приёмнике события пишут обработчики)
+        for tenant in tenants:
+            tenant.run(load_users)
+            tenant.analytics.start()
+
+    # Компилируем шаблоны панели управления до первого запроса
+    precompile_templates()
+
+    # Замер задержки планирования для /healthz
+    lag_monitor.start()
 
     # Запускаем поток для периодического сохранения данных
-    save_thread = threading.Thread(target=periodic_save, daemon=True)
-    save_thread.start()
+    # (на приёмнике данные сохраняют сами обработчики)
+    if shard_router is None:
+        save_thread = threading.Thread(target=periodic_save, name='periodic-save', daemon=True)
+        save_thread.start()
 
     # Порт для веб-приложения
     port = int(os.environ.get('PORT', 8080))
 
-    # Запускаем flask-приложение в отдельном потоке
-    flask_thread = threading.Thread(
-        target=lambda: app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False),
-        daemon=True
-    )
-    flask_thread.start()
+    if admin_server is not None:
+        # Панель управления в цикле событий aiohttp (ADMIN_SERVER=aiohttp)
+        admin_server.start()
+    else:
+        # Запускаем flask-приложение в отдельном потоке
+        flask_thread = threading.Thread(
+            target=lambda: app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False),
+            name='flask',
+            daemon=True
+        )
+        flask_thread.start()
 
     logger.info(f'Сервер запущен на порту {port}')
-    logger.info('Бот запущен!')
-
-    # Запускаем бота (этот вызов блокирующий)
-    bot.polling(none_stop=True, interval=1)
+    logger.info(f'Бот запущен! Ботов в процессе: {len(tenants)}')
+
+    # Прогреваем кэши и соединения всех ботов до первого пользователя; при ошибке
+    # или таймауте бот всё равно запускается. Приёмник сам сообщения не отправляет,
+    # прогреваются обработчики.
+    if shard_router is None:
+        with ThreadPoolExecutor(max_workers=len(tenants)) as executor:
+            list(executor.map(lambda tenant: tenant.warm_up.run(), tenants))
+
+        # Повторяем доставки, прерванные прошлым остановом, в фоне, не задерживая опрос
+        for tenant in tenants:
+            threading.Thread(target=tenant.run, args=(replay_outbox,), name=f'outbox-replay-{tenant.name}',
+                             daemon=True).start()
+
+    # Включаем запись входящих обновлений для нагрузочного тестирования (replay.py)
+    if os.getenv('CAPTURE_UPDATES', '').lower() in ('1', 'true', 'yes'):
+        for tenant in tenants:
+            capture_file = os.path.join(tenant.data_dir, 'captures',
+                                        f"updates-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz")
+            tenant.polling_engine.recorder = UpdateRecorder(capture_file, salt=os.getenv('CAPTURE_SALT'))
+
+    # Запускаем очереди публикаций (при нескольких процессах — только на ведущем приёмнике)
+    for tenant in tenants:
+        tenant.scheduler.start()
+
+    # Каждый бот, кроме первого, опрашивает Telegram в своём потоке
+    for tenant in list(tenants)[1:]:
+        threading.Thread(target=tenant.polling_engine.run, name=f'polling-{tenant.name}', daemon=True).start()
+
+    # Запускаем опрос первого бота (этот вызов блокирующий)
+    try:
+        tenants.default.polling_engine.run()
+    except KeyboardInterrupt:
+        for tenant in tenants:
+            tenant.polling_engine.request_stop()
+        worker_pool.stop()
+        start_pool.stop()
 
 
 if __name__ == '__main__':
-    # Импортируем asyncio только здесь для совместимости
-    import asyncio
-
     main()
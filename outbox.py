@@ -0,0 +1,222 @@
+"""
+Журнал доставок: отправка файла подписчику переживает падение и перезапуск.
+
+Перед отправкой доставка записывается в журнал (add), после отправки
+отмечается завершённой (complete). Журнал — JSON-строки, только дописываются:
+
+    {"op": "add", "id": ..., "chat_id": ..., "user_id": ..., "asset": ..., "created_at": ...}
+    {"op": "done", "id": ..., "user_id": ..., "delivered": true, "at": ...}
+    {"op": "delivered", "user_id": ..., "at": ...}   (после сжатия журнала)
+
+Записи сбрасываются на диск фоновым потоком пачками: один fsync на все
+доставки, накопившиеся за commit_interval, поэтому add ждёт миллисекунды, а
+не отдельный fsync на каждую доставку. Отметки о завершении fsync не ждут.
+
+При запуске незавершённые доставки повторяются (replayable). Повтор не
+дублирует отправку: по каждому пользователю выполняется не больше одной
+доставки, а доставки, после которых пользователь уже получил файл,
+пропускаются. Если процесс упал между отправкой и записью отметки на диск,
+файл будет отправлен повторно — окно равно одному commit_interval.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз повторять доставку при запуске, прежде чем отказаться от неё
+MAX_REPLAY_ATTEMPTS = 3
+
+# Сколько ждать записи доставки на диск, прежде чем отправлять без неё, секунды
+COMMIT_TIMEOUT = 5
+
+
+class Outbox:
+    """Журнал доставок одного бота с групповым fsync."""
+
+    def __init__(self, path: str, commit_interval: float = 0.005):
+        self.path = path
+        self.commit_interval = commit_interval
+        # Незавершённые доставки и время последней завершённой доставки по пользователям
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.delivered_at: Dict[int, float] = {}
+        self._buffer: List[str] = []
+        self._appended = 0
+        self._synced = 0
+        self._records = 0
+        self._condition = threading.Condition()
+        # Запись в файл идёт без self._condition, чтобы доставки копились во время fsync
+        self._file_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._load()
+
+    # Хранение
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        if record['op'] == 'add':
+            self.pending[record['id']] = record
+        elif record['op'] == 'done':
+            entry = self.pending.pop(record['id'], None)
+            if record.get('delivered') and entry is not None:
+                self._mark_delivered(entry['user_id'], entry['created_at'])
+        elif record['op'] == 'delivered':
+            self._mark_delivered(record['user_id'], record['at'])
+
+    def _mark_delivered(self, user_id: int, created_at: float) -> None:
+        self.delivered_at[user_id] = max(self.delivered_at.get(user_id, 0), created_at)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # Недописанная строка после сбоя
+                        continue
+                    self._records += 1
+        except Exception as e:
+            logger.error(f'Ошибка загрузки журнала доставок: {e}')
+            return
+        if self.pending:
+            logger.info(f'В журнале доставок незавершённых доставок: {len(self.pending)}')
+
+    def _append(self, record: Dict[str, Any]) -> int:
+        """Добавляет запись в очередь на диск; возвращает её номер. Вызывается под self._condition."""
+        self._apply(record)
+        self._buffer.append(json.dumps(record, ensure_ascii=False) + '\n')
+        self._appended += 1
+        self._records += 1
+        self._condition.notify_all()
+        return self._appended
+
+    def _commit(self) -> None:
+        with self._condition:
+            while not self._buffer:
+                self._condition.wait()
+        # Ждём, пока соберутся доставки других потоков, и пишем их одним fsync
+        time.sleep(self.commit_interval)
+        with self._file_lock:
+            with self._condition:
+                lines, self._buffer = self._buffer, []
+                last = self._appended
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.writelines(lines)
+                file.flush()
+                os.fsync(file.fileno())
+        with self._condition:
+            self._synced = last
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._commit()
+            except Exception as e:
+                logger.error(f'Ошибка записи журнала доставок: {e}')
+                time.sleep(1)
+
+    def start(self) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='outbox-commit', daemon=True)
+                self._thread.start()
+
+    def compact(self) -> None:
+        """Переписывает журнал, оставляя только незавершённые доставки."""
+        with self._file_lock, self._condition:
+            if self._buffer or self._records <= len(self.pending):
+                return
+            try:
+                tmp_path = f'{self.path}.tmp'
+                # Состояние доставки сохраняется только для пользователей с незавершёнными доставками
+                waiting = {entry['user_id'] for entry in self.pending.values()}
+                delivered_at = {user_id: at for user_id, at in self.delivered_at.items() if user_id in waiting}
+                records = [{'op': 'delivered', 'user_id': user_id, 'at': at} for user_id, at in delivered_at.items()]
+                records.extend(self.pending.values())
+                with open(tmp_path, 'w', encoding='utf-8') as file:
+                    for record in records:
+                        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.path)
+                self._records = len(records)
+                self.delivered_at = delivered_at
+            except Exception as e:
+                logger.error(f'Ошибка сжатия журнала доставок: {e}')
+
+    # Доставки
+
+    def add(self, chat_id: int, user_id: int, asset: Optional[str] = None,
+            attempts: int = 0, created_at: Optional[float] = None) -> str:
+        """
+        Записывает доставку и ждёт, пока запись окажется на диске.
+
+        Args:
+            chat_id: Чат для отправки
+            user_id: Пользователь
+            asset: Материал каталога, если он выбран
+            attempts: Сколько раз доставка уже повторялась после перезапуска
+            created_at: Время исходной доставки для повтора (по умолчанию — сейчас)
+
+        Returns:
+            str: Номер доставки для complete
+        """
+        self.start()
+        entry = {'op': 'add', 'id': uuid.uuid4().hex[:12], 'chat_id': chat_id, 'user_id': user_id,
+                 'asset': asset, 'created_at': created_at or time.time(), 'attempts': attempts}
+        with self._condition:
+            number = self._append(entry)
+            if not self._condition.wait_for(lambda: self._synced >= number, COMMIT_TIMEOUT):
+                logger.error(f"Доставка {entry['id']} не записана на диск за {COMMIT_TIMEOUT} с, отправляем без записи")
+        return entry['id']
+
+    def complete(self, entry_id: str, delivered: bool) -> None:
+        """Отмечает доставку завершённой; не ждёт записи на диск."""
+        with self._condition:
+            entry = self.pending.get(entry_id)
+            if entry is None:
+                return
+            self._append({'op': 'done', 'id': entry_id, 'user_id': entry['user_id'],
+                          'delivered': delivered, 'at': time.time()})
+
+    def replayable(self) -> List[Dict[str, Any]]:
+        """
+        Незавершённые доставки для повтора: по одной на пользователя.
+
+        Доставки пользователя, уже получившего файл после их создания, и доставки,
+        исчерпавшие попытки, отмечаются завершёнными без отправки.
+        """
+        with self._condition:
+            entries = sorted(self.pending.values(), key=lambda entry: entry['created_at'])
+        latest: Dict[int, Dict[str, Any]] = {}
+        for entry in entries:
+            latest[entry['user_id']] = entry
+
+        replay = []
+        for entry in entries:
+            user_id = entry['user_id']
+            skip = (latest[user_id] is not entry
+                    or self.delivered_at.get(user_id, 0) >= entry['created_at']
+                    or entry.get('attempts', 0) >= MAX_REPLAY_ATTEMPTS)
+            if skip:
+                self.complete(entry['id'], False)
+            else:
+                replay.append(entry)
+        return replay
+
+    def retry(self, entry: Dict[str, Any]) -> str:
+        """Заменяет доставку новой записью с увеличенным счётчиком попыток перед повтором."""
+        new_id = self.add(entry['chat_id'], entry['user_id'], entry.get('asset'),
+                          attempts=entry.get('attempts', 0) + 1, created_at=entry['created_at'])
+        self.complete(entry['id'], False)
+        return new_id
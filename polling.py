@@ -0,0 +1,355 @@
+"""
+Движок long polling для бота.
+
+В отличие от bot.polling с фиксированным интервалом, движок:
+    - держит настоящий long poll (Telegram отвечает сразу, как появились обновления);
+    - забирает обновления пачками до 100 штук;
+    - раздаёт их пулу обработчиков по chat_id: сообщения одного чата
+      обрабатываются строго по порядку, разные чаты — параллельно;
+    - сохраняет в файл offset — update_id, до которого все обновления уже
+      обработаны, — и исходный JSON полученных, но ещё не обработанных
+      обновлений: Telegram больше не отдаёт их повторно, поэтому после
+      перезапуска они обрабатываются из файла;
+    - отбрасывает дубликаты по ограниченному LRU недавно виденных update_id;
+    - при необходимости передаёт исходные обновления в recorder (см. capture.py)
+      и трассирует их обработку через tracer (см. tracing.py).
+
+Несколько движков (по одному на бота) могут использовать общий пул потоков
+обработки WorkerPool.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import telebot
+from telebot import apihelper, types
+
+from structured_logging import update_context
+
+logger = logging.getLogger(__name__)
+
+# Как часто сохранять offset по мере обработки обновлений между запросами getUpdates, секунды
+SAVE_INTERVAL = 1.0
+
+
+def update_chat_id(update: types.Update) -> Optional[int]:
+    """Возвращает ID чата обновления или None, если его нельзя определить."""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        return update.callback_query.from_user.id
+    return None
+
+
+class WorkerPool:
+    """
+    Потоки обработки обновлений.
+
+    Задачи с одинаковым ключом выполняются одним потоком строго по порядку,
+    задачи с разными ключами — параллельно.
+    """
+
+    def __init__(self, workers: int = 8, name: str = 'polling-worker'):
+        self.name = name
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def _worker(self, worker_queue: queue.Queue) -> None:
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f'Ошибка в потоке обработки: {e}')
+            finally:
+                worker_queue.task_done()
+
+    def submit(self, key: Hashable, func: Callable, *args: Any) -> None:
+        """Ставит задачу в очередь потока, закреплённого за ключом."""
+        self._queues[hash(key) % len(self._queues)].put((func, args))
+
+    def queue_depth(self) -> int:
+        """Количество задач, ожидающих обработки."""
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def queued_tasks(self) -> List[Tuple[Callable, Tuple[Any, ...]]]:
+        """Задачи, ожидающие обработки (для диагностики)."""
+        tasks = []
+        for worker_queue in self._queues:
+            with worker_queue.mutex:
+                tasks.extend(item for item in worker_queue.queue if item is not None)
+        return tasks
+
+    def join(self) -> None:
+        """Дожидается выполнения всех поставленных задач."""
+        for worker_queue in self._queues:
+            worker_queue.join()
+
+    def start(self) -> None:
+        """Запускает потоки обработки (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._threads:
+                return
+            for number, worker_queue in enumerate(self._queues):
+                worker = threading.Thread(target=self._worker, args=(worker_queue,),
+                                          name=f'{self.name}-{number}', daemon=True)
+                worker.start()
+                self._threads.append(worker)
+
+    def stop(self, drain_timeout: float = 30) -> None:
+        """Дожидается выполнения уже поставленных задач и останавливает потоки."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        deadline = time.monotonic() + drain_timeout
+        for worker in self._threads:
+            worker.join(max(deadline - time.monotonic(), 0))
+
+
+class PollingEngine:
+    """Long polling с пакетной выборкой, параллельной обработкой и сохранением offset."""
+
+    def __init__(self, bot: telebot.TeleBot, offset_file: str,
+                 long_polling_timeout: int = 50, batch_size: int = 100,
+                 workers: int = 8, seen_size: int = 10000,
+                 pool: Optional[WorkerPool] = None, name: Optional[str] = None,
+                 context: Optional[Dict[contextvars.ContextVar, Any]] = None):
+        self.bot = bot
+        self.offset_file = offset_file
+        self.long_polling_timeout = long_polling_timeout
+        self.batch_size = batch_size
+        self.seen_size = seen_size
+        # Имя бота для логов и переменные контекста, которые выставляются на время
+        # обработки каждого обновления (например, текущий бот, когда в процессе их несколько)
+        self.name = name
+        self.context = context or {}
+        self.pool = pool or WorkerPool(workers)
+
+        # offset следующего запроса getUpdates; подтверждённый offset в файле может отставать от него
+        self.offset: Optional[int] = None
+        # Время последнего успешного ответа getUpdates (time.monotonic)
+        self.last_poll_at: Optional[float] = None
+
+        # Запись входящих обновлений (UpdateRecorder) и обратный вызов после
+        # обработки каждого обновления с временем от постановки в очередь
+        self.recorder = None
+        self.on_processed: Optional[Callable[[types.Update, float], None]] = None
+        # Трассировка обработки обновлений (tracing.Tracer)
+        self.tracer = None
+        # Если задан, исходные обновления передаются ему вместо локальной обработки
+        # (приёмник при работе в нескольких процессах, см. sharding.py); второй
+        # аргумент вызывается с update_id, когда обновление передано
+        self.router: Optional[Callable[[Dict[str, Any], Callable[[int], None]], None]] = None
+
+        self._seen: OrderedDict = OrderedDict()
+        self._stop = threading.Event()
+        # Полученные, но ещё не обработанные обновления (update_id -> исходный JSON) по возрастанию update_id
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._offset_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._saved_at = 0.0
+        self._save_timer: Optional[threading.Timer] = None
+
+    # Offset
+
+    def _load_offset(self) -> Optional[int]:
+        """Читает offset и возвращает его; необработанные обновления из файла попадают в self._pending."""
+        if not os.path.exists(self.offset_file):
+            return None
+        try:
+            with open(self.offset_file, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            pending = data.get('pending', [])
+            with self._offset_lock:
+                self._pending = {raw_update['update_id']: raw_update for raw_update in pending}
+            offset = data.get('fetch_offset', data['offset'])
+            logger.info(f'Продолжаем получение обновлений с update_id {offset}, '
+                        f'необработанных обновлений: {len(pending)}')
+            return offset
+        except Exception as e:
+            logger.error(f'Ошибка чтения offset обновлений: {e}')
+            return None
+
+    def _save_offset(self) -> None:
+        try:
+            directory = os.path.dirname(self.offset_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+
+            # Сохраняют и поток опроса, и потоки обработки: запись в файл по очереди,
+            # чтобы более старое состояние не перезаписало новое
+            with self._save_lock:
+                with self._offset_lock:
+                    self._save_timer = None
+                    pending = list(self._pending.values())
+                    data = {'offset': next(iter(self._pending), self.offset),
+                            'fetch_offset': self.offset, 'pending': pending}
+                    self._saved_at = time.monotonic()
+                tmp_path = f'{self.offset_file}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as file:
+                    json.dump(data, file, ensure_ascii=False)
+                os.replace(tmp_path, self.offset_file)
+        except Exception as e:
+            logger.error(f'Ошибка сохранения offset обновлений: {e}')
+
+    def _complete(self, update_id: int) -> None:
+        """Отмечает обновление обработанным и сохраняет состояние (не чаще SAVE_INTERVAL)."""
+        with self._offset_lock:
+            if self._pending.pop(update_id, None) is None or self._save_timer is not None:
+                return
+            delay = max(self._saved_at + SAVE_INTERVAL - time.monotonic(), 0)
+            self._save_timer = threading.Timer(delay, self._save_offset)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    # Дубликаты
+
+    def _is_duplicate(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            return True
+        self._seen[update_id] = True
+        if len(self._seen) > self.seen_size:
+            self._seen.popitem(last=False)
+        return False
+
+    # Обработка
+
+    def queue_depth(self) -> int:
+        """Количество обновлений, ожидающих обработки (во всём пуле потоков)."""
+        return self.pool.queue_depth()
+
+    def _process(self, update: types.Update, enqueued_at: float) -> None:
+        tokens = [(var, var.set(value)) for var, value in self.context.items()]
+        log_context = {'update_id': update.update_id, 'user_id': update_chat_id(update)}
+        if self.name:
+            log_context['tenant'] = self.name
+        tokens.append((update_context, update_context.set(log_context)))
+        started = time.monotonic()
+        trace = (self.tracer.trace('update', queued_ms=round((started - enqueued_at) * 1000, 1), **log_context)
+                 if self.tracer is not None else contextlib.nullcontext())
+        try:
+            with trace:
+                self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f'Ошибка обработки обновления {update.update_id}: {e}')
+        finally:
+            finished = time.monotonic()
+            logger.debug('Обновление %s обработано за %.1f мс', update.update_id, (finished - started) * 1000,
+                         extra={'event': 'update_processed',
+                                'duration_ms': round((finished - started) * 1000, 1)})
+            for var, token in reversed(tokens):
+                var.reset(token)
+            self._complete(update.update_id)
+            if self.on_processed is not None:
+                self.on_processed(update, finished - enqueued_at)
+
+    def dispatch(self, update: types.Update) -> None:
+        """Передаёт обновление обработчику, закреплённому за его чатом."""
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update.update_id
+        self.pool.submit((id(self), key), self._process, update, time.monotonic())
+
+    def join(self) -> None:
+        """Дожидается обработки всех переданных обновлений."""
+        self.pool.join()
+
+    def start_workers(self) -> None:
+        """Запускает потоки обработки обновлений."""
+        self.pool.start()
+
+    # Цикл опроса
+
+    def _hand_off(self, raw_update: Dict[str, Any]) -> None:
+        with self._offset_lock:
+            self._pending[raw_update['update_id']] = raw_update
+        if self.router is not None:
+            # Приёмник считает обновление обработанным, когда обработчик подтвердил приём
+            self.router(raw_update, self._complete)
+            return
+        self.dispatch(types.Update.de_json(raw_update))
+
+    def poll_once(self) -> int:
+        """
+        Выполняет один запрос getUpdates и раздаёт полученные обновления.
+
+        Returns:
+            int: Количество новых (не повторных) обновлений
+        """
+        # Запрашиваем исходный JSON, чтобы его можно было записать без потерь
+        raw_updates = apihelper.get_updates(
+            self.bot.token,
+            offset=self.offset,
+            limit=self.batch_size,
+            timeout=self.long_polling_timeout + 10,
+            long_polling_timeout=self.long_polling_timeout,
+        )
+        self.last_poll_at = time.monotonic()
+        if not raw_updates:
+            return 0
+
+        dispatched = 0
+        for raw_update in raw_updates:
+            if self._is_duplicate(raw_update['update_id']):
+                logger.warning(f'Пропущено повторное обновление {raw_update["update_id"]}')
+                continue
+            if self.recorder is not None:
+                self.recorder.record(raw_update)
+            self._hand_off(raw_update)
+            dispatched += 1
+
+        # Следующий запрос с этим offset подтверждает обновления для Telegram,
+        # поэтому необработанные из них сохраняются в файл вместе с offset
+        self.offset = raw_updates[-1]['update_id'] + 1
+        self._save_offset()
+        return dispatched
+
+    def run(self) -> None:
+        """Запускает опрос; блокирует поток до вызова stop()."""
+        self.offset = self._load_offset()
+        self.start_workers()
+
+        # Обновления, полученные до перезапуска, но не обработанные
+        with self._offset_lock:
+            pending, self._pending = list(self._pending.values()), {}
+        for raw_update in pending:
+            self._is_duplicate(raw_update['update_id'])
+            self._hand_off(raw_update)
+
+        errors = 0
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                delay = min(2 ** errors, 60)
+                logger.error(f'Ошибка получения обновлений: {e}. Повтор через {delay} с')
+                self._stop.wait(delay)
+
+    def request_stop(self) -> None:
+        """Останавливает опрос, не дожидаясь обработки полученных обновлений."""
+        self._stop.set()
+
+    def stop(self, drain_timeout: float = 30) -> None:
+        """Останавливает опрос и дожидается обработки уже полученных обновлений."""
+        self.request_stop()
+        self.pool.stop(drain_timeout)
+        if self.offset is not None:
+            self._save_offset()
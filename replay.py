@@ -0,0 +1,225 @@
+"""
+Воспроизведение записанных обновлений для нагрузочного тестирования.
+
+Обновления, записанные с CAPTURE_UPDATES=1 (см. capture.py), прогоняются через
+обработчики main.py так же, как в работе: через PollingEngine с распределением
+по чатам. Вместо Telegram используется локальный фейковый Bot API, который
+отвечает на вызовы бота с заданной задержкой и отдаёт тестовый PDF.
+
+Пример:
+    python replay.py .data/captures/updates-20260101-120000.ndjson.gz --speed 10x
+
+Скорость: realtime — с исходными интервалами, Nx — в N раз быстрее,
+max — без пауз. Данные бота пишутся во временный каталог и не затрагивают .data.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from capture import read_capture
+
+FAKE_PDF = b'%PDF-1.4\n% replay\n' + b'0' * 64 * 1024 + b'\n%%EOF\n'
+
+
+class FakeBotApi:
+    """Минимальный фейковый Bot API для обработчиков main.py."""
+
+    def __init__(self, latency: float = 0.0, member_status: str = 'member'):
+        self.latency = latency
+        self.member_status = member_status
+        self.calls: Counter = Counter()
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                api.handle(self)
+
+            def do_POST(self):
+                api.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='fake-bot-api', daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _message(self, params: Dict[str, str]) -> Dict[str, Any]:
+        chat_id = int(params.get('chat_id', 0)) if params.get('chat_id', '').lstrip('-').isdigit() else 0
+        return {'message_id': self._next_message_id(), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}}
+
+    def result(self, method: str, params: Dict[str, str]) -> Any:
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        if method == 'getChat':
+            return {'id': -1001, 'type': 'channel', 'title': 'Replay', 'username': 'replay_channel'}
+        if method == 'getChatMember':
+            return {'status': self.member_status,
+                    'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'user'}}
+        if method in ('deleteMessage', 'answerCallbackQuery'):
+            return True
+        message = self._message(params)
+        if method == 'sendDocument':
+            # Как и Telegram, возвращаем file_id, по которому файл можно отправить повторно
+            message['document'] = {'file_id': 'replay-document', 'file_unique_id': 'replay-document'}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'replay-photo', 'file_unique_id': 'replay-photo', 'width': 1280, 'height': 720}]
+        return message
+
+    def handle(self, request: BaseHTTPRequestHandler) -> None:
+        url = urlparse(request.path)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if url.path == '/bonus.pdf':
+            request.send_response(200)
+            request.send_header('Content-Type', 'application/pdf')
+            request.send_header('Content-Length', str(len(FAKE_PDF)))
+            request.end_headers()
+            request.wfile.write(FAKE_PDF)
+            return
+
+        # Тело запроса (в том числе multipart с файлом) читаем, но не разбираем
+        length = int(request.headers.get('Content-Length') or 0)
+        if length:
+            request.rfile.read(length)
+
+        method = url.path.rsplit('/', 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self._lock:
+            self.calls[method] += 1
+
+        body = json.dumps({'ok': True, 'result': self.result(method, params)}).encode()
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+
+def parse_speed(value: str) -> Optional[float]:
+    """Преобразует скорость воспроизведения в множитель (None — без пауз)."""
+    if value == 'max':
+        return None
+    if value == 'realtime':
+        return 1.0
+    if value.endswith('x'):
+        value = value[:-1]
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('Скорость должна быть больше нуля')
+    return speed
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def replay(capture_file: str, speed: Optional[float], api: FakeBotApi) -> Dict[str, Any]:
+    """Воспроизводит запись и возвращает отчёт о задержках и пропускной способности."""
+    # Импортируем бота только после подмены адреса Bot API и рабочего каталога
+    from telebot import apihelper, types
+    apihelper.API_URL = api.base_url + '/bot{0}/{1}'
+
+    import main
+
+    latencies: List[float] = []
+    latencies_lock = threading.Lock()
+
+    def on_processed(update, seconds: float) -> None:
+        with latencies_lock:
+            latencies.append(seconds)
+
+    engine = main.polling_engine
+    engine.on_processed = on_processed
+    engine.start_workers()
+
+    records = list(read_capture(capture_file))
+    started = time.monotonic()
+    first_ts = records[0]['ts'] if records else 0.0
+    for record in records:
+        if speed is not None:
+            delay = started + (record['ts'] - first_ts) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        engine.dispatch(types.Update.de_json(record['update']))
+
+    engine.join()
+    elapsed = time.monotonic() - started
+
+    return {
+        'updates': len(records),
+        'seconds': round(elapsed, 3),
+        'throughput_per_second': round(len(records) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 1),
+            'p90': round(percentile(latencies, 0.90) * 1000, 1),
+            'p99': round(percentile(latencies, 0.99) * 1000, 1),
+            'max': round(max(latencies, default=0.0) * 1000, 1),
+        },
+        'api_calls': dict(api.calls),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных обновлений бота')
+    parser.add_argument('capture_file', help='Файл записи (.ndjson.gz)')
+    parser.add_argument('--speed', type=parse_speed, default=None,
+                        help='realtime, Nx (например 10x) или max (по умолчанию max)')
+    parser.add_argument('--api-latency', type=float, default=50,
+                        help='Задержка ответа фейкового Bot API, миллисекунды')
+    parser.add_argument('--member-status', default='member',
+                        help='Статус подписки, который возвращает getChatMember (member, left, ...)')
+    parser.add_argument('--workers', type=int, default=None, help='Количество потоков обработки')
+    args = parser.parse_args()
+
+    capture_file = os.path.abspath(args.capture_file)
+    api = FakeBotApi(latency=args.api_latency / 1000, member_status=args.member_status)
+
+    # Бот работает во временном каталоге с фейковыми токеном и каналом
+    os.chdir(tempfile.mkdtemp(prefix='replay-'))
+    os.environ['BOT_TOKEN'] = '0:replay'
+    os.environ.setdefault('CHANNEL_ID', '@replay_channel')
+    os.environ.setdefault('BOT_USERNAME', 'replay_bot')
+    os.environ['BONUS_PDF_URL'] = api.base_url + '/bonus.pdf'
+    if args.workers:
+        os.environ['POLLING_WORKERS'] = str(args.workers)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        report = replay(capture_file, args.speed, api)
+    finally:
+        api.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""
+Отложенная публикация поста в несколько каналов.
+
+Публикация — это задание: готовый пост, время публикации и список каналов.
+Задания хранятся в JSON-файле бота и переживают перезапуск. Фоновый поток
+забирает наступившие задания и рассылает пост:
+    - пост с фото сначала отправляется в один канал, а file_id загруженного
+      фото используется для остальных, чтобы Telegram не скачивал фото заново;
+    - остальные каналы обслуживаются параллельно, но не быстрее rate
+      сообщений в секунду на всё задание;
+    - результат сохраняется по каждому каналу; каналы с ошибкой повторяются
+      через retry_delay * 2^попытка секунд (или через retry_after от Telegram),
+      пока не исчерпаны попытки.
+
+Канал, которому пост ушёл, но результат не успел сохраниться до падения
+процесса, после перезапуска получит пост повторно.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+# Сколько завершённых заданий хранится для просмотра в панели
+MAX_FINISHED_JOBS = 100
+
+# Статусы, в которых задание ещё будет выполняться
+ACTIVE_STATUSES = ('scheduled', 'running', 'retrying')
+
+
+class RateLimiter:
+    """Не больше rate вызовов acquire в секунду на все потоки."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            slot = max(time.monotonic(), self._next_at)
+            self._next_at = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Откладывает следующие вызовы acquire на seconds секунд."""
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+# Методы Bot API, которые отправляют или правят сообщения и подпадают под предел отправки
+SEND_METHOD_PREFIXES = ('send', 'copy', 'forward', 'edit')
+
+
+class OutboundLimiter:
+    """
+    Предел исходящих сообщений, общий для всех ботов процесса.
+
+    Telegram ограничивает отправку для каждого бота (около 30 сообщений в
+    секунду), поэтому у каждого бота своя очередь RateLimiter, а сам предел
+    один на процесс: обработчики, фоновые проверки и рассылки всех ботов
+    проходят через него. После ответа 429 отправка бота приостанавливается
+    на retry_after секунд.
+    """
+
+    def __init__(self, rate: float = 30):
+        self.rate = rate
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+
+    def _limiter(self, bot_key: str) -> RateLimiter:
+        with self._lock:
+            limiter = self._limiters.get(bot_key)
+            if limiter is None:
+                limiter = self._limiters[bot_key] = RateLimiter(self.rate)
+            return limiter
+
+    def acquire(self, bot_key: str) -> None:
+        """Ждёт очереди на отправку сообщения ботом."""
+        self._limiter(bot_key).acquire()
+
+    def pause(self, bot_key: str, seconds: float) -> None:
+        """Откладывает следующие отправки бота на seconds секунд."""
+        self._limiter(bot_key).pause(seconds)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Пауза, которую Telegram просит выдержать после ошибки 429, или None."""
+    if isinstance(error, apihelper.ApiTelegramException):
+        return ((error.result_json or {}).get('parameters') or {}).get('retry_after')
+    return None
+
+
+class PostScheduler:
+    """
+    Очередь публикаций одного бота.
+
+    send(канал, пост, фото) отправляет пост и возвращает ID сообщения и file_id
+    отправленного фото; фото — URL или file_id, None для текстового поста.
+    """
+
+    def __init__(self, store_file: str,
+                 send: Callable[[str, Dict[str, Any], Optional[str]], Tuple[int, Optional[str]]],
+                 rate: float = 20, concurrency: int = 4, max_attempts: int = 5,
+                 retry_delay: float = 30, name: Optional[str] = None):
+        self.store_file = store_file
+        self.send = send
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.name = name
+        self.jobs: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._load()
+
+    # Хранение
+
+    def _load(self) -> None:
+        if not os.path.exists(self.store_file):
+            return
+        try:
+            with open(self.store_file, 'r', encoding='utf-8') as file:
+                jobs = json.load(file)
+        except Exception as e:
+            logger.error(f'Ошибка загрузки очереди публикаций: {e}')
+            return
+
+        for job in jobs:
+            # Задание, прерванное перезапуском, продолжается с неотправленных каналов
+            if job['status'] == 'running':
+                job['status'] = 'scheduled'
+            self.jobs[job['id']] = job
+        active = sum(1 for job in self.jobs.values() if job['status'] in ACTIVE_STATUSES)
+        logger.info(f'Загружена очередь публикаций: заданий {len(self.jobs)}, ожидают {active}')
+
+    def _save(self) -> None:
+        """Сохраняет очередь; вызывается под self._lock."""
+        try:
+            directory = os.path.dirname(self.store_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            tmp_path = f'{self.store_file}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(list(self.jobs.values()), file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.store_file)
+        except Exception as e:
+            logger.error(f'Ошибка сохранения очереди публикаций: {e}')
+
+    def _trim(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] not in ACTIVE_STATUSES]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    # Задания
+
+    def schedule(self, post: Dict[str, Any], targets: List[str], publish_at: Optional[float] = None) -> str:
+        """
+        Ставит пост в очередь публикации.
+
+        Args:
+            post: Пост: text, image_url и reply_markup (JSON клавиатуры)
+            targets: Каналы для публикации
+            publish_at: Время публикации (time.time()); None — как можно скорее
+
+        Returns:
+            str: Номер задания
+        """
+        if not targets:
+            raise ValueError('Не задан ни один канал для публикации')
+
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            'created_at': now,
+            'publish_at': publish_at if publish_at is not None else now,
+            'status': 'scheduled',
+            'attempt': 0,
+            'post': post,
+            'photo_file_id': None,
+            'results': {target: {'status': 'pending', 'message_id': None, 'error': None, 'attempts': 0}
+                        for target in targets},
+        }
+        with self._lock:
+            self.jobs[job['id']] = job
+            self._trim()
+            self._save()
+        self._wakeup.set()
+        logger.info(f"Публикация {job['id']} запланирована в {len(targets)} каналов")
+        return job['id']
+
+    def cancel(self, job_id: str) -> bool:
+        """Отменяет задание, которое ещё не выполняется."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] not in ('scheduled', 'retrying'):
+                return False
+            job['status'] = 'cancelled'
+            self._save()
+        return True
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """Задания, начиная с последнего созданного."""
+        with self._lock:
+            return json.loads(json.dumps(list(reversed(self.jobs.values()))))
+
+    def last_targets(self) -> List[str]:
+        """Каналы последнего задания — значение по умолчанию для формы публикации."""
+        with self._lock:
+            for job in reversed(self.jobs.values()):
+                return list(job['results'])
+        return []
+
+    # Выполнение
+
+    def _send_target(self, job: Dict[str, Any], target: str, photo: Optional[str],
+                     limiter: RateLimiter) -> Optional[float]:
+        """Отправляет пост в один канал; возвращает retry_after при ошибке 429."""
+        limiter.acquire()
+        try:
+            message_id, photo_file_id = self.send(target, job['post'], photo)
+            update = {'status': 'ok', 'message_id': message_id, 'error': None, 'sent_at': time.time()}
+            delay = None
+        except Exception as e:
+            logger.error(f"Ошибка публикации {job['id']} в канал {target}: {e}")
+            photo_file_id = None
+            update = {'status': 'failed', 'error': str(e)}
+            delay = retry_after(e)
+
+        # Задание сохраняется другими потоками рассылки, поэтому меняется только под блокировкой
+        with self._lock:
+            result = job['results'][target]
+            result.update(update, attempts=result['attempts'] + 1)
+            if photo_file_id and not job['photo_file_id']:
+                job['photo_file_id'] = photo_file_id
+            self._save()
+        return delay
+
+    def _run_job(self, job: Dict[str, Any]) -> None:
+        pending = [target for target, result in job['results'].items() if result['status'] != 'ok']
+        limiter = RateLimiter(self.rate)
+        delays = []
+
+        # Фото загружается один раз: сначала один канал, дальше по file_id
+        image_url = job['post'].get('image_url')
+        if image_url and not job['photo_file_id'] and pending:
+            delays.append(self._send_target(job, pending.pop(0), image_url, limiter))
+        photo = job['photo_file_id'] or image_url or None
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='post-publish') as executor:
+                delays.extend(executor.map(lambda target: self._send_target(job, target, photo, limiter), pending))
+
+        self._finish_attempt(job, delays)
+
+    def _finish_attempt(self, job: Dict[str, Any], delays: List[Optional[float]]) -> None:
+        """Завершает попытку: задание выполнено, повторяется позже или исчерпало попытки."""
+        failed = [target for target, result in job['results'].items() if result['status'] != 'ok']
+        with self._lock:
+            job['attempt'] += 1
+            if not failed:
+                job['status'] = 'done'
+            elif job['attempt'] < self.max_attempts:
+                delay = max([d for d in delays if d] + [self.retry_delay * 2 ** (job['attempt'] - 1)])
+                job['status'] = 'retrying'
+                job['publish_at'] = time.time() + delay
+            else:
+                job['status'] = 'partial' if len(failed) < len(job['results']) else 'failed'
+            self._save()
+
+        logger.info(f"Публикация {job['id']}: {job['status']}, "
+                    f"успешно {len(job['results']) - len(failed)} из {len(job['results'])}")
+
+    def _execute(self, job: Dict[str, Any]) -> None:
+        try:
+            self._run_job(job)
+        except Exception as e:
+            logger.error(f"Ошибка выполнения публикации {job['id']}: {e}")
+            # Иначе задание осталось бы в статусе running до перезапуска
+            self._finish_attempt(job, [])
+
+    def _next_due(self) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        """Наступившее задание или время до ближайшего."""
+        now = time.time()
+        wait = None
+        with self._lock:
+            for job in self.jobs.values():
+                if job['status'] not in ('scheduled', 'retrying'):
+                    continue
+                if job['publish_at'] <= now:
+                    job['status'] = 'running'
+                    self._save()
+                    return job, None
+                until = job['publish_at'] - now
+                wait = until if wait is None else min(wait, until)
+        return None, wait
+
+    def run(self) -> None:
+        while True:
+            job, wait = self._next_due()
+            if job is not None:
+                self._execute(job)
+                continue
+
+            # Новое задание будит поток раньше срока
+            self._wakeup.wait(min(wait, 60) if wait is not None else 60)
+            self._wakeup.clear()
+
+    def start(self) -> None:
+        if self._thread is None:
+            thread_name = f'post-scheduler-{self.name}' if self.name else 'post-scheduler'
+            self._thread = threading.Thread(target=self.run, name=thread_name, daemon=True)
+            self._thread.start()
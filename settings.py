@@ -0,0 +1,258 @@
+"""
+Неизменяемый версионированный снимок настроек бота.
+
+Настройки, которые меняются из панели управления (URL PDF, пост для канала),
+вместе со всеми производными от них частями — текстами сообщений, готовыми
+клавиатурами, уже сериализованными в JSON, и отрисованным постом — собираются
+в один неизменяемый объект Settings. При изменении строится новый снимок
+с увеличенной версией и атомарно подменяет старый, поэтому обработчики,
+взявшие снимок один раз в начале, никогда не видят наполовину обновлённую
+конфигурацию и не собирают клавиатуры на каждое сообщение.
+"""
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, Any
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+# Настройки, которые можно изменить из панели управления
+EDITABLE_FIELDS = (
+    'bonus_pdf_url',
+    'image_url',
+    'channel_post_title',
+    'channel_post_description',
+    'channel_post_call',
+    'channel_link',
+    'channel_button_text',
+)
+
+
+def format_description(text: str) -> str:
+    """Преобразует описание со *звездочками* и тегами <br> в HTML для Telegram."""
+    text = (text
+            .replace('\r\n', '\n')
+            .replace('<br>', '\n')
+            .replace('<br/>', '\n')
+            .replace('<br />', '\n'))
+    # Несколько пустых строк подряд схлопываются в одну
+    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    return ''.join(f'<b>{part}</b>' if i % 2 else part
+                   for i, part in enumerate(text.split('*')))
+
+
+def html_to_editable(text: str) -> str:
+    """Преобразует HTML-теги в звездочки для редактирования."""
+    if not text:
+        return ''
+
+    # Заменяем <b> теги на звездочки
+    text = text.replace('<b>', '*').replace('</b>', '*')
+
+    # Заменяем разные виды <br> на переносы строк
+    text = text.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
+
+    return text
+
+
+def build_post_text(values: Dict[str, str]) -> str:
+    """Формирует HTML-текст поста для канала."""
+    # Проверяем наличие тегов <b> и убеждаемся, что они корректно парные
+    clean_description = values['channel_post_description']
+
+    # Подсчитываем количество открывающих и закрывающих тегов
+    open_tags = clean_description.count('<b>')
+    close_tags = clean_description.count('</b>')
+
+    # Если количество не совпадает, используем более безопасный метод
+    if open_tags != close_tags:
+        logger.warning(f'Неравное количество тегов <b> ({open_tags}) и </b> ({close_tags}). Переформатируем.')
+        # Удаляем все существующие теги <b> и заново применяем форматирование
+        clean_description = clean_description.replace('<b>', '').replace('</b>', '')
+        clean_description = ''.join(f'<b>{part}</b>' if i % 2 else part
+                                    for i, part in enumerate(clean_description.split('*')))
+
+    return (f"<b>{values['channel_post_title']}</b>\n\n{clean_description}\n\n"
+            f"<b>{values['channel_post_call']}</b>\n\n"
+            f"Создавайте уютный и функциональный дом \n"
+            f"вместе с <a href=\"{values['channel_link']}\">Уютные метры</a>🏡")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Снимок настроек со всеми заранее собранными частями сообщений."""
+    version: int
+
+    # Редактируемые настройки
+    bonus_pdf_url: str
+    image_url: str
+    channel_post_title: str
+    channel_post_description: str
+    channel_post_call: str
+    channel_link: str
+    channel_button_text: str
+
+    # Готовые тексты сообщений
+    checklist_button_text: str
+    welcome_message: str
+    start_message: str
+    subscription_request: str
+    reminder_message: str
+    pdf_message: str
+    pdf_message_repeat: str
+    pdf_caption: str
+    pdf_link_message: str
+    pdf_error_message: str
+
+    # Готовые клавиатуры, уже сериализованные в JSON
+    checklist_keyboard: str
+    subscription_keyboard: str
+    post_keyboard: str
+
+    # Готовый пост для канала и фрагменты для панели управления
+    post_text: str
+    post_preview: str
+    editable_description: str
+
+    def editable_values(self) -> Dict[str, str]:
+        return {name: getattr(self, name) for name in EDITABLE_FIELDS}
+
+
+class SettingsManager:
+    """
+    Хранит текущий снимок настроек и публикует новые версии.
+
+    Чтение — это одно обращение к атрибуту current, без блокировок.
+    Обновления сериализуются блокировкой, сохраняются на диск и только
+    после этого становятся видны обработчикам.
+    """
+
+    def __init__(self, settings_file: str, defaults: Dict[str, str], config: Dict[str, str],
+                 channel_id: str, bot_username: str):
+        self.settings_file = settings_file
+        self._config = config
+        self._channel_id = channel_id
+        self._bot_username = bot_username
+        self._lock = threading.Lock()
+
+        values = {name: defaults.get(name) or '' for name in EDITABLE_FIELDS}
+        version = 1
+        stored = self._read_file()
+        if stored:
+            values.update({name: stored[name] for name in EDITABLE_FIELDS if name in stored})
+            version = stored.get('version', version)
+
+        self.current: Settings = self._build(version, values)
+
+    def _read_file(self) -> Dict[str, Any]:
+        if not os.path.exists(self.settings_file):
+            return {}
+        try:
+            with open(self.settings_file, 'r', encoding='utf-8') as file:
+                stored = json.load(file)
+            logger.info(f'Загружены настройки версии {stored.get("version")}')
+            return stored
+        except Exception as e:
+            logger.error(f'Ошибка загрузки настроек: {e}')
+            return {}
+
+    def _write_file(self, settings: Settings) -> None:
+        directory = os.path.dirname(self.settings_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        data = {'version': settings.version, **settings.editable_values()}
+        tmp_path = f'{self.settings_file}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.settings_file)
+
+    def _build(self, version: int, values: Dict[str, str]) -> Settings:
+        config = self._config
+        channel_id = self._channel_id
+        channel_url = f"https://t.me/{channel_id.replace('@', '')}"
+        checklist_button_text = config.get('checklist_button_text', 'Получить чек-лист')
+
+        checklist_keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        checklist_keyboard.add(types.KeyboardButton(checklist_button_text))
+
+        subscription_keyboard = types.InlineKeyboardMarkup()
+        subscription_keyboard.add(types.InlineKeyboardButton(text="Перейти в канал", url=channel_url))
+
+        post_keyboard = types.InlineKeyboardMarkup()
+        post_keyboard.add(types.InlineKeyboardButton(
+            text=values['channel_button_text'],
+            url=f"https://t.me/{self._bot_username}?start=checklist"
+        ))
+
+        post_text = build_post_text(values)
+
+        return Settings(
+            version=version,
+            **values,
+            checklist_button_text=checklist_button_text,
+            welcome_message=config.get(
+                'welcome_message',
+                f'Привет! Подпишитесь на канал {channel_id} и нажмите кнопку, чтобы получить чек-лист.'),
+            start_message=f'Привет! Чтобы получить чек-лист подготовки к ремонту, подпишитесь на канал {channel_id} и нажмите /check для проверки подписки.',
+            subscription_request=config['subscription_request'],
+            reminder_message=f"Чтобы получить чек-лист, нажмите кнопку \"{checklist_button_text}\" или отправьте /check для проверки подписки.",
+            pdf_message=config['pdf_message'],
+            pdf_message_repeat=config['pdf_message_repeat'],
+            pdf_caption='Чек-лист подготовки к ремонту',
+            pdf_link_message=f"К сожалению, не удалось отправить документ. Скачайте PDF по ссылке: {values['bonus_pdf_url']}",
+            pdf_error_message=f"Произошла ошибка при отправке PDF. Скачайте его по ссылке: {values['bonus_pdf_url']}",
+            checklist_keyboard=checklist_keyboard.to_json(),
+            subscription_keyboard=subscription_keyboard.to_json(),
+            post_keyboard=post_keyboard.to_json(),
+            post_text=post_text,
+            post_preview=post_text.replace('\n', '<br>'),
+            editable_description=html_to_editable(values['channel_post_description']),
+        )
+
+    def reload(self) -> bool:
+        """
+        Перечитывает файл настроек, если его изменил другой процесс.
+
+        Returns:
+            bool: True, если опубликована более новая версия из файла
+        """
+        stored = self._read_file()
+        with self._lock:
+            if stored.get('version', 0) <= self.current.version:
+                return False
+            values = self.current.editable_values()
+            values.update({name: stored[name] for name in EDITABLE_FIELDS if name in stored})
+            self.current = self._build(stored['version'], values)
+        return True
+
+    def update(self, **changes: str) -> Settings:
+        """
+        Публикует новую версию настроек.
+
+        Args:
+            **changes: Новые значения редактируемых настроек
+
+        Returns:
+            Settings: Опубликованный снимок
+        """
+        unknown = set(changes) - set(EDITABLE_FIELDS)
+        if unknown:
+            raise ValueError(f'Неизвестные настройки: {", ".join(sorted(unknown))}')
+
+        with self._lock:
+            values = self.current.editable_values()
+            values.update({name: value or '' for name, value in changes.items()})
+            settings = self._build(self.current.version + 1, values)
+            self._write_file(settings)
+            # Присваивание ссылки атомарно: обработчики видят либо старый, либо новый снимок
+            self.current = settings
+
+        logger.info(f'Опубликованы настройки версии {settings.version}')
+        return settings
+
@@ -0,0 +1,447 @@
+"""
+Горизонтальное масштабирование: один приёмник обновлений и N процессов-обработчиков.
+
+    приёмник (ingress)   опрашивает Telegram и раздаёт обновления процессам-
+                         обработчикам по user_id; обслуживает панель управления,
+                         собирая данные со всех обработчиков
+    обработчик (worker)  обрабатывает обновления своей доли пользователей и
+                         хранит только её (.data/shards/<номер>/users.bin)
+
+Процессы общаются через Unix-сокеты (multiprocessing.connection) с общим
+ключом. Опрашивать Telegram может только один приёмник: его выбирает
+блокировка файла .data/shards/leader.lock. Резервный приёмник ждёт блокировку
+и подхватывает опрос, как только ведущий завершится; обработчики при этом
+продолжают работать.
+
+Всё запускается на одной машине:
+    python sharding.py --shards 4 --standby
+"""
+import argparse
+import fcntl
+import hashlib
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from user_index import encode_cursor, user_activity_key
+from user_store import SnapshotReader, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Типы обновлений, из которых берётся пользователь для выбора обработчика
+_UPDATE_KINDS = ('message', 'edited_message', 'callback_query', 'inline_query',
+                 'chosen_inline_result', 'my_chat_member', 'chat_member', 'chat_join_request',
+                 'channel_post', 'edited_channel_post')
+
+# Сколько обновлений может ждать отправки одному обработчику; лишние остаются
+# в файле offset приёмника и передаются после его перезапуска
+SHARD_QUEUE_SIZE = 10000
+
+# Сколько ждать подтверждения приёма обновления обработчиком, в секундах
+SEND_TIMEOUT = 10
+
+# Интервал опроса обработчиков для /healthz, в секундах
+HEARTBEAT_INTERVAL = 5
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Номер обработчика, которому принадлежит пользователь."""
+    return user_id % shards
+
+
+def update_user_id(raw_update: Dict[str, Any]) -> Optional[int]:
+    """Возвращает ID пользователя (или чата) из исходного JSON обновления."""
+    for kind in _UPDATE_KINDS:
+        item = raw_update.get(kind)
+        if item:
+            sender = item.get('from') or item.get('chat') or {}
+            if 'id' in sender:
+                return sender['id']
+    return None
+
+
+def socket_path(directory: str, index: int) -> str:
+    return os.path.join(directory, f'worker-{index}.sock')
+
+
+def derive_authkey(secret: str) -> bytes:
+    """Ключ для сокетов процессов; по умолчанию выводится из токена бота."""
+    return hashlib.sha256(f'shards:{secret}'.encode()).digest()
+
+
+def import_shard(source_file: str, target_file: str, index: int, shards: int) -> int:
+    """
+    Переносит в снимок обработчика его долю пользователей из общего снимка.
+
+    Выполняется при первом запуске обработчика, когда своего снимка у него ещё нет.
+
+    Returns:
+        int: Количество перенесённых пользователей
+    """
+    reader = SnapshotReader(source_file)
+    try:
+        part = {user_id: user_data for user_id, user_data in reader if shard_for(user_id, shards) == index}
+    finally:
+        reader.close()
+    write_snapshot(target_file, part)
+    return len(part)
+
+
+class LeaderLock:
+    """Блокировка файла, которую держит ведущий приёмник, пока жив процесс."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking: bool = True, poll_interval: float = 1.0) -> bool:
+        """Захватывает блокировку; при blocking=True ждёт, пока её освободят."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        file = open(self.path, 'a+')
+        while True:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not blocking:
+                    file.close()
+                    return False
+                time.sleep(poll_interval)
+
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self._file = file
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class ShardServer:
+    """
+    Сервер обработчика: принимает обновления и вызовы от приёмника.
+
+    Сообщения: ('update', исходный JSON) с подтверждением приёма ('ok', None) и
+    ('call', операция, аргументы) с ответом ('ok', результат) или ('error', текст ошибки).
+    """
+
+    def __init__(self, address: str, authkey: bytes,
+                 on_update: Callable[[Dict[str, Any]], None],
+                 operations: Dict[str, Callable[..., Any]]):
+        directory = os.path.dirname(address)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(address):
+            os.unlink(address)
+        self.address = address
+        self.on_update = on_update
+        self.operations = operations
+        self._listener = Listener(address, family='AF_UNIX', authkey=authkey)
+
+    def _serve_connection(self, connection) -> None:
+        with connection:
+            while True:
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    return
+
+                if message[0] == 'update':
+                    try:
+                        self.on_update(message[1])
+                    except Exception as e:
+                        logger.error(f'Ошибка приёма обновления от приёмника: {e}')
+                    # Повтор не поможет: ошибка уже записана, приёмник может забыть обновление
+                    connection.send(('ok', None))
+                    continue
+
+                _, operation, kwargs = message
+                try:
+                    reply = ('ok', self.operations[operation](**kwargs))
+                except Exception as e:
+                    logger.error(f'Ошибка операции {operation}: {e}')
+                    reply = ('error', str(e))
+                connection.send(reply)
+
+    def serve_forever(self) -> None:
+        logger.info(f'Обработчик принимает обновления на {self.address}')
+        while True:
+            try:
+                connection = self._listener.accept()
+            except Exception as e:
+                logger.error(f'Ошибка подключения приёмника: {e}')
+                continue
+            threading.Thread(target=self._serve_connection, args=(connection,),
+                             name='shard-connection', daemon=True).start()
+
+
+class ShardClient:
+    """Соединение приёмника с одним обработчиком; переподключается при обрыве."""
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self._authkey = authkey
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = Client(self.address, family='AF_UNIX', authkey=self._authkey)
+        return self._connection
+
+    def _reset(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except OSError:
+                pass
+            self._connection = None
+
+    def send_update(self, raw_update: Dict[str, Any], timeout: float = SEND_TIMEOUT) -> None:
+        """Передаёт обновление и ждёт подтверждения, что обработчик его принял."""
+        with self._lock:
+            try:
+                connection = self._connect()
+                connection.send(('update', raw_update))
+                if not connection.poll(timeout):
+                    raise TimeoutError(f'Обработчик {self.address} не подтвердил приём за {timeout} с')
+                connection.recv()
+            except Exception:
+                self._reset()
+                raise
+
+    def call(self, operation: str, timeout: float = 30, **kwargs: Any) -> Any:
+        with self._lock:
+            try:
+                connection = self._connect()
+                connection.send(('call', operation, kwargs))
+                if not connection.poll(timeout):
+                    raise TimeoutError(f'Обработчик {self.address} не ответил за {timeout} с')
+                status, result = connection.recv()
+            except Exception:
+                self._reset()
+                raise
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+
+class ShardSender:
+    """
+    Очередь и поток отправки обновлений одному обработчику.
+
+    Недоступный обработчик задерживает только свою очередь: поток повторяет
+    отправку, пока обработчик не подтвердит приём, и только после этого
+    сообщает приёмнику, что обновление передано.
+    """
+
+    def __init__(self, client: ShardClient, index: int, queue_size: int = SHARD_QUEUE_SIZE):
+        self.client = client
+        self.index = index
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'shard-sender-{self.index}', daemon=True)
+                self._thread.start()
+
+    def put(self, raw_update: Dict[str, Any], on_sent: Callable[[int], None]) -> bool:
+        """Ставит обновление в очередь; False, если очередь переполнена."""
+        self.start()
+        try:
+            self.queue.put_nowait((raw_update, on_sent))
+            return True
+        except queue.Full:
+            return False
+
+    def _send(self, raw_update: Dict[str, Any]) -> None:
+        delay = 0.1
+        failing = False
+        while True:
+            try:
+                self.client.send_update(raw_update)
+                if failing:
+                    logger.info(f'Обработчик {self.index} снова доступен')
+                return
+            except Exception as e:
+                if not failing:
+                    logger.error(f'Обработчик {self.index} недоступен, обновления ждут в очереди: {e}')
+                    failing = True
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+
+    def _run(self) -> None:
+        while True:
+            raw_update, on_sent = self.queue.get()
+            self._send(raw_update)
+            try:
+                on_sent(raw_update['update_id'])
+            except Exception as e:
+                logger.error(f'Ошибка подтверждения обновления {raw_update["update_id"]}: {e}')
+
+
+class ShardRouter:
+    """Раздача обновлений обработчикам и сбор данных со всех обработчиков."""
+
+    def __init__(self, directory: str, shards: int, authkey: bytes):
+        self.shards = shards
+        # Обновления и вызовы панели идут по разным соединениям, чтобы долгий
+        # экспорт не задерживал обработку сообщений
+        self._update_clients = [ShardClient(socket_path(directory, index), authkey) for index in range(shards)]
+        self._call_clients = [ShardClient(socket_path(directory, index), authkey) for index in range(shards)]
+        self._heartbeat_clients = [ShardClient(socket_path(directory, index), authkey) for index in range(shards)]
+        self._senders = [ShardSender(client, index) for index, client in enumerate(self._update_clients)]
+        self._executor = ThreadPoolExecutor(max_workers=shards, thread_name_prefix='shard-call')
+        # Последний ответ каждого обработчика на heartbeat: {'at': time.monotonic(), 'stats': ...}
+        self.status: List[Dict[str, Any]] = [{'at': None, 'stats': None, 'error': None} for _ in range(shards)]
+
+    def shard_of(self, raw_update: Dict[str, Any]) -> int:
+        user_id = update_user_id(raw_update)
+        return shard_for(user_id if user_id is not None else raw_update['update_id'], self.shards)
+
+    def route(self, raw_update: Dict[str, Any], on_sent: Callable[[int], None]) -> None:
+        """
+        Ставит обновление в очередь обработчика его пользователя; не блокирует поток опроса.
+
+        on_sent(update_id) вызывается, когда обработчик подтвердил приём. Если очередь
+        обработчика переполнена, обновление не передаётся и остаётся неподтверждённым
+        в файле offset приёмника до перезапуска.
+        """
+        index = self.shard_of(raw_update)
+        if not self._senders[index].put(raw_update, on_sent):
+            logger.error(f'Очередь обработчика {index} переполнена: обновление {raw_update["update_id"]} '
+                         f'будет передано после перезапуска приёмника')
+
+    def queue_depth(self) -> int:
+        """Количество обновлений, ожидающих отправки обработчикам."""
+        return sum(sender.queue.qsize() for sender in self._senders)
+
+    def call_all(self, operation: str, **kwargs: Any) -> List[Any]:
+        """Вызывает операцию на всех обработчиках параллельно и возвращает ответы по порядку."""
+        futures = [self._executor.submit(client.call, operation, **kwargs) for client in self._call_clients]
+        return [future.result() for future in futures]
+
+    # Сбор данных для панели управления
+
+    def stats(self) -> Dict[str, int]:
+        totals: Dict[str, int] = {}
+        for stats in self.call_all('stats'):
+            for key, value in stats.items():
+                if isinstance(value, int):
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def snapshot(self) -> Dict[int, Dict[str, Any]]:
+        merged: Dict[int, Dict[str, Any]] = {}
+        for part in self.call_all('snapshot'):
+            merged.update(part)
+        return merged
+
+    def find_users(self, descending: bool = True, limit: int = 50, **query: Any) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Ищет пользователей на всех обработчиках.
+
+        Порядок по (last_activity, user_id) общий для всех обработчиков, поэтому
+        страница — это первые limit записей слияния страниц каждого обработчика,
+        а курсор страницы подходит для запроса к любому из них.
+        """
+        pages = self.call_all('find_users', descending=descending, limit=limit, **query)
+        found = [user_data for page_users, _ in pages for user_data in page_users]
+        has_more = any(next_cursor for _, next_cursor in pages) or len(found) > limit
+
+        found.sort(key=lambda user_data: user_activity_key(user_data['user_id'], user_data), reverse=descending)
+        page = found[:limit]
+        next_cursor = None
+        if has_more and page:
+            next_cursor = encode_cursor(user_activity_key(page[-1]['user_id'], page[-1]))
+        return page, next_cursor
+
+    # Состояние обработчиков
+
+    def _heartbeat(self) -> None:
+        while True:
+            for index, client in enumerate(self._heartbeat_clients):
+                try:
+                    stats = client.call('stats', timeout=HEARTBEAT_INTERVAL)
+                    self.status[index] = {'at': time.monotonic(), 'stats': stats, 'error': None}
+                except Exception as e:
+                    self.status[index] = dict(self.status[index], error=str(e))
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def save_age(self) -> Optional[float]:
+        """
+        Время с последнего сохранения у самого отстающего обработчика.
+
+        Берётся из последнего heartbeat с поправкой на его возраст; None, если
+        какой-то обработчик ещё ни разу не ответил или не сохранял данные.
+        """
+        now = time.monotonic()
+        ages = []
+        for status in self.status:
+            stats = status['stats']
+            if stats is None or stats.get('save_age') is None:
+                return None
+            ages.append(stats['save_age'] + now - status['at'])
+        return round(max(ages), 3) if ages else None
+
+    def start_heartbeat(self) -> None:
+        threading.Thread(target=self._heartbeat, name='shard-heartbeat', daemon=True).start()
+
+
+# Запуск всех процессов на одной машине
+
+def run_cluster(shards: int, standby: bool) -> None:
+    """Запускает обработчики и приёмник (и резервный приёмник) как дочерние процессы main.py."""
+    main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    processes: List[subprocess.Popen] = []
+
+    def start(role: str, index: int = 0) -> None:
+        env = dict(os.environ, SHARD_ROLE=role, SHARD_COUNT=str(shards), SHARD_INDEX=str(index))
+        processes.append(subprocess.Popen([sys.executable, main_script], env=env))
+
+    for index in range(shards):
+        start('worker', index)
+    for _ in range(2 if standby else 1):
+        start('ingress')
+
+    def stop(*_args) -> None:
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Запуск бота в нескольких процессах на одной машине')
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 2, help='Количество процессов-обработчиков')
+    parser.add_argument('--standby', action='store_true', help='Запустить резервный приёмник')
+    args = parser.parse_args()
+    run_cluster(args.shards, args.standby)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Логирование без задержек в обработчиках.
+
+Записи журнала складываются в ограниченную очередь и выводятся отдельным
+фоновым потоком (QueueHandler + QueueListener), поэтому обработчики сообщений
+не ждут ввода-вывода. Дополнительно поддерживаются:
+    - формат JSON (LOG_FORMAT=json) с полями event, tenant, user_id, update_id, duration_ms;
+    - выборочная запись частых событий (LOG_SAMPLE_RATES=message_received=0.1,...):
+      отброшенные записи даже не форматируются;
+    - смена уровня логирования во время работы (set_level).
+
+Поля user_id и update_id текущего обновления подставляются автоматически
+из update_context, который выставляет PollingEngine.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+# Обновление, которое обрабатывается в текущем потоке: {'update_id': ..., 'user_id': ..., 'tenant': ...}
+update_context: contextvars.ContextVar = contextvars.ContextVar('update_context', default=None)
+
+# Поля, которые переносятся из extra в JSON-запись
+CONTEXT_FIELDS = ('event', 'tenant', 'user_id', 'update_id', 'duration_ms')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Максимальное количество записей в очереди; при переполнении записи отбрасываются
+QUEUE_SIZE = 10000
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет в запись поля текущего обновления."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = update_context.get()
+        if context:
+            for key, value in context.items():
+                if getattr(record, key, None) is None:
+                    setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только часть записей частых событий.
+
+    Событие задаётся полем event (extra={'event': ...}). Для доли 0.1 пропускается
+    каждая десятая запись; предупреждения и ошибки пропускаются всегда.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.every = {event: max(int(round(1 / rate)), 1) for event, rate in rates.items() if rate > 0}
+        self.disabled = {event for event, rate in rates.items() if rate <= 0}
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+        if event in self.disabled:
+            return False
+        every = self.every.get(event)
+        if every is None or every == 1:
+            return True
+        with self._lock:
+            count = self._counters.get(event, 0)
+            self._counters[event] = count + 1
+        return count % every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну строку JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не блокирует поток."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Подставляет аргументы в сообщение, но не форматирует запись.
+
+        Стандартный prepare форматирует запись в потоке, который пишет лог, и
+        отбрасывает exc_info. Форматирование (в том числе трассировки
+        исключений для JSON) выполняет поток вывода; аргументы подставляются
+        сразу, потому что изменяемые объекты могут измениться до вывода.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class NamedQueueListener(logging.handlers.QueueListener):
+    """QueueListener, поток вывода которого называется log-writer (видно в стеках потоков)."""
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._monitor, name='log-writer', daemon=True)
+        self._thread.start()
+
+
+class LoggingState:
+    """Настроенное логирование: очередь, фоновый поток вывода и текущие параметры."""
+
+    def __init__(self, handler: DroppingQueueHandler, listener: logging.handlers.QueueListener,
+                 json_format: bool, sample_rates: Dict[str, float]):
+        self.handler = handler
+        self.listener = listener
+        self.json_format = json_format
+        self.sample_rates = sample_rates
+
+    @property
+    def level(self) -> str:
+        return logging.getLevelName(logging.getLogger().level)
+
+    def set_level(self, level: str) -> None:
+        """Меняет уровень логирования во время работы."""
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f'Неизвестный уровень логирования: {level}')
+        logging.getLogger().setLevel(level)
+
+    def queue_depth(self) -> int:
+        return self.handler.queue.qsize()
+
+
+def parse_sample_rates(value: Optional[str]) -> Dict[str, float]:
+    """Разбирает строку вида 'message_received=0.1,update_processed=0.01'."""
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(level: str = 'INFO', json_format: bool = False,
+                  sample_rates: Optional[Dict[str, float]] = None) -> LoggingState:
+    """
+    Настраивает корневой логгер: очередь, фильтры и фоновый поток вывода.
+
+    Returns:
+        LoggingState: Состояние логирования для панели управления
+    """
+    sample_rates = sample_rates or {}
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(SamplingFilter(sample_rates))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+    listener = NamedQueueListener(handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем оставшиеся записи при завершении процесса
+    atexit.register(listener.stop)
+
+    return LoggingState(handler, listener, json_format, sample_rates)
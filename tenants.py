@@ -0,0 +1,175 @@
+"""
+Несколько ботов в одном процессе.
+
+Каждый бот (tenant) — это свой токен, канал, настройки, пользователи и кэши,
+а процесс, пул соединений с Bot API, пул потоков обработки, поток сохранения
+и веб-сервер панели управления — общие. Конфигурация ботов читается из JSON-файла
+(TENANTS_FILE), например:
+
+    [
+        {"name": "metry", "bot_token": "...", "channel_id": "@uyutnie_metry",
+         "bot_username": "metry_bot", "bonus_pdf_url": "https://..."},
+        {"name": "kitchen", "bot_token": "...", "channel_id": "@kitchen",
+         "bot_username": "kitchen_bot", "data_dir": "/var/lib/bots/kitchen"}
+    ]
+
+Кроме того, можно задать pdf_file_id, data_dir, assets_file и настройки поста.
+Незаданные поля берутся из переменных окружения. Без TENANTS_FILE процесс
+обслуживает одного бота из переменных окружения, как раньше.
+
+Код обработчиков работает с «текущим» ботом: его выставляет PollingEngine на
+время обработки обновления и панель управления на время запроса.
+"""
+import contextvars
+import json
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from typing import Dict, Any, Callable, Iterator, List, Optional
+
+import telebot
+
+from settings import EDITABLE_FIELDS, SettingsManager, format_description
+from user_store import UserStore
+
+# Бот, для которого выполняется текущий код
+tenant_context: contextvars.ContextVar = contextvars.ContextVar('tenant', default=None)
+
+
+@dataclass(frozen=True)
+class TenantConfig:
+    """Конфигурация одного бота."""
+    name: str
+    bot_token: str
+    channel_id: str
+    bot_username: str
+    data_dir: str
+    pdf_file_id: Optional[str] = None
+    # Значения по умолчанию для настроек, изменяемых из панели управления
+    settings: Dict[str, str] = field(default_factory=dict)
+    # Файл настроек, если он не в data_dir (общий для процессов-обработчиков)
+    settings_file: Optional[str] = None
+    # Каталог материалов, выбираемых по ссылке /start (см. assets.py)
+    assets_file: Optional[str] = None
+
+
+def load_tenant_configs(path: str, base: TenantConfig) -> List[TenantConfig]:
+    """
+    Читает конфигурацию ботов из JSON-файла.
+
+    Args:
+        path: Путь к файлу со списком ботов
+        base: Конфигурация из переменных окружения, из которой берутся незаданные поля
+
+    Returns:
+        Список конфигураций; данные каждого бота по умолчанию лежат в
+        <каталог данных>/tenants/<name>
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        items = json.load(file)
+
+    configs = []
+    names = set()
+    for item in items:
+        name = item.get('name')
+        if not name or name in names:
+            raise ValueError(f'Имя бота не задано или повторяется: {name!r}')
+        if not item.get('bot_token') or not item.get('channel_id'):
+            raise ValueError(f'Для бота {name} нужно задать bot_token и channel_id')
+        names.add(name)
+
+        settings = dict(base.settings)
+        for key in EDITABLE_FIELDS:
+            if key in item:
+                settings[key] = item[key]
+        if 'channel_post_description' in item:
+            settings['channel_post_description'] = format_description(item['channel_post_description'])
+
+        configs.append(replace(
+            base,
+            name=name,
+            bot_token=item['bot_token'],
+            channel_id=item['channel_id'],
+            bot_username=item.get('bot_username', base.bot_username),
+            data_dir=item.get('data_dir') or os.path.join(base.data_dir, 'tenants', name),
+            pdf_file_id=item.get('pdf_file_id'),
+            settings=settings,
+            assets_file=item.get('assets_file', base.assets_file),
+        ))
+    return configs
+
+
+class Tenant:
+    """Бот со своими настройками, пользователями и кэшами."""
+
+    def __init__(self, config: TenantConfig, bot: telebot.TeleBot,
+                 settings: SettingsManager, users: UserStore):
+        self.config = config
+        self.name = config.name
+        self.channel_id = config.channel_id
+        self.data_dir = config.data_dir
+        self.bot = bot
+        self.settings = settings
+        self.users = users
+        # PollingEngine, прогрев и очередь публикаций создаются после бота: им нужен сам Tenant
+        self.polling_engine = None
+        self.warm_up = None
+        self.scheduler = None
+        # Каталог материалов; None — бот выдаёт один PDF из настроек
+        self.catalog = None
+        # Журнал событий для воронок и когорт (analytics.py)
+        self.analytics = None
+        # Журнал доставок файла подписчикам (outbox.py)
+        self.outbox = None
+
+        # Кэши и состояние для /healthz
+        self.pdf_cache: Dict[str, Any] = {'url': config.settings.get('bonus_pdf_url'), 'content': None,
+                                          'fetched_at': 0.0, 'file_id': config.pdf_file_id}
+        self.channel_access_cache: Dict[str, Any] = {'checked_at': 0.0, 'result': None}
+        self.save_state: Dict[str, Any] = {'succeeded_at': None, 'duration': None, 'error': None}
+
+    @contextmanager
+    def activate(self) -> Iterator['Tenant']:
+        """Делает бота текущим на время блока with."""
+        token = tenant_context.set(self)
+        try:
+            yield self
+        finally:
+            tenant_context.reset(token)
+
+    def run(self, func: Callable, *args: Any) -> Any:
+        """Вызывает func с этим ботом в роли текущего."""
+        with self.activate():
+            return func(*args)
+
+
+class TenantRegistry:
+    """Боты процесса в порядке загрузки; первый используется по умолчанию."""
+
+    def __init__(self):
+        self._tenants: Dict[str, Tenant] = {}
+
+    def add(self, tenant: Tenant) -> None:
+        if tenant.name in self._tenants:
+            raise ValueError(f'Бот {tenant.name} уже добавлен')
+        self._tenants[tenant.name] = tenant
+
+    def get(self, name: str) -> Optional[Tenant]:
+        return self._tenants.get(name)
+
+    @property
+    def default(self) -> Tenant:
+        return next(iter(self._tenants.values()))
+
+    def current(self) -> Tenant:
+        """Текущий бот; вне обработки обновлений и запросов панели — бот по умолчанию."""
+        return tenant_context.get() or self.default
+
+    def names(self) -> List[str]:
+        return list(self._tenants)
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(list(self._tenants.values()))
+
+    def __len__(self) -> int:
+        return len(self._tenants)
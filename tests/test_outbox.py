@@ -0,0 +1,62 @@
+import outbox
+from outbox import Outbox
+
+
+def reopen(path):
+    box = Outbox(path, commit_interval=0)
+    box.start()
+    return box
+
+
+def test_unfinished_delivery_is_replayed_after_restart(tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+    box = reopen(path)
+    done = box.add(chat_id=1, user_id=1)
+    box.complete(done, delivered=True)
+    box.add(chat_id=2, user_id=2, asset='kitchen')
+    box.add(chat_id=3, user_id=3)
+
+    replay = reopen(path).replayable()
+    assert [(entry['user_id'], entry['asset']) for entry in replay] == [(2, 'kitchen'), (3, None)]
+
+
+def test_replay_keeps_latest_delivery_per_user(tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+    box = reopen(path)
+    # Пользователь уже получил файл после этой доставки
+    box.add(chat_id=2, user_id=2, created_at=100)
+    box.complete(box.add(chat_id=2, user_id=2, created_at=150), delivered=True)
+    # Отметка о завершении не ждёт диска: следующая доставка ждёт и её
+    box.add(chat_id=1, user_id=1, asset='old', created_at=100)
+    box.add(chat_id=1, user_id=1, asset='new', created_at=200)
+
+    restarted = reopen(path)
+    assert [entry['asset'] for entry in restarted.replayable()] == ['new']
+    # Пропущенные доставки отмечены завершёнными и больше не повторяются
+    assert [entry['asset'] for entry in reopen(path).replayable()] == ['new']
+
+
+def test_retry_counts_attempts_until_limit(tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+    reopen(path).add(chat_id=1, user_id=1)
+
+    for _ in range(outbox.MAX_REPLAY_ATTEMPTS):
+        box = reopen(path)
+        entries = box.replayable()
+        assert len(entries) == 1
+        box.retry(entries[0])
+    assert reopen(path).replayable() == []
+
+
+def test_compact_keeps_pending_deliveries(tmp_path):
+    path = str(tmp_path / 'outbox.jsonl')
+    box = reopen(path)
+    for user_id in range(10):
+        box.complete(box.add(chat_id=user_id, user_id=user_id), delivered=True)
+    box.add(chat_id=42, user_id=42)
+    box.add(chat_id=43, user_id=43)  # ждём записи этой доставки на диск перед сжатием
+    box.compact()
+
+    with open(path, encoding='utf-8') as file:
+        assert len(file.readlines()) == 2
+    assert [entry['user_id'] for entry in reopen(path).replayable()] == [42, 43]
@@ -0,0 +1,127 @@
+import json
+import threading
+
+import pytest
+from telebot import apihelper
+
+import polling
+from polling import PollingEngine, WorkerPool
+
+
+def message(update_id, chat_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': 'x', 'chat': {'id': chat_id, 'type': 'private'}}}
+
+
+class FakeBot:
+    token = '1:test'
+
+    def __init__(self, blocked=(), failing=()):
+        self.processed = []
+        self.blocked = set(blocked)
+        self.failing = set(failing)
+        self.release = threading.Event()
+
+    def process_new_updates(self, updates):
+        update_id = updates[0].update_id
+        if update_id in self.blocked:
+            self.release.wait(5)
+        if update_id in self.failing:
+            raise RuntimeError('ошибка обработчика')
+        self.processed.append(update_id)
+
+
+@pytest.fixture(autouse=True)
+def save_immediately(monkeypatch):
+    monkeypatch.setattr(polling, 'SAVE_INTERVAL', 0)
+
+
+def serve(monkeypatch, batches):
+    batches = list(batches)
+    monkeypatch.setattr(apihelper, 'get_updates', lambda *args, **kwargs: batches.pop(0) if batches else [])
+
+
+def read_offset(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def test_offset_waits_for_unfinished_updates(tmp_path, monkeypatch):
+    path = str(tmp_path / 'offset.json')
+    bot = FakeBot(blocked={11})
+    engine = PollingEngine(bot, path, pool=WorkerPool(4))
+    engine.start_workers()
+    serve(monkeypatch, [[message(10, 1), message(11, 2), message(12, 3)]])
+    engine.poll_once()
+
+    # Обновление 11 ещё обрабатывается: offset не может уйти дальше него
+    for _ in range(100):
+        if sorted(bot.processed) == [10, 12] and len(read_offset(path)['pending']) == 1:
+            break
+        threading.Event().wait(0.01)
+    saved = read_offset(path)
+    assert saved['offset'] == 11
+    assert saved['fetch_offset'] == 13
+    assert [update['update_id'] for update in saved['pending']] == [11]
+
+    bot.release.set()
+    engine.stop()
+    assert read_offset(path) == {'offset': 13, 'fetch_offset': 13, 'pending': []}
+
+
+def test_unfinished_updates_are_processed_after_restart(tmp_path, monkeypatch):
+    path = str(tmp_path / 'offset.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'offset': 11, 'fetch_offset': 13, 'pending': [message(11, 2)]}, file)
+
+    bot = FakeBot()
+    engine = PollingEngine(bot, path, pool=WorkerPool(2))
+    offsets = []
+
+    def get_updates(token, offset=None, **kwargs):
+        offsets.append(offset)
+        engine.request_stop()
+        return [message(13, 1)]
+
+    monkeypatch.setattr(apihelper, 'get_updates', get_updates)
+    engine.run()
+    engine.stop()
+
+    assert offsets == [13]
+    assert sorted(bot.processed) == [11, 13]
+    assert read_offset(path)['offset'] == 14
+
+
+def test_old_offset_file_is_supported(tmp_path, monkeypatch):
+    path = str(tmp_path / 'offset.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'offset': 20}, file)
+
+    engine = PollingEngine(FakeBot(), path, pool=WorkerPool(1))
+    assert engine._load_offset() == 20
+
+
+def test_worker_survives_handler_errors(tmp_path, monkeypatch):
+    path = str(tmp_path / 'offset.json')
+    bot = FakeBot(failing={13})
+    engine = PollingEngine(bot, path, pool=WorkerPool(1))
+    engine.start_workers()
+    engine.on_processed = lambda update, seconds: 1 / 0 if update.update_id == 14 else None
+    serve(monkeypatch, [[message(13, 1), message(14, 1), message(15, 1)]])
+    engine.poll_once()
+    engine.join()
+    engine.stop()
+
+    assert bot.processed == [14, 15]
+    assert read_offset(path)['offset'] == 16
+
+
+def test_duplicates_are_skipped(tmp_path, monkeypatch):
+    bot = FakeBot()
+    engine = PollingEngine(bot, str(tmp_path / 'offset.json'), pool=WorkerPool(1))
+    engine.start_workers()
+    serve(monkeypatch, [[message(1, 1), message(2, 1)], [message(2, 1), message(3, 1)]])
+    assert engine.poll_once() == 2
+    assert engine.poll_once() == 1
+    engine.stop()
+    assert bot.processed == [1, 2, 3]
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from scheduler import PostScheduler
+
+
+class FakeChannels:
+    def __init__(self, failing=(), fail_times=0):
+        self.failing = set(failing)
+        self.fail_times = fail_times
+        self.calls = []
+
+    def send(self, target, post, photo):
+        self.calls.append((target, photo))
+        if target in self.failing:
+            raise RuntimeError('канал недоступен')
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError('временная ошибка')
+        return len(self.calls), 'photo-file-id' if photo else None
+
+
+@pytest.fixture
+def store_file(tmp_path):
+    return str(tmp_path / 'scheduled_posts.json')
+
+
+def run_due(scheduler):
+    job, _ = scheduler._next_due()
+    assert job is not None
+    scheduler._execute(job)
+    return scheduler.get(job['id'])
+
+
+def test_failed_channel_is_retried(store_file):
+    channels = FakeChannels(fail_times=1)
+    scheduler = PostScheduler(store_file, channels.send, rate=1000, retry_delay=0)
+    scheduler.schedule({'text': 'пост', 'image_url': None, 'reply_markup': None}, ['@a'])
+
+    job = run_due(scheduler)
+    assert job['status'] == 'retrying'
+    assert job['results']['@a']['status'] == 'failed'
+
+    job = run_due(scheduler)
+    assert job['status'] == 'done'
+    assert job['results']['@a'] == dict(job['results']['@a'], status='ok', message_id=2, attempts=2)
+
+
+def test_partial_results_after_last_attempt(store_file):
+    channels = FakeChannels(failing={'@b'})
+    scheduler = PostScheduler(store_file, channels.send, rate=1000, max_attempts=2, retry_delay=0)
+    scheduler.schedule({'text': 'пост', 'image_url': None, 'reply_markup': None}, ['@a', '@b'])
+
+    run_due(scheduler)
+    job = run_due(scheduler)
+    assert job['status'] == 'partial'
+    assert job['results']['@a']['status'] == 'ok'
+    assert job['results']['@b']['status'] == 'failed'
+    # Успешный канал не получает пост повторно
+    assert [target for target, _ in channels.calls] == ['@a', '@b', '@b']
+
+    with open(store_file, encoding='utf-8') as file:
+        assert json.load(file)[0]['status'] == 'partial'
+
+
+def test_photo_uploaded_once(store_file):
+    channels = FakeChannels()
+    scheduler = PostScheduler(store_file, channels.send, rate=1000)
+    scheduler.schedule({'text': 'пост', 'image_url': 'https://example.com/p.jpg', 'reply_markup': None},
+                       ['@a', '@b', '@c'])
+
+    job = run_due(scheduler)
+    assert job['status'] == 'done'
+    assert channels.calls[0] == ('@a', 'https://example.com/p.jpg')
+    assert sorted(channels.calls[1:]) == [('@b', 'photo-file-id'), ('@c', 'photo-file-id')]
+
+
+def test_job_error_does_not_leave_job_running(store_file):
+    scheduler = PostScheduler(store_file, FakeChannels().send, rate=1000, max_attempts=2, retry_delay=0)
+    # Пост без полей: выполнение задания падает до отправки
+    scheduler.schedule(None, ['@a'])
+
+    assert run_due(scheduler)['status'] == 'retrying'
+    assert run_due(scheduler)['status'] == 'failed'
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from telebot import apihelper
+
+import polling
+from polling import PollingEngine
+from sharding import ShardRouter, ShardServer, derive_authkey, shard_for, socket_path, update_user_id
+from user_index import decode_cursor
+
+AUTHKEY = derive_authkey('test')
+
+
+def message(update_id, user_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': 'x',
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+                        'chat': {'id': user_id, 'type': 'private'}}}
+
+
+class FakeBot:
+    token = '1:test'
+
+
+@pytest.fixture(autouse=True)
+def save_immediately(monkeypatch):
+    monkeypatch.setattr(polling, 'SAVE_INTERVAL', 0)
+
+
+def start_shard(directory, index, received):
+    server = ShardServer(socket_path(str(directory), index), AUTHKEY,
+                         on_update=lambda raw_update: received.append(raw_update['update_id']),
+                         operations={})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def read_offset(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def test_update_goes_to_shard_of_its_user():
+    assert shard_for(7, 4) == 3
+    assert update_user_id(message(1, 42)) == 42
+    assert update_user_id({'update_id': 2, 'callback_query': {'id': 'q', 'from': {'id': 5}}}) == 5
+    assert update_user_id({'update_id': 3}) is None
+
+    router = ShardRouter('/nonexistent', 4, AUTHKEY)
+    assert router.shard_of(message(1, 42)) == 2
+    # Без пользователя обработчик выбирается по update_id
+    assert router.shard_of({'update_id': 5}) == 1
+
+
+def test_route_delivers_and_confirms(tmp_path):
+    received = {0: [], 1: []}
+    for index in received:
+        start_shard(tmp_path, index, received[index])
+    router = ShardRouter(str(tmp_path), 2, AUTHKEY)
+
+    sent = []
+    for update_id, user_id in ((1, 10), (2, 11), (3, 12)):
+        router.route(message(update_id, user_id), sent.append)
+
+    assert wait_for(lambda: sorted(sent) == [1, 2, 3])
+    assert received == {0: [1, 3], 1: [2]}
+
+
+def test_dead_shard_keeps_updates_pending(tmp_path, monkeypatch):
+    offset_file = str(tmp_path / 'offset.json')
+    received = {0: [], 1: []}
+    start_shard(tmp_path, 0, received[0])
+    router = ShardRouter(str(tmp_path), 2, AUTHKEY)
+    engine = PollingEngine(FakeBot(), offset_file)
+    engine.router = router.route
+
+    batches = [[message(10, 2), message(11, 3), message(12, 4)]]
+    monkeypatch.setattr(apihelper, 'get_updates', lambda *args, **kwargs: batches.pop(0) if batches else [])
+    started = time.monotonic()
+    engine.poll_once()
+    # Недоступный обработчик 1 не задерживает опрос и обработчик 0
+    assert time.monotonic() - started < 1
+    assert wait_for(lambda: received[0] == [10, 12])
+    assert wait_for(lambda: [raw['update_id'] for raw in read_offset(offset_file)['pending']] == [11])
+    assert read_offset(offset_file)['offset'] == 11
+
+    # Обработчик запустился: обновление доставлено и больше не ждёт в файле offset
+    start_shard(tmp_path, 1, received[1])
+    assert wait_for(lambda: received[1] == [11])
+    engine._save_offset()
+    assert read_offset(offset_file)['pending'] == []
+    assert read_offset(offset_file)['offset'] == 13
+
+
+def test_stats_and_find_users_merge_shards(monkeypatch):
+    router = ShardRouter('/nonexistent', 2, AUTHKEY)
+
+    def user(user_id, minute):
+        return {'user_id': user_id, 'last_activity': datetime(2024, 1, 1, 12, minute)}
+
+    replies = {
+        'stats': [{'total_users': 3, 'active_users': 1, 'storage': 'snapshot'},
+                  {'total_users': 2, 'active_users': 2, 'storage': 'snapshot'}],
+        'find_users': [([user(2, 50), user(4, 30)], 'more'),
+                       ([user(1, 40), user(3, 20)], None)],
+    }
+    monkeypatch.setattr(router, 'call_all', lambda operation, **kwargs: replies[operation])
+
+    assert router.stats() == {'total_users': 5, 'active_users': 3}
+
+    page, cursor = router.find_users(limit=3)
+    assert [user_data['user_id'] for user_data in page] == [2, 1, 4]
+    assert decode_cursor(cursor) == (datetime(2024, 1, 1, 12, 30).timestamp(), 4)
+
+    page, cursor = router.find_users(limit=10)
+    assert [user_data['user_id'] for user_data in page] == [2, 1, 4, 3]
+    # Первый обработчик сообщил о следующей странице
+    assert cursor is not None
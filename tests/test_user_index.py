@@ -0,0 +1,75 @@
+import random
+from datetime import datetime, timedelta
+
+from user_index import UserIndex
+
+BASE = datetime(2026, 1, 1)
+
+
+def build(count=500, seed=1):
+    rng = random.Random(seed)
+    users = {}
+    for user_id in range(1, count + 1):
+        users[user_id] = {
+            'user_id': user_id,
+            'username': rng.choice(['anna', 'Anton', 'boris', 'vera', '']) + str(user_id),
+            'is_subscribed': rng.random() < 0.3,
+            'pdf_sent': rng.random() < 0.1,
+            # Одинаковое время у нескольких пользователей проверяет порядок по user_id
+            'last_activity': BASE + timedelta(minutes=rng.randrange(count // 2)),
+        }
+    index = UserIndex()
+    for user_id in users:
+        index.refresh(user_id, users.get)
+    return index, users
+
+
+def expected(users, descending=True, predicate=lambda user_data: True):
+    matching = [user_id for user_id, user_data in users.items() if predicate(user_data)]
+    return sorted(matching, key=lambda user_id: (users[user_id]['last_activity'], user_id), reverse=descending)
+
+
+def pages(index, **query):
+    result, cursor = [], None
+    while True:
+        page, cursor = index.query(cursor=cursor, limit=37, **query)
+        result.extend(page)
+        if cursor is None:
+            return result
+
+
+def test_pages_follow_activity_order():
+    index, users = build()
+    assert pages(index) == expected(users)
+    assert pages(index, descending=False) == expected(users, descending=False)
+
+
+def test_flags_and_activity_range():
+    index, users = build()
+    active_from, active_to = BASE + timedelta(minutes=50), BASE + timedelta(minutes=150)
+    result = pages(index, flags={'is_subscribed': True, 'pdf_sent': False},
+                   active_from=active_from, active_to=active_to, descending=False)
+    assert result == expected(users, descending=False, predicate=lambda user_data: (
+        user_data['is_subscribed'] and not user_data['pdf_sent']
+        and active_from <= user_data['last_activity'] <= active_to))
+    assert index.count('is_subscribed') == sum(user_data['is_subscribed'] for user_data in users.values())
+
+
+def test_username_prefix_is_case_insensitive():
+    index, users = build()
+    result = pages(index, username_prefix='AN', flags={'is_subscribed': False})
+    assert result == expected(users, predicate=lambda user_data: (
+        user_data['username'].lower().startswith('an') and not user_data['is_subscribed']))
+
+
+def test_refresh_moves_and_removes_users():
+    index, users = build(50)
+    users[10] = dict(users[10], is_subscribed=True, last_activity=BASE + timedelta(days=1))
+    index.refresh(10, users.get)
+    del users[11]
+    index.refresh(11, users.get)
+
+    page, _ = index.query(flags={'is_subscribed': True}, limit=1)
+    assert page == [10]
+    assert 11 not in pages(index)
+    assert pages(index) == expected(users)
@@ -0,0 +1,109 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from user_store import SnapshotReader, UserStore, write_snapshot
+
+
+def make_user(user_id, **fields):
+    user_data = {
+        'user_id': user_id,
+        'username': f'user{user_id}',
+        'welcome_sent': True,
+        'pdf_sent': False,
+        'is_subscribed': False,
+        'last_activity': datetime(2026, 1, 1, 12, 0, user_id % 60),
+    }
+    user_data.update(fields)
+    return user_data
+
+
+def test_snapshot_round_trip(tmp_path):
+    users = {
+        3: make_user(3, pdf_sent=True, is_subscribed=True, last_checked=datetime(2026, 1, 2, 8, 30)),
+        1: make_user(1, username='Ёжик', asset='kitchen'),
+        2: make_user(2, username=''),
+    }
+    del users[2]['last_activity']
+    path = str(tmp_path / 'users.bin')
+
+    write_snapshot(path, users)
+    reader = SnapshotReader(path)
+    try:
+        assert reader.count == 3
+        assert dict(reader) == users
+        assert [user_id for user_id, _ in reader] == [1, 2, 3]
+        assert reader.find(3) == users[3]
+        assert reader.find(4) is None
+    finally:
+        reader.close()
+
+
+def test_store_reloads_saved_snapshot(tmp_path):
+    snapshot_file = str(tmp_path / 'users.bin')
+    store = UserStore(snapshot_file, str(tmp_path / 'users.json'))
+    for user_id in range(1, 200):
+        store.setdefault(user_id, make_user(user_id))
+    store.update_user(7, pdf_sent=True, asset='bathroom')
+    del store[8]
+    store.save()
+
+    loaded = UserStore(snapshot_file, str(tmp_path / 'users.json'))
+    loaded.start_loading()
+    # До окончания загрузки пользователь находится бинарным поиском в снимке
+    assert loaded.get(7)['asset'] == 'bathroom'
+    assert loaded.wait_loaded(5)
+    assert dict(loaded.snapshot()) == dict(store.snapshot())
+    assert 8 not in loaded
+    assert loaded.index.count('pdf_sent') == 1
+
+
+def test_store_converts_json(tmp_path):
+    json_file = tmp_path / 'users.json'
+    json_file.write_text('{"5": {"user_id": 5, "username": "old", "welcome_sent": true, '
+                         '"pdf_sent": true, "is_subscribed": true, '
+                         '"last_activity": "2026-01-01T10:00:00"}}', encoding='utf-8')
+    store = UserStore(str(tmp_path / 'users.bin'), str(json_file))
+    store.start_loading()
+    assert store.wait_loaded(5)
+
+    assert store[5]['username'] == 'old'
+    assert store[5]['last_activity'] == datetime(2026, 1, 1, 10, 0)
+
+
+def test_corrupt_snapshot_is_set_aside(tmp_path):
+    snapshot_file = tmp_path / 'users.bin'
+    write_snapshot(str(snapshot_file), {user_id: make_user(user_id) for user_id in range(1, 100)})
+    original = snapshot_file.read_bytes()
+    snapshot_file.write_bytes(original[:len(original) // 2])
+
+    store = UserStore(str(snapshot_file), str(tmp_path / 'users.json'))
+    store.start_loading()
+    assert store.wait_loaded(5)
+    assert len(store) == 0
+
+    # Сохранение пустого хранилища не затирает повреждённый снимок
+    store.setdefault(500, make_user(500))
+    store.save()
+    assert (tmp_path / 'users.bin.corrupt').read_bytes() == original[:len(original) // 2]
+    reader = SnapshotReader(str(snapshot_file))
+    try:
+        assert [user_id for user_id, _ in reader] == [500]
+    finally:
+        reader.close()
+
+
+def test_save_refused_when_corrupt_file_stays(tmp_path, monkeypatch):
+    snapshot_file = tmp_path / 'users.bin'
+    snapshot_file.write_bytes(b'not a snapshot')
+    def replace(source, target):
+        raise PermissionError('только чтение')
+    monkeypatch.setattr(os, 'replace', replace)
+
+    store = UserStore(str(snapshot_file), str(tmp_path / 'users.json'))
+    store.start_loading()
+    store.setdefault(1, make_user(1))
+    with pytest.raises(RuntimeError):
+        store.save()
+    assert snapshot_file.read_bytes() == b'not a snapshot'
@@ -0,0 +1,152 @@
+"""
+Трассировка обработки обновлений.
+
+Для обновления, попавшего в выборку (sample_rate), строится дерево отрезков:
+корень — обработка обновления, вложенные — запросы к Bot API, скачивания,
+попытки проверки подписки, паузы и т. д. Отрезок открывается контекстным
+менеджером span(name, **attributes) в любом месте кода; вне трассировки
+span ничего не делает, поэтому код можно размечать без проверок.
+
+Трассировки дольше slow_threshold секунд попадают в кольцевой буфер
+(просмотр в /admin/traces) и, если задан export_file, дописываются в него
+JSON-строками. Остальные отбрасываются сразу после обработки обновления.
+Стоимость отрезка — пара вызовов perf_counter и один объект, так что
+трассировка заметна только на фоне работы без сети.
+"""
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """Отрезок трассировки: имя, атрибуты, время начала и конца, вложенные отрезки."""
+
+    __slots__ = ('name', 'attributes', 'started', 'finished', 'children', 'error')
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.children: List['Span'] = []
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self, origin: Optional[float] = None) -> Dict[str, Any]:
+        """Отрезок с вложенными; время — в миллисекундах от начала трассировки."""
+        origin = self.started if origin is None else origin
+        return {
+            'name': self.name,
+            'attributes': self.attributes,
+            'offset_ms': round((self.started - origin) * 1000, 1),
+            'duration_ms': round(self.duration * 1000, 1),
+            'error': self.error,
+            'children': [child.to_dict(origin) for child in self.children],
+        }
+
+
+# Текущий отрезок потока (или задачи asyncio)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Вложенный отрезок текущей трассировки; вне трассировки ничего не делает."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    current = Span(name, attributes)
+    parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.finished = time.perf_counter()
+        _current_span.reset(token)
+
+
+class Tracer:
+    """Выборка трассировок, кольцевой буфер медленных и запись в файл."""
+
+    def __init__(self, sample_rate: float = 0.05, slow_threshold: float = 5.0,
+                 buffer_size: int = 100, export_file: Optional[str] = None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.export_file = export_file
+        self.traced = 0
+        self.slow: deque = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        """Корневой отрезок трассировки, если обновление попало в выборку."""
+        if _current_span.get() is not None or random.random() >= self.sample_rate:
+            yield None
+            return
+
+        root = Span(name, attributes)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            root.finished = time.perf_counter()
+            _current_span.reset(token)
+            self.traced += 1
+            if root.duration >= self.slow_threshold:
+                self._keep(root)
+
+    def _keep(self, root: Span) -> None:
+        trace = dict(root.to_dict(), at=time.time())
+        with self._lock:
+            self.slow.append(trace)
+            if self.export_file:
+                try:
+                    with open(self.export_file, 'a', encoding='utf-8') as file:
+                        file.write(json.dumps(trace, ensure_ascii=False, default=str) + '\n')
+                except Exception as e:
+                    logger.error(f'Ошибка записи трассировки в файл: {e}')
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """Медленные трассировки, начиная с последней."""
+        with self._lock:
+            return list(reversed(self.slow))
+
+
+class TracingAdapter(HTTPAdapter):
+    """HTTPAdapter, который оформляет каждый запрос отрезком трассировки (для Bot API — по имени метода)."""
+
+    def send(self, request, *args, **kwargs):
+        # Из URL берём только метод: в пути запроса к Bot API лежит токен
+        path = request.path_url.split('?', 1)[0]
+        if path.startswith('/file/'):
+            name = 'bot_api.download_file'
+        elif path.startswith('/bot'):
+            name = f"bot_api.{path.rsplit('/', 1)[-1]}"
+        else:
+            name = f'http.{request.method}'
+        with span(name) as current:
+            response = super().send(request, *args, **kwargs)
+            if current is not None:
+                current.attributes['status'] = response.status_code
+            return response
@@ -0,0 +1,327 @@
+"""
+Индексы пользователей для поиска из панели управления без полного обхода.
+
+Индексы обновляются инкрементально при каждом изменении пользователя:
+
+    активность   отсортированные ключи (last_activity, user_id), отдельно для
+                 каждого сочетания флагов is_subscribed и pdf_sent
+    username     отсортированные ключи (username в нижнем регистре, user_id)
+
+Ключи хранятся в блочных отсортированных списках: вставка и удаление —
+бинарный поиск и сдвиг внутри блока, а не всего списка. Запрос с флагами
+читает только списки подходящих сочетаний, поэтому страница набирается без
+перебора неподходящих пользователей. Перебор по префиксу username идёт
+порциями, и блокировка индекса отпускается между ними.
+
+Обновление идемпотентно: индекс хранит текущие ключи каждого пользователя и при
+изменении удаляет именно их, поэтому повторное применение той же записи ничего
+не ломает. Это позволяет строить индекс целиком после фоновой загрузки и затем
+доприменять изменения, пришедшие во время построения, а хранилищу — обновлять
+индекс уже после снятия блокировки своей полосы (см. UserIndex.refresh).
+"""
+import heapq
+import itertools
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Callable, Dict, Any, Iterable, List, Optional, Tuple
+
+# Флаги пользователя, по сочетаниям которых разбит индекс активности
+FLAGS = ('is_subscribed', 'pdf_sent')
+
+# Все сочетания флагов в порядке FLAGS
+COMBINATIONS = tuple(itertools.product((False, True), repeat=len(FLAGS)))
+
+_MAX_KEY = '\U0010ffff'
+
+# Сколько ключей username проверяется за одно удержание блокировки индекса
+SCAN_CHUNK = 1000
+
+
+class SortedKeys:
+    """Отсортированный список ключей, разбитый на блоки не длиннее 2 * LOAD."""
+
+    LOAD = 512
+
+    def __init__(self, keys: Iterable = ()):
+        ordered = sorted(keys)
+        self._blocks: List[list] = [ordered[i:i + self.LOAD] for i in range(0, len(ordered), self.LOAD)]
+        self._maxes: List[Any] = [block[-1] for block in self._blocks]
+        self._len = len(ordered)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, key: Any) -> None:
+        self._len += 1
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            return
+        i = min(bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        insort(block, key)
+        self._maxes[i] = block[-1]
+        if len(block) > 2 * self.LOAD:
+            self._blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+            self._maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+
+    def remove(self, key: Any) -> None:
+        i = bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect_left(block, key)]
+        self._len -= 1
+        if block:
+            self._maxes[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+
+    def range(self, low: Any = None, high: Any = None, descending: bool = False,
+              limit: Optional[int] = None) -> List[Any]:
+        """Ключи из [low, high) по порядку (или в обратном), не больше limit."""
+        result: List[Any] = []
+        if limit == 0 or not self._blocks:
+            return result
+        if descending:
+            i = bisect_left(self._maxes, high) if high is not None else len(self._blocks) - 1
+            i = min(i, len(self._blocks) - 1)
+            j = bisect_left(self._blocks[i], high) if high is not None else len(self._blocks[i])
+            while i >= 0:
+                block = self._blocks[i]
+                for position in range(j - 1, -1, -1):
+                    key = block[position]
+                    if low is not None and key < low:
+                        return result
+                    result.append(key)
+                    if limit is not None and len(result) >= limit:
+                        return result
+                i -= 1
+                j = len(self._blocks[i]) if i >= 0 else 0
+        else:
+            i = bisect_left(self._maxes, low) if low is not None else 0
+            j = bisect_left(self._blocks[i], low) if low is not None and i < len(self._blocks) else 0
+            while i < len(self._blocks):
+                block = self._blocks[i]
+                for position in range(j, len(block)):
+                    key = block[position]
+                    if high is not None and key >= high:
+                        return result
+                    result.append(key)
+                    if limit is not None and len(result) >= limit:
+                        return result
+                i += 1
+                j = 0
+        return result
+
+
+def user_activity_key(user_id: int, user_data: Dict[str, Any]) -> Tuple[float, int]:
+    last_activity = user_data.get('last_activity')
+    timestamp = last_activity.timestamp() if isinstance(last_activity, datetime) else 0.0
+    return timestamp, user_id
+
+
+def _username_key(user_id: int, user_data: Dict[str, Any]) -> Tuple[str, int]:
+    return (user_data.get('username') or '').lower(), user_id
+
+
+def _combination(user_data: Dict[str, Any]) -> Tuple[bool, ...]:
+    return tuple(bool(user_data.get(flag)) for flag in FLAGS)
+
+
+def encode_cursor(key: Tuple[float, int]) -> str:
+    return f'{key[0]!r}:{key[1]}'
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    timestamp, user_id = cursor.split(':')
+    return float(timestamp), int(user_id)
+
+
+class UserIndex:
+    """Инкрементально поддерживаемые индексы для запросов к пользователям."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        self.ready = threading.Event()
+        self.ready.set()
+        self._pending: set = set()
+
+    def _reset(self) -> None:
+        self._activity: Dict[Tuple[bool, ...], SortedKeys] = {combination: SortedKeys()
+                                                              for combination in COMBINATIONS}
+        self._usernames = SortedKeys()
+        # user_id -> (ключ активности, ключ username, сочетание флагов)
+        self._state: Dict[int, Tuple[Tuple[float, int], Tuple[str, int], Tuple[bool, ...]]] = {}
+
+    # Обновление
+
+    def refresh(self, user_id: int, lookup: Callable[[int], Optional[Dict[str, Any]]]) -> None:
+        """
+        Приводит индекс в соответствие с актуальной записью пользователя.
+
+        Запись читается через lookup уже под блокировкой индекса, поэтому при
+        параллельных изменениях одного пользователя последним применяется самое
+        новое значение, в каком бы порядке ни пришли вызовы.
+        """
+        with self._lock:
+            if not self.ready.is_set():
+                self._pending.add(user_id)
+                return
+            self._apply(user_id, lookup(user_id))
+
+    def _apply(self, user_id: int, user_data: Optional[Dict[str, Any]]) -> None:
+        state = self._state.get(user_id)
+        if user_data is not None:
+            new_state = (user_activity_key(user_id, user_data), _username_key(user_id, user_data),
+                         _combination(user_data))
+            if state == new_state:
+                return
+        else:
+            new_state = None
+
+        if state is not None:
+            activity_key, username_key, combination = state
+            self._activity[combination].remove(activity_key)
+            self._usernames.remove(username_key)
+            del self._state[user_id]
+
+        if new_state is not None:
+            activity_key, username_key, combination = new_state
+            self._activity[combination].add(activity_key)
+            self._usernames.add(username_key)
+            self._state[user_id] = new_state
+
+    def begin_rebuild(self) -> None:
+        """Переводит индекс в режим построения: изменения откладываются."""
+        with self._lock:
+            self._pending = set()
+            self.ready.clear()
+
+    def finish_rebuild(self, items: Iterable[Tuple[int, Dict[str, Any]]], lookup) -> None:
+        """
+        Строит индекс целиком и доприменяет изменения, отложенные во время построения.
+
+        Args:
+            items: Пары (user_id, запись), из которых строится индекс
+            lookup: Функция, возвращающая актуальную запись пользователя или None
+        """
+        activity: Dict[Tuple[bool, ...], list] = {combination: [] for combination in COMBINATIONS}
+        usernames = []
+        state = {}
+        for user_id, user_data in items:
+            activity_key = user_activity_key(user_id, user_data)
+            username_key = _username_key(user_id, user_data)
+            combination = _combination(user_data)
+            activity[combination].append(activity_key)
+            usernames.append(username_key)
+            state[user_id] = (activity_key, username_key, combination)
+        activity_keys = {combination: SortedKeys(keys) for combination, keys in activity.items()}
+        username_keys = SortedKeys(usernames)
+
+        with self._lock:
+            self._activity = activity_keys
+            self._usernames = username_keys
+            self._state = state
+            for user_id in self._pending:
+                self._apply(user_id, lookup(user_id))
+            self._pending = set()
+            self.ready.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    # Запросы
+
+    def count(self, flag: str) -> int:
+        """Возвращает количество пользователей с установленным флагом."""
+        self.ready.wait()
+        position = FLAGS.index(flag)
+        with self._lock:
+            return sum(len(keys) for combination, keys in self._activity.items() if combination[position])
+
+    def query(self,
+              flags: Optional[Dict[str, bool]] = None,
+              active_from: Optional[datetime] = None,
+              active_to: Optional[datetime] = None,
+              username_prefix: Optional[str] = None,
+              descending: bool = True,
+              cursor: Optional[str] = None,
+              limit: int = 50) -> Tuple[List[int], Optional[str]]:
+        """
+        Ищет пользователей, отсортированных по last_activity.
+
+        Args:
+            flags: Требуемые значения флагов, например {'is_subscribed': True}
+            active_from: Нижняя граница last_activity (включительно)
+            active_to: Верхняя граница last_activity (включительно)
+            username_prefix: Префикс username без учёта регистра
+            descending: Сначала самые недавно активные
+            cursor: Курсор, полученный из предыдущей страницы
+            limit: Размер страницы
+
+        Returns:
+            Список user_id страницы и курсор следующей страницы (или None)
+        """
+        flags = flags or {}
+        username_prefix = (username_prefix or '').lower()
+        self.ready.wait()
+
+        # Границы диапазона ключей активности: [low, high)
+        low = (active_from.timestamp(), -1 << 63) if active_from is not None else None
+        high = (active_to.timestamp(), 1 << 63) if active_to is not None else None
+        if cursor:
+            timestamp, user_id = decode_cursor(cursor)
+            if descending:
+                high = min(high, (timestamp, user_id)) if high is not None else (timestamp, user_id)
+            else:
+                # Ключ сразу после курсора: user_id целые
+                low = max(low, (timestamp, user_id + 1)) if low is not None else (timestamp, user_id + 1)
+
+        combinations = [combination for combination in COMBINATIONS
+                        if all(combination[FLAGS.index(flag)] == bool(value) for flag, value in flags.items())]
+
+        if username_prefix:
+            page = self._query_username(username_prefix, set(combinations), low, high, descending, limit + 1)
+        else:
+            # Из каждого подходящего сочетания флагов нужно не больше limit + 1 ключей
+            with self._lock:
+                parts = [self._activity[combination].range(low, high, descending, limit + 1)
+                         for combination in combinations]
+            page = list(itertools.islice(heapq.merge(*parts, reverse=descending), limit + 1))
+
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return [user_id for _, user_id in page[:limit]], next_cursor
+
+    def _query_username(self, prefix: str, combinations: set, low, high,
+                        descending: bool, size: int) -> List[Tuple[float, int]]:
+        """Первые size ключей активности пользователей с префиксом username; перебор идёт порциями."""
+        best: List[Any] = []
+        start: Tuple[str, int] = (prefix,)
+        end = (prefix + _MAX_KEY,)
+        while True:
+            with self._lock:
+                chunk = self._usernames.range(start, end, limit=SCAN_CHUNK)
+                found = []
+                for username_key in chunk:
+                    state = self._state.get(username_key[1])
+                    if state is None or state[2] not in combinations:
+                        continue
+                    activity_key = state[0]
+                    if (low is None or activity_key >= low) and (high is None or activity_key < high):
+                        found.append(activity_key)
+            for activity_key in found:
+                # Куча из size лучших: для descending — наибольших ключей
+                item = activity_key if descending else (-activity_key[0], -activity_key[1])
+                if len(best) < size:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+            if len(chunk) < SCAN_CHUNK:
+                break
+            start = (chunk[-1][0], chunk[-1][1] + 1)
+
+        keys = best if descending else [(-timestamp, -user_id) for timestamp, user_id in best]
+        return sorted(keys, reverse=descending)
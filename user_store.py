@@ -0,0 +1,534 @@
+"""
+Хранилище пользователей с быстрым холодным стартом.
+
+Данные пользователей сохраняются в компактный бинарный снимок
+(все числа little-endian):
+
+    заголовок  MAGIC(4) версия(H) размер_записи(H) записей(I) смещение_строк(Q)
+    записи     фиксированной ширины, отсортированы по user_id
+    строки     количество(I), смещения(I * (количество + 1)), данные utf-8
+
+Даты хранятся как секунды эпохи (NaN — значение отсутствует), строки
+(username и редкие дополнительные поля в JSON) вынесены в общую таблицу строк.
+
+Снимок открывается через mmap, а записи переносятся в память фоновым потоком,
+поэтому бот начинает обслуживать пользователей сразу. Так как записи
+отсортированы по user_id, сам снимок служит индексом: пользователь, до которого
+загрузка ещё не дошла, находится бинарным поиском прямо в файле.
+"""
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Mapping, MutableMapping
+from datetime import datetime
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+from user_index import UserIndex
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'UMUS'
+SNAPSHOT_VERSION = 1
+
+# MAGIC, версия, размер записи, количество записей, смещение таблицы строк
+HEADER = struct.Struct('<4sHHIQ')
+# user_id, username, дополнительные поля, флаги, last_activity, last_checked
+RECORD = struct.Struct('<qIIB3xdd')
+UINT32 = struct.Struct('<I')
+
+NO_STRING = 0xFFFFFFFF
+
+FLAG_WELCOME_SENT = 1
+FLAG_PDF_SENT = 2
+FLAG_IS_SUBSCRIBED = 4
+
+# Поля, которые хранятся в записи напрямую; остальные попадают в extra
+_RECORD_FIELDS = ('user_id', 'username', 'welcome_sent', 'pdf_sent', 'is_subscribed',
+                  'last_activity', 'last_checked')
+
+
+def _to_epoch(value: Any) -> float:
+    """Преобразует datetime в секунды эпохи, отсутствующее значение — в NaN."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return math.nan
+
+
+def _from_epoch(value: float) -> Optional[datetime]:
+    if math.isnan(value):
+        return None
+    return datetime.fromtimestamp(value)
+
+
+def write_snapshot(path: str, users: Dict[int, Dict[str, Any]]) -> None:
+    """
+    Записывает бинарный снимок пользователей.
+
+    Файл сначала пишется во временный, а затем атомарно заменяет старый снимок,
+    поэтому сбой во время записи не портит предыдущие данные.
+    """
+    strings: Dict[str, int] = {}
+
+    def intern(value: str) -> int:
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    records = bytearray(RECORD.size * len(users))
+    for position, user_id in enumerate(sorted(users)):
+        user_data = users[user_id]
+        extra = {key: value for key, value in user_data.items() if key not in _RECORD_FIELDS}
+
+        flags = 0
+        if user_data.get('welcome_sent'):
+            flags |= FLAG_WELCOME_SENT
+        if user_data.get('pdf_sent'):
+            flags |= FLAG_PDF_SENT
+        if user_data.get('is_subscribed'):
+            flags |= FLAG_IS_SUBSCRIBED
+
+        RECORD.pack_into(
+            records, position * RECORD.size,
+            user_id,
+            intern(user_data.get('username') or ''),
+            intern(json.dumps(extra, ensure_ascii=False, default=str)) if extra else NO_STRING,
+            flags,
+            _to_epoch(user_data.get('last_activity')),
+            _to_epoch(user_data.get('last_checked')),
+        )
+
+    encoded = [value.encode('utf-8') for value in strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+
+    strings_offset = HEADER.size + len(records)
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, RECORD.size, len(users), strings_offset)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(header)
+        file.write(records)
+        file.write(UINT32.pack(len(encoded)))
+        file.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        for value in encoded:
+            file.write(value)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotReader:
+    """Читает бинарный снимок через mmap без полной загрузки в память."""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+        magic, version, record_size, count, strings_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f'Неподдерживаемый формат снимка: {path}')
+
+        self.count = count
+        self._strings_count = UINT32.unpack_from(self._mm, strings_offset)[0]
+        self._offsets_base = strings_offset + UINT32.size
+        self._data_base = self._offsets_base + UINT32.size * (self._strings_count + 1)
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+    def _string(self, index: int) -> str:
+        start = UINT32.unpack_from(self._mm, self._offsets_base + UINT32.size * index)[0]
+        end = UINT32.unpack_from(self._mm, self._offsets_base + UINT32.size * (index + 1))[0]
+        return self._mm[self._data_base + start:self._data_base + end].decode('utf-8')
+
+    def _user_id_at(self, position: int) -> int:
+        return struct.unpack_from('<q', self._mm, HEADER.size + position * RECORD.size)[0]
+
+    def record(self, position: int) -> Tuple[int, Dict[str, Any]]:
+        """Декодирует запись с указанным номером в словарь пользователя."""
+        user_id, username, extra, flags, last_activity, last_checked = RECORD.unpack_from(
+            self._mm, HEADER.size + position * RECORD.size)
+
+        user_data: Dict[str, Any] = {
+            'user_id': user_id,
+            'username': self._string(username),
+            'welcome_sent': bool(flags & FLAG_WELCOME_SENT),
+            'pdf_sent': bool(flags & FLAG_PDF_SENT),
+            'is_subscribed': bool(flags & FLAG_IS_SUBSCRIBED),
+        }
+
+        last_activity = _from_epoch(last_activity)
+        if last_activity is not None:
+            user_data['last_activity'] = last_activity
+        last_checked = _from_epoch(last_checked)
+        if last_checked is not None:
+            user_data['last_checked'] = last_checked
+
+        if extra != NO_STRING:
+            user_data.update(json.loads(self._string(extra)))
+
+        return user_id, user_data
+
+    def find(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Ищет пользователя бинарным поиском по отсортированным записям."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._user_id_at(middle) < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._user_id_at(low) == user_id:
+            return self.record(low)[1]
+        return None
+
+    def __iter__(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        for position in range(self.count):
+            yield self.record(position)
+
+
+def parse_json_users(path: str) -> Dict[int, Dict[str, Any]]:
+    """Читает пользователей из старого формата users.json."""
+    with open(path, 'r', encoding='utf-8') as file:
+        loaded_users = json.load(file)
+
+    result = {}
+    # Преобразуем строковые ключи обратно в целые числа и обрабатываем даты
+    for user_id_str, user_data in loaded_users.items():
+        for key in ('last_activity', 'last_checked'):
+            if key in user_data and isinstance(user_data[key], str):
+                try:
+                    user_data[key] = datetime.fromisoformat(user_data[key])
+                except ValueError:
+                    user_data[key] = datetime.now()
+        result[int(user_id_str)] = user_data
+    return result
+
+
+class UserSnapshot(Mapping):
+    """
+    Неизменяемый снимок пользователей, собранный из снимков отдельных полос.
+
+    Записи пользователей в хранилище никогда не изменяются на месте, поэтому
+    снимок остаётся согласованным, сколько бы ни шла по нему итерация.
+    """
+
+    def __init__(self, parts: Tuple[Dict[int, Dict[str, Any]], ...]):
+        self._parts = parts
+
+    def __getitem__(self, user_id: int) -> Dict[str, Any]:
+        return self._parts[user_id % len(self._parts)][user_id]
+
+    def __iter__(self) -> Iterator[int]:
+        for part in self._parts:
+            yield from part
+
+    def __len__(self) -> int:
+        return sum(len(part) for part in self._parts)
+
+
+class _Stripe:
+    """Полоса хранилища: часть пользователей со своей блокировкой."""
+    __slots__ = ('lock', 'data', 'frozen')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data: Dict[int, Dict[str, Any]] = {}
+        # Копия data для снимков; None, если с момента копирования были записи
+        self.frozen: Optional[Dict[int, Dict[str, Any]]] = None
+
+
+class UserStore(MutableMapping):
+    """
+    Потокобезопасное хранилище пользователей.
+
+    Пользователи разбиты на полосы по user_id, у каждой полосы своя блокировка,
+    так что записи разных пользователей почти не конкурируют. Записи
+    пользователей неизменяемы: update_user подменяет запись новой копией.
+    Благодаря этому snapshot() копирует только полосы, изменённые с прошлого
+    снимка, а долгие экспорт и сохранение идут по снимку и не блокируют
+    обработчики сообщений.
+
+    Пока идёт фоновая загрузка, обращение к отдельному пользователю ищет его
+    в файле снимка по индексу, а операции над всеми пользователями (итерация,
+    len, очистка, сохранение) дожидаются окончания загрузки.
+
+    Каждое изменение записи после снятия блокировки полосы отражается в индексах
+    (index), по которым работают запросы панели управления: индекс сам читает
+    актуальную запись, поэтому порядок обновлений индекса не важен.
+    """
+
+    STRIPES = 64
+
+    def __init__(self, snapshot_file: str, json_file: str):
+        self.snapshot_file = snapshot_file
+        self.json_file = json_file
+
+        self._stripes = tuple(_Stripe() for _ in range(self.STRIPES))
+        self._reader_lock = threading.Lock()
+        self._reader: Optional[SnapshotReader] = None
+        self._loaded = threading.Event()
+        self._loaded.set()
+        # Файл, который не удалось загрузить и не удалось убрать в сторону:
+        # пока он задан, save() не перезаписывает данные неполными
+        self.unsaved_source: Optional[str] = None
+        self.index = UserIndex()
+
+    def _stripe(self, user_id: int) -> _Stripe:
+        return self._stripes[user_id % self.STRIPES]
+
+    def _current(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._stripe(user_id).data.get(user_id)
+
+    def _reindex(self, user_id: int) -> None:
+        """Обновляет индекс пользователя; вызывается без блокировки полосы."""
+        self.index.refresh(user_id, self._current)
+
+    # Загрузка
+
+    def start_loading(self) -> None:
+        """Запускает фоновую загрузку из снимка или конвертацию из users.json."""
+        snapshot_exists = os.path.exists(self.snapshot_file)
+        json_exists = os.path.exists(self.json_file)
+
+        if json_exists and (not snapshot_exists
+                            or os.path.getmtime(self.json_file) > os.path.getmtime(self.snapshot_file)):
+            target = self._convert_json
+        elif snapshot_exists:
+            try:
+                self._reader = SnapshotReader(self.snapshot_file)
+            except Exception as e:
+                logger.error(f'Ошибка открытия снимка пользователей: {e}')
+                self._set_aside(self.snapshot_file)
+                return
+            target = self._load_snapshot
+        else:
+            logger.info('Файл с данными пользователей не найден, создаем новый')
+            return
+
+        self._loaded.clear()
+        self.index.begin_rebuild()
+        threading.Thread(target=target, name='users-loader', daemon=True).start()
+
+    def _load_snapshot(self) -> None:
+        started = datetime.now()
+        try:
+            self._merge(self._reader)
+            logger.info(f'Загружены данные {self._reader.count} пользователей из снимка '
+                        f'за {(datetime.now() - started).total_seconds():.2f} с')
+        except Exception as e:
+            logger.error(f'Ошибка загрузки данных пользователей: {e}')
+            self._set_aside(self.snapshot_file)
+        finally:
+            with self._reader_lock:
+                self._reader.close()
+                self._reader = None
+                self._loaded.set()
+            self._rebuild_index()
+
+    def _convert_json(self) -> None:
+        try:
+            loaded_users = parse_json_users(self.json_file)
+            self._merge(loaded_users.items())
+            logger.info(f'Загружены данные {len(loaded_users)} пользователей из {self.json_file}')
+        except Exception as e:
+            logger.error(f'Ошибка загрузки данных пользователей: {e}')
+            self._set_aside(self.json_file)
+            self._loaded.set()
+            self._rebuild_index()
+            return
+
+        self._loaded.set()
+        self._rebuild_index()
+        # Сразу сохраняем снимок, чтобы следующий запуск был быстрым
+        self.save()
+        logger.info(f'Данные пользователей сконвертированы в {self.snapshot_file}')
+
+    def _set_aside(self, path: str) -> None:
+        """
+        Переносит файл, который не удалось загрузить, в <файл>.corrupt.
+
+        Иначе следующее сохранение заменило бы его пустыми или неполными данными.
+        Если перенести не удалось, сохранение запрещается до перезапуска.
+        """
+        corrupt_file = f'{path}.corrupt'
+        try:
+            os.replace(path, corrupt_file)
+            logger.error(f'Файл {path} перенесён в {corrupt_file}, данные из него не загружены')
+        except OSError as e:
+            self.unsaved_source = path
+            logger.error(f'Не удалось перенести {path} в {corrupt_file}: {e}; сохранение данных отключено')
+
+    def _merge(self, items) -> None:
+        # Записи, уже созданные или загруженные по индексу, новее снимка.
+        # Индексы для загруженных записей строятся целиком после загрузки.
+        for user_id, user_data in items:
+            self._insert(user_id, user_data, index=False)
+
+    def _rebuild_index(self) -> None:
+        started = datetime.now()
+        self.index.finish_rebuild(self.snapshot().items(), self._current)
+        logger.info(f'Индексы пользователей построены за {(datetime.now() - started).total_seconds():.2f} с')
+
+    def _insert(self, user_id: int, user_data: Dict[str, Any], index: bool = True) -> Dict[str, Any]:
+        """Добавляет пользователя, если его ещё нет, и возвращает актуальную запись."""
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            current = stripe.data.get(user_id)
+            if current is not None:
+                return current
+            current = stripe.data[user_id] = user_data
+            stripe.frozen = None
+        if index:
+            self._reindex(user_id)
+        return current
+
+    def wait_loaded(self, timeout: Optional[float] = None) -> bool:
+        """Ожидает окончания фоновой загрузки."""
+        return self._loaded.wait(timeout)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    def _fallback(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Находит пользователя, до которого ещё не дошла фоновая загрузка."""
+        if self._loaded.is_set():
+            return None
+
+        with self._reader_lock:
+            if self._reader is None:
+                reader_available = False
+            else:
+                reader_available = True
+                user_data = self._reader.find(user_id)
+                if user_data is not None:
+                    return self._insert(user_id, user_data, index=False)
+
+        if not reader_available:
+            # Конвертация из JSON не даёт индекса — дожидаемся её окончания
+            self.wait_loaded()
+            return self._stripe(user_id).data.get(user_id)
+        return None
+
+    # Снимки и сохранение
+
+    def snapshot(self) -> UserSnapshot:
+        """
+        Возвращает согласованный снимок всех пользователей.
+
+        Копируются только полосы, изменённые с момента предыдущего снимка;
+        каждая из них блокируется лишь на время копирования.
+        """
+        self.wait_loaded()
+        parts = []
+        for stripe in self._stripes:
+            frozen = stripe.frozen
+            if frozen is None:
+                with stripe.lock:
+                    frozen = stripe.frozen = dict(stripe.data)
+            parts.append(frozen)
+        return UserSnapshot(tuple(parts))
+
+    def save(self) -> None:
+        """Сохраняет всех пользователей в бинарный снимок."""
+        if self.unsaved_source is not None:
+            raise RuntimeError(f'Данные не загружены из {self.unsaved_source}, сохранение отключено')
+        write_snapshot(self.snapshot_file, self.snapshot())
+
+    # Изменение записей
+
+    def update_user(self, user_id: int, **changes: Any) -> Optional[Dict[str, Any]]:
+        """
+        Атомарно обновляет поля пользователя.
+
+        Returns:
+            Новая запись пользователя или None, если пользователь не найден
+        """
+        if user_id not in self:
+            return None
+
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            current = stripe.data.get(user_id)
+            if current is None:
+                return None
+            updated = stripe.data[user_id] = {**current, **changes}
+            stripe.frozen = None
+        self._reindex(user_id)
+        return updated
+
+    def setdefault(self, user_id: int, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Атомарно добавляет пользователя, если его ещё нет."""
+        existing = self.get(user_id)
+        if existing is not None:
+            return existing
+        return self._insert(user_id, user_data)
+
+    # Интерфейс словаря
+
+    def __getitem__(self, user_id: int) -> Dict[str, Any]:
+        try:
+            return self._stripe(user_id).data[user_id]
+        except KeyError:
+            user_data = self._fallback(user_id)
+            if user_data is None:
+                raise
+            return user_data
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self._stripe(user_id).data or self._fallback(user_id) is not None
+
+    def __setitem__(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            stripe.data[user_id] = user_data
+            stripe.frozen = None
+        self._reindex(user_id)
+
+    def __delitem__(self, user_id: int) -> None:
+        self.wait_loaded()
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            del stripe.data[user_id]
+            stripe.frozen = None
+        self._reindex(user_id)
+
+    def __iter__(self) -> Iterator[int]:
+        # Итерация идёт по снимку, поэтому параллельные изменения ей не мешают
+        return iter(self.snapshot())
+
+    def items(self):
+        return self.snapshot().items()
+
+    def values(self):
+        return self.snapshot().values()
+
+    def __len__(self) -> int:
+        self.wait_loaded()
+        return sum(len(stripe.data) for stripe in self._stripes)
+
+    def clear(self) -> None:
+        self.wait_loaded()
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.data.clear()
+                stripe.frozen = None
+        self.index.clear()
+
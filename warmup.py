@@ -0,0 +1,87 @@
+"""
+Прогрев бота перед началом приёма обновлений.
+
+Первые пользователи после запуска не должны платить за холодный старт:
+скачивание PDF, первую загрузку файла в Telegram, проверку канала и установку
+TLS-соединений с Bot API. WarmUp выполняет эти шаги заранее, замеряет время
+каждого и ограничивает общее время прогрева: если шаги не уложились в таймаут
+или завершились ошибкой, бот всё равно запускается, а недогретое доделывается
+при первом обращении, как раньше.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SkipStep(Exception):
+    """Шаг прогрева не нужен в текущей конфигурации."""
+
+
+class WarmUp:
+    """Последовательность шагов прогрева с замером времени и общим таймаутом."""
+
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self._steps: List[Tuple[str, Callable[[], Any]]] = []
+        # Результаты шагов: {имя: {'status': ..., 'seconds': ..., 'detail': ...}}
+        self.report: Dict[str, Dict[str, Any]] = {}
+        self.finished = False
+
+    def step(self, name: str, func: Callable[[], Any]) -> None:
+        """Добавляет шаг; func может вернуть строку с подробностями результата."""
+        self._steps.append((name, func))
+        self.report[name] = {'status': 'pending', 'seconds': None, 'detail': None}
+
+    def _run_steps(self) -> None:
+        for name, func in self._steps:
+            self.report[name]['status'] = 'running'
+            started = time.monotonic()
+            try:
+                detail = func()
+                status = 'ok'
+            except SkipStep as e:
+                detail = str(e)
+                status = 'skipped'
+            except Exception as e:
+                detail = str(e)
+                status = 'failed'
+            seconds = round(time.monotonic() - started, 3)
+            self.report[name].update(status=status, seconds=seconds, detail=detail)
+
+            message = f'Прогрев: {name} — {status} за {seconds} с'
+            if detail:
+                message += f' ({detail})'
+            if status == 'failed':
+                logger.warning(message)
+            else:
+                logger.info(message)
+
+    def run(self) -> bool:
+        """
+        Выполняет шаги, но не дольше timeout секунд.
+
+        Шаги, не успевшие завершиться, продолжают выполняться в фоне.
+
+        Returns:
+            bool: True, если все шаги завершились без ошибок и вовремя
+        """
+        started = time.monotonic()
+        worker = threading.Thread(target=self._run_steps, name='warm-up', daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        self.finished = True
+
+        total = round(time.monotonic() - started, 3)
+        if worker.is_alive():
+            logger.warning(f'Прогрев не уложился в {self.timeout} с, запускаем бота без полного прогрева')
+            return False
+
+        failed = [name for name, result in self.report.items() if result['status'] == 'failed']
+        if failed:
+            logger.warning(f'Прогрев завершён за {total} с с ошибками: {", ".join(failed)}')
+            return False
+        logger.info(f'Прогрев завершён за {total} с')
+        return True